@@ -1,10 +1,18 @@
 ﻿# -*- coding: utf-8 -*-
-import os, re, tempfile, shutil, uuid, time, hmac, hashlib, json, secrets, subprocess, threading
+import os, re, sys, atexit, base64, copy, functools, contextvars, math, mmap, struct, tempfile, shutil, uuid, time, hmac, hashlib, json, secrets, subprocess, threading, queue, collections, sqlite3, heapq, zipfile, selectors, socket, ssl
+from array import array
+from contextlib import contextmanager
+from urllib.parse import quote
 from datetime import datetime
-from flask import Flask, request, send_file, render_template_string, abort, url_for, redirect, Response, stream_with_context
+from flask import Flask, g, request, send_file, render_template_string, abort, url_for, redirect, Response, stream_with_context
 from werkzeug.exceptions import HTTPException
 from werkzeug.utils import secure_filename
 import yt_dlp, imageio_ffmpeg
+from yt_dlp.networking import Request as YDLRequest
+try:
+    import fcntl
+except ImportError:  # Windows: sin bloqueo entre procesos
+    fcntl = None
 
 DEPLOY_MARK = "PYTHONANYWHERE v7-preview-unlock"
 
@@ -30,9 +38,18 @@ SESSION_TTL = 30 * 60  # 30 min
 MAX_UPLOAD_SIZE = 500 * 1024 * 1024  # 500 MB
 app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_SIZE
 
-# Sistema de progreso para SSE
-progress_store = {}  # {session_id: {"progress": 0-100, "message": str, "status": str, "error": str}}
-progress_lock = threading.Lock()
+# Sistema de progreso para SSE. "memory" vale para un solo worker; con varios
+# workers de gunicorn hace falta "sqlite" para que /progress vea el trabajo de otro.
+PROGRESS_BACKEND = os.environ.get("PROGRESS_BACKEND", "memory").lower()
+PROGRESS_DB = os.environ.get("PROGRESS_DB", os.path.join(tempfile.gettempdir(), "ytmp3_progress.db"))
+PROGRESS_POLL = 0.25        # s entre consultas a la base compartida
+SSE_HEARTBEAT = 15          # s entre comentarios keepalive
+SSE_IDLE_TIMEOUT = 300      # s sin cambios antes de cerrar el stream
+
+# Trabajos /prepare en curso por vídeo (single-flight)
+inflight_jobs = {}       # {video_id: {"leader": sid, "followers": [sid, ...]}}
+inflight_by_leader = {}  # {sid líder: mismo dict}
+inflight_lock = threading.Lock()
 
 # ---------- HTMLs ----------
 HOME_HTML = r'''<!doctype html>
@@ -170,9 +187,15 @@ YOUTUBE_HTML = r'''<!doctype html>
         eventSource.close();
         showError(data.error);
       });
+      // EventSource reconecta solo (con Last-Event-ID); se abandona tras varios fallos seguidos
+      let failures = 0;
+      eventSource.addEventListener('open', function() { failures = 0; });
       eventSource.onerror = function() {
-        eventSource.close();
-        showError('Error de conexión. Por favor, intenta de nuevo.');
+        failures++;
+        if (eventSource.readyState === EventSource.CLOSED || failures > 5) {
+          eventSource.close();
+          showError('Error de conexión. Por favor, intenta de nuevo.');
+        }
       };
     })
     .catch(err => { showError('Error: ' + err.message); });
@@ -227,8 +250,26 @@ UPLOAD_HTML = r'''<!doctype html>
   label { display: block; font-weight: 600; margin-bottom: .25rem; }
   input[type=file] { width: 100%; padding: .4rem; font-size: 1rem; }
   button { padding: .65rem 1rem; font-size: 1rem; cursor: pointer; }
+  button:disabled { opacity: 0.6; cursor: not-allowed; }
   .hint { font-size: .95rem; }
   .sr-only { position: absolute; left: -10000px; top: auto; width: 1px; height: 1px; overflow: hidden; }
+  .progress-container { display: none; margin-top: 1.5rem; padding: 1rem; background: #f5f5f5; border-radius: 8px; }
+  .progress-container.active { display: block; }
+  .progress-label { display: flex; justify-content: space-between; margin-bottom: 0.5rem; font-weight: 600; }
+  .progress-percentage { color: #0066cc; font-size: 1.1rem; }
+  .progress-bar { width: 100%; height: 24px; background: #e0e0e0; border-radius: 12px; overflow: hidden; box-shadow: inset 0 1px 3px rgba(0,0,0,0.2); }
+  .progress-fill { height: 100%; background: linear-gradient(90deg, #0066cc, #0088ff); border-radius: 12px; transition: width 0.3s ease; }
+  .progress-message { margin-top: 0.5rem; font-size: 0.9rem; color: #666; font-style: italic; }
+  .progress-bar.complete .progress-fill { background: linear-gradient(90deg, #4caf50, #66bb6a); }
+  .progress-bar.error .progress-fill { background: linear-gradient(90deg, #f44336, #e57373); }
+  @media (prefers-color-scheme: dark) {
+    .progress-container { background: #2a2a2a; }
+    .progress-bar { background: #1a1a1a; }
+    .progress-message { color: #b0b0b0; }
+  }
+  @media (prefers-reduced-motion: reduce) {
+    .progress-fill { transition: none; }
+  }
 </style>
 </head>
 <body>
@@ -240,18 +281,226 @@ UPLOAD_HTML = r'''<!doctype html>
 <main role="main" aria-labelledby="h2">
   <h2 id="h2" class="sr-only">Formulario de subida</h2>
 
-  <form action="{{ url_for('upload_post') }}" method="post" enctype="multipart/form-data">
+  <form id="uploadForm" action="{{ url_for('upload_post') }}" method="post" enctype="multipart/form-data">
     <div class="group">
       <label for="file">Archivo de audio o vídeo</label>
       <input id="file" name="file" type="file" accept="audio/*,video/*" required>
       <div class="hint">Se convertirá a MP3 para editar y descargar.</div>
     </div>
-    <button type="submit">Preparar audio</button>
+    <button type="submit" id="submitBtn">Preparar audio</button>
   </form>
+  <div id="progressContainer" class="progress-container" role="region" aria-label="Progreso de procesamiento">
+    <div aria-live="polite" aria-atomic="true" class="sr-only" id="announcer"></div>
+    <div class="progress-label">
+      <span id="progressStatus">Preparando</span>
+      <span class="progress-percentage" id="progressPercent" aria-live="polite">0%</span>
+    </div>
+    <div id="progressBar" class="progress-bar" role="progressbar" aria-valuenow="0" aria-valuemin="0" aria-valuemax="100" aria-labelledby="progressStatus">
+      <div class="progress-fill" id="progressFill" style="width: 0%">
+        <span class="sr-only" id="progressSR">0% completado</span>
+      </div>
+    </div>
+    <div class="progress-message" id="progressMessage" aria-live="polite"></div>
+  </div>
+</main>
+<script>
+(function() {
+  const form = document.getElementById('uploadForm');
+  const fileInput = document.getElementById('file');
+  const submitBtn = document.getElementById('submitBtn');
+  const progressContainer = document.getElementById('progressContainer');
+  const progressBar = document.getElementById('progressBar');
+  const progressFill = document.getElementById('progressFill');
+  const progressPercent = document.getElementById('progressPercent');
+  const progressMessage = document.getElementById('progressMessage');
+  const progressStatus = document.getElementById('progressStatus');
+  const progressSR = document.getElementById('progressSR');
+  const announcer = document.getElementById('announcer');
+  let lastAnnouncedProgress = -1;
+  let eventSource = null;
+  // Subida por trozos: si se corta la conexión (o se recarga la página) se sigue
+  // desde el último byte que tiene el servidor en lugar de empezar de cero.
+  const CHUNK = 4 * 1024 * 1024;
+  const RETRIES = 6;
+  const createUrl = '{{ url_for("uploads_create") }}';
+  form.addEventListener('submit', function(e) {
+    e.preventDefault();
+    if (!fileInput.files.length) return;
+    submitBtn.disabled = true;
+    submitBtn.textContent = 'Procesando...';
+    progressContainer.classList.add('active');
+    updateProgress(0, 'Subiendo archivo...', 'preparing');
+    chunkedUpload(fileInput.files[0]).then(listen, function(err) {
+      showError(err.message || 'Error de conexión. Por favor, intenta de nuevo.');
+    });
+  });
+  function fail(message) {
+    const err = new Error(message);
+    err.fatal = true;
+    return err;
+  }
+  function sleep(ms) { return new Promise(r => setTimeout(r, ms)); }
+  async function retrying(fn) {
+    for (let attempt = 0; ; attempt++) {
+      try { return await fn(); }
+      catch (err) {
+        if (err.fatal || attempt >= RETRIES) throw err;
+        updateProgress(0, 'Reintentando la subida...', 'preparing');
+        await sleep(Math.min(1000 * 2 ** attempt, 15000));
+      }
+    }
+  }
+  async function errorOf(resp) {
+    let data = null;
+    try { data = await resp.json(); } catch (err) {}
+    if (resp.status === 413) return fail((data && data.error) || 'El archivo es demasiado grande.');
+    const msg = (data && data.error) || ('Error del servidor (' + resp.status + ').');
+    return resp.status >= 500 ? new Error(msg) : fail(msg);
+  }
+  async function serverOffset(upload) {
+    const resp = await fetch(upload.upload_url, {method: 'HEAD', cache: 'no-store'});
+    if (resp.status === 404 || resp.status === 403) return null;
+    if (!resp.ok) throw new Error('Error del servidor (' + resp.status + ').');
+    return parseInt(resp.headers.get('Upload-Offset'), 10) || 0;
+  }
+  async function create(file) {
+    const resp = await fetch(createUrl, {method: 'POST', headers: {
+      'Upload-Length': String(file.size),
+      'Upload-Metadata': 'filename ' + btoa(unescape(encodeURIComponent(file.name))),
+    }});
+    if (resp.status !== 201) throw await errorOf(resp);
+    return resp.json();
+  }
+  async function chunkedUpload(file) {
+    const key = 'upload:' + [file.name, file.size, file.lastModified].join(':');
+    let upload = null, offset = null;
+    try { upload = JSON.parse(localStorage.getItem(key)); } catch (err) {}
+    if (upload) offset = await retrying(() => serverOffset(upload));
+    if (offset === null) {
+      upload = await retrying(() => create(file));
+      offset = 0;
+      try { localStorage.setItem(key, JSON.stringify(upload)); } catch (err) {}
+    }
+    while (offset < file.size) {
+      offset = await retrying(async () => {
+        let resp;
+        try {
+          resp = await fetch(upload.upload_url, {method: 'PATCH', body: file.slice(offset, offset + CHUNK), headers: {
+            'Upload-Offset': String(offset), 'Content-Type': 'application/offset+octet-stream',
+          }});
+        } catch (err) {
+          // No se sabe cuánto llegó: se pregunta antes de reintentar
+          const known = await serverOffset(upload).catch(() => null);
+          if (known !== null) offset = known;
+          throw err;
+        }
+        if (resp.status === 409) return parseInt(resp.headers.get('Upload-Offset'), 10) || 0;
+        if (resp.status !== 204) throw await errorOf(resp);
+        return parseInt(resp.headers.get('Upload-Offset'), 10);
+      });
+      updateProgress(0, 'Subiendo: ' + Math.round(offset / file.size * 100) + '%', 'preparing');
+    }
+    const data = await retrying(async () => {
+      const resp = await fetch(upload.finalize_url, {method: 'POST'});
+      if (!resp.ok) throw await errorOf(resp);
+      return resp.json();
+    });
+    try { localStorage.removeItem(key); } catch (err) {}
+    return data.session_id;
+  }
+  function listen(sid) {
+    eventSource = new EventSource('{{ url_for("progress_stream", sid="") }}' + sid);
+    eventSource.addEventListener('progress', function(e) {
+      const data = JSON.parse(e.data);
+      updateProgress(data.progress, data.message, data.status);
+    });
+    eventSource.addEventListener('complete', function(e) {
+      const data = JSON.parse(e.data);
+      eventSource.close();
+      window.location.href = data.editor_url;
+    });
+    eventSource.addEventListener('error_event', function(e) {
+      const data = JSON.parse(e.data);
+      eventSource.close();
+      showError(data.error);
+    });
+    // EventSource reconecta solo (con Last-Event-ID); se abandona tras varios fallos seguidos
+    let failures = 0;
+    eventSource.addEventListener('open', function() { failures = 0; });
+    eventSource.onerror = function() {
+      failures++;
+      if (eventSource.readyState === EventSource.CLOSED || failures > 5) {
+        eventSource.close();
+        showError('Error de conexión. Por favor, intenta de nuevo.');
+      }
+    };
+  }
+  function updateProgress(progress, message, status) {
+    progress = Math.min(Math.max(progress, 0), 100);
+    progressFill.style.width = progress + '%';
+    progressPercent.textContent = Math.round(progress) + '%';
+    progressMessage.textContent = message;
+    progressBar.setAttribute('aria-valuenow', progress);
+    progressSR.textContent = Math.round(progress) + '% completado';
+    if (status === 'complete') {
+      progressBar.classList.add('complete');
+      progressStatus.textContent = 'Completado';
+    } else if (status === 'error') {
+      progressBar.classList.add('error');
+      progressStatus.textContent = 'Error';
+    } else {
+      progressStatus.textContent = 'Procesando';
+    }
+    const roundedProgress = Math.floor(progress / 25) * 25;
+    if (roundedProgress !== lastAnnouncedProgress && roundedProgress > 0) {
+      lastAnnouncedProgress = roundedProgress;
+      announcer.textContent = 'Progreso: ' + roundedProgress + '%';
+    }
+  }
+  function showError(error) {
+    updateProgress(0, error, 'error');
+    submitBtn.disabled = false;
+    submitBtn.textContent = 'Preparar audio';
+    announcer.textContent = 'Error: ' + error;
+    setTimeout(() => {
+      progressContainer.classList.remove('active');
+      progressBar.classList.remove('error');
+    }, 5000);
+  }
+})();
+</script>
+</body>
+</html>'''
+
+# Espera sin JavaScript (formulario clásico de /upload): la página se recarga sola
+# hasta que el audio está listo y entonces redirige al editor
+WAIT_HTML = r'''<!doctype html>
+<html lang="es">
+<head>
+<meta charset="utf-8">
+<title>Preparando audio</title>
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<meta http-equiv="refresh" content="{{ refresh }}">
+<style>
+  :root { color-scheme: light dark; }
+  body { font-family: system-ui, Arial, sans-serif; max-width: 680px; margin: 2rem auto; padding: 1rem; line-height: 1.5; }
+  progress { width: 100%; height: 1.5rem; }
+</style>
+</head>
+<body>
+<header>
+  <h1>Preparando audio</h1>
+  <p><a href="{{ url_for('upload_get') }}">Volver</a></p>
+</header>
+<main role="main">
+  <p role="status">{{ message }}</p>
+  <progress max="100" value="{{ progress }}">{{ progress }}%</progress>
+  <p>Esta página se actualiza sola cada {{ refresh }} segundos.</p>
 </main>
 </body>
 </html>'''
 
+
 EDITOR_HTML = r'''<!doctype html>
 <html lang="es">
 <head>
@@ -270,6 +519,7 @@ EDITOR_HTML = r'''<!doctype html>
   .muted { opacity: .8; }
   .status { margin-top: .5rem; }
   .sr-only { position: absolute; left: -10000px; top: auto; width: 1px; height: 1px; overflow: hidden; }
+  #wave { display: block; width: 100%; height: 96px; cursor: pointer; }
 </style>
 </head>
 <body>
@@ -285,6 +535,14 @@ EDITOR_HTML = r'''<!doctype html>
     <audio id="player" controls preload="metadata" src="{{ audio_url }}">Tu navegador no soporta audio.</audio>
   </div>
 
+  <div class="block" id="waveBox">
+    <canvas id="wave" role="img" aria-label="Forma de onda del audio con la selección marcada. Haz clic para mover la posición del reproductor."></canvas>
+    <div class="row">
+      <button type="button" id="zoomSel">Ampliar a la selección</button>
+      <button type="button" id="zoomAll">Ver todo el audio</button>
+    </div>
+  </div>
+
   <section class="block" aria-labelledby="navh">
     <h2 id="navh" class="sr-only">Navegación temporal</h2>
     <div class="row">
@@ -318,6 +576,7 @@ EDITOR_HTML = r'''<!doctype html>
       <label><input type="checkbox" id="lock30"> Bloquear a 30 s desde el inicio</label>
       <label><input type="checkbox" id="precise" checked> Corte preciso (recomendado para tonos)</label>
       <label><input type="checkbox" id="fades" checked> Micro-fundidos 5 ms</label>
+      <label><input type="checkbox" id="snap"> Ajustar marcas al silencio más cercano</label>
     </div>
     <div id="live" class="status" aria-live="polite"></div>
   </section>
@@ -331,12 +590,30 @@ EDITOR_HTML = r'''<!doctype html>
     <input type="hidden" id="ringtone_h" name="ringtone_mode" value="false">
     <input type="hidden" id="precise_h" name="precise" value="true">
     <input type="hidden" id="fades_h" name="fades" value="true">
+    <input type="hidden" id="snap_h" name="snap" value="false">
     <div class="row">
       <button type="button" id="previewClip">Previsualizar recorte</button>
       <button type="submit">Recortar y descargar</button>
     </div>
   </form>
 
+  <!-- Varios recortes en un ZIP -->
+  <section class="block" aria-labelledby="batchh">
+    <h2 id="batchh">Varios recortes</h2>
+    <div class="hint">Añade selecciones a la lista y descárgalas todas juntas. Los recortes de la lista siempre son precisos.</div>
+    <div class="row">
+      <button type="button" id="addClip">Añadir selección a la lista</button>
+    </div>
+    <ol id="clipList"></ol>
+    <form id="batchForm" action="{{ batch_url }}" method="post">
+      <input type="hidden" name="id" value="{{ sid }}">
+      <input type="hidden" name="sig" value="{{ sig }}">
+      <input type="hidden" id="segments_h" name="segments">
+      <input type="hidden" id="batch_snap_h" name="snap" value="false">
+      <button type="submit" id="batchSubmit" disabled>Descargar la lista en ZIP</button>
+    </form>
+  </section>
+
   <!-- Cancelar como POST -->
   <form class="block" action="{{ cancel_url }}" method="post">
     <input type="hidden" name="id" value="{{ sid }}">
@@ -358,8 +635,67 @@ EDITOR_HTML = r'''<!doctype html>
   const ringtoneH = document.getElementById('ringtone_h');
   const preciseH = document.getElementById('precise_h');
   const fadesH = document.getElementById('fades_h');
+  const snap = document.getElementById('snap');
+  const snapH = document.getElementById('snap_h');
   const previewBtn = document.getElementById('previewClip');
   const clearBtn = document.getElementById('clearSel');
+  const clipList = document.getElementById('clipList');
+  const batchSubmit = document.getElementById('batchSubmit');
+  const wave = document.getElementById('wave');
+  const waveBox = document.getElementById('waveBox');
+
+  // Forma de onda: el servidor devuelve pares min/max ya reducidos al ancho pedido
+  let peaks = null;
+  let view = { from: 0, to: null };
+  async function loadPeaks() {
+    const width = Math.max(1, Math.round(wave.clientWidth * (window.devicePixelRatio || 1)));
+    const q = new URLSearchParams({ width: width, start: view.from.toFixed(3) });
+    if (view.to != null) q.set('end', view.to.toFixed(3));
+    try {
+      const r = await fetch(`{{ peaks_url }}&${q}`);
+      if (!r.ok) throw new Error(r.status);
+      peaks = {
+        data: new Int8Array(await r.arrayBuffer()),
+        span: parseFloat(r.headers.get('X-Peaks-Seconds-Per-Bucket')),
+        first: parseFloat(r.headers.get('X-Peaks-Start')),
+      };
+      drawWave();
+    } catch (e) {
+      peaks = null;
+      waveBox.hidden = true;   // sin forma de onda el editor funciona igual
+    }
+  }
+  function waveRange() {
+    const n = peaks.data.length / 2;
+    return [view.from, view.to != null ? view.to : peaks.first + n * peaks.span];
+  }
+  function drawWave() {
+    if (!peaks) return;
+    const dpr = window.devicePixelRatio || 1;
+    const W = Math.round(wave.clientWidth * dpr), H = Math.round(wave.clientHeight * dpr);
+    if (wave.width !== W) wave.width = W;
+    if (wave.height !== H) wave.height = H;
+    const ctx = wave.getContext('2d');
+    const [from, to] = waveRange();
+    if (!(to > from)) return;
+    const x = t => (t - from) / (to - from) * W;
+    ctx.clearRect(0, 0, W, H);
+    const st = parseTime(startI.value), en = parseTime(endI.value);
+    if (isFinite(st) && isFinite(en) && en > st) {
+      ctx.fillStyle = 'rgba(80, 140, 255, .3)';
+      ctx.fillRect(x(st), 0, x(en) - x(st), H);
+    }
+    ctx.fillStyle = getComputedStyle(wave).color;
+    for (let i = 0; i < peaks.data.length / 2; i++) {
+      const x0 = x(peaks.first + i * peaks.span);
+      const x1 = x(peaks.first + (i + 1) * peaks.span);
+      const top = H / 2 - peaks.data[2*i+1] / 128 * H / 2;
+      const bottom = H / 2 - peaks.data[2*i] / 128 * H / 2;
+      ctx.fillRect(x0, top, Math.max(1, x1 - x0), Math.max(1, bottom - top));
+    }
+    ctx.fillStyle = '#d22';
+    ctx.fillRect(x(player.currentTime || 0), 0, Math.max(1, dpr), H);
+  }
 
   function fmt(t) {
     if (!isFinite(t) || t < 0) t = 0;
@@ -396,6 +732,8 @@ EDITOR_HTML = r'''<!doctype html>
     ringtoneH.value = lock30.checked ? "true" : "false";
     preciseH.value = precise.checked ? "true" : "false";
     fadesH.value = fades.checked ? "true" : "false";
+    snapH.value = snap.checked ? "true" : "false";
+    drawWave();
   }
   function clamp(v, min, max){ return Math.max(min, Math.min(max, v)); }
 
@@ -446,20 +784,33 @@ EDITOR_HTML = r'''<!doctype html>
     });
   });
 
-  document.getElementById('markStart').addEventListener('click', ()=>{
-    const pos = player.currentTime || 0;
+  // Con "ajustar" activo, el servidor mueve la marca al punto tranquilo más cercano
+  async function snapped(pos, kind) {
+    if (!snap.checked) return { t: pos, snapped: false };
+    try {
+      const r = await fetch(`{{ boundaries_url }}&t=${pos.toFixed(3)}&kind=${kind}`);
+      if (r.ok) return await r.json();
+    } catch (e) {}
+    return { t: pos, snapped: false };
+  }
+
+  document.getElementById('markStart').addEventListener('click', async ()=>{
+    const s = await snapped(player.currentTime || 0, 'start');
+    const pos = s.t;
     startI.value = fmt(pos);
     if (lock30.checked) {
       const d = isFinite(player.duration) ? player.duration : null;
       if (d != null) endI.value = fmt(Math.min(pos + 30.0, d));
     }
     announce();
+    if (s.snapped) live.textContent += ' Inicio ajustado al silencio.';
     onChangeLimitsLive();
   });
-  document.getElementById('markEnd').addEventListener('click', ()=>{
-    const pos = player.currentTime || 0;
-    endI.value = fmt(pos);
+  document.getElementById('markEnd').addEventListener('click', async ()=>{
+    const s = await snapped(player.currentTime || 0, 'end');
+    endI.value = fmt(s.t);
     announce();
+    if (s.snapped) live.textContent += ' Fin ajustado al silencio.';
     onChangeLimitsLive();
   });
 
@@ -477,6 +828,49 @@ EDITOR_HTML = r'''<!doctype html>
     live.textContent = 'Selección anulada. Usando todo el audio.';
   });
 
+  // Lista de recortes para /trim/batch
+  const clips = [];
+  function renderClips() {
+    clipList.textContent = '';
+    clips.forEach((c, i)=>{
+      const li = document.createElement('li');
+      const dur = fmt(parseTime(c.end) - parseTime(c.start));
+      li.textContent = `${c.start} a ${c.end} (${dur})${c.ringtone ? ', tono' : ''}${c.fades ? '' : ', sin fundidos'} `;
+      const del = document.createElement('button');
+      del.type = 'button';
+      del.textContent = 'Quitar';
+      del.setAttribute('aria-label', `Quitar el recorte ${i + 1}`);
+      del.addEventListener('click', ()=>{
+        clips.splice(i, 1);
+        renderClips();
+        live.textContent = `Recorte ${i + 1} quitado. Quedan ${clips.length}.`;
+        batchSubmit.focus();
+      });
+      li.appendChild(del);
+      clipList.appendChild(li);
+    });
+    batchSubmit.disabled = clips.length === 0;
+  }
+  document.getElementById('addClip').addEventListener('click', ()=>{
+    const st = parseTime(startI.value), en = parseTime(endI.value);
+    if (!(isFinite(st) && isFinite(en) && en > st)) {
+      live.textContent = 'Selecciona inicio y fin válidos para añadir a la lista.';
+      return;
+    }
+    if (clips.length >= {{ batch_max }}) {
+      live.textContent = 'La lista está llena.';
+      return;
+    }
+    clips.push({ start: startI.value, end: endI.value, fades: fades.checked, ringtone: lock30.checked });
+    renderClips();
+    live.textContent = `Recorte ${clips.length} añadido a la lista: ${startI.value} a ${endI.value}.`;
+  });
+  document.getElementById('batchForm').addEventListener('submit', ()=>{
+    document.getElementById('segments_h').value = JSON.stringify(clips);
+    document.getElementById('batch_snap_h').value = snap.checked ? "true" : "false";
+  });
+
+  snap.addEventListener('change', announce);
   lock30.addEventListener('change', ()=>{
     const ro = lock30.checked;
     endI.readOnly = ro;
@@ -515,7 +909,16 @@ EDITOR_HTML = r'''<!doctype html>
     }
   });
 
-  // Botón de previsualización
+  // Botón de previsualización: el servidor prepara el tramo exacto con los mismos
+  // fundidos que el recorte final. Si falla, se escucha en el reproductor principal.
+  const clipPlayer = new Audio();
+  clipPlayer.addEventListener('ended', ()=>{ live.textContent = 'Previsualización finalizada.'; });
+  player.addEventListener('play', ()=>{ clipPlayer.pause(); });
+  function previewInPlayer(st) {
+    player.currentTime = st;
+    nextPlayIsPreview = true; // marca que el próximo play es de previsualización
+    const p = player.play(); if (p && p.catch) p.catch(()=>{});
+  }
   previewBtn.addEventListener('click', ()=>{
     const st = parseTime(startI.value);
     const en = parseTime(endI.value);
@@ -523,111 +926,521 @@ EDITOR_HTML = r'''<!doctype html>
       live.textContent = 'Selecciona inicio y fin válidos para previsualizar.';
       return;
     }
-    player.currentTime = st;
-    nextPlayIsPreview = true; // marca que el próximo play es de previsualización
-    const p = player.play(); if (p && p.catch) p.catch(()=>{});
+    player.pause();
+    const withFades = (precise.checked || lock30.checked) && fades.checked;
+    const q = new URLSearchParams({ start: startI.value, end: endI.value, fades: withFades ? 'true' : 'false' });
+    clipPlayer.onerror = ()=>{ clipPlayer.onerror = null; previewInPlayer(st); };
+    clipPlayer.src = `{{ preview_url }}&${q}`;
+    const p = clipPlayer.play();
+    if (p && p.catch) p.catch((e)=>{ if (e.name === 'NotSupportedError') previewInPlayer(st); });
     live.textContent = `Reproduciendo recorte ${startI.value} â†’ ${endI.value}.`;
   });
 
+  wave.addEventListener('click', (ev)=>{
+    if (!peaks) return;
+    const [from, to] = waveRange();
+    const rect = wave.getBoundingClientRect();
+    const d = isFinite(player.duration) ? player.duration : to;
+    player.currentTime = clamp(from + (ev.clientX - rect.left) / rect.width * (to - from), 0, d);
+    announce();
+    onChangeLimitsLive();
+  });
+  player.addEventListener('timeupdate', drawWave);
+  player.addEventListener('seeked', drawWave);
+  document.getElementById('zoomSel').addEventListener('click', ()=>{
+    const st = parseTime(startI.value), en = parseTime(endI.value);
+    if (!(isFinite(st) && isFinite(en) && en > st)) {
+      live.textContent = 'Selecciona inicio y fin válidos para ampliar.';
+      return;
+    }
+    const pad = (en - st) * 0.1;
+    view = { from: Math.max(0, st - pad), to: en + pad };
+    loadPeaks();
+    live.textContent = `Forma de onda ampliada a ${fmt(view.from)} a ${fmt(view.to)}.`;
+  });
+  document.getElementById('zoomAll').addEventListener('click', ()=>{
+    view = { from: 0, to: null };
+    loadPeaks();
+    live.textContent = 'Forma de onda de todo el audio.';
+  });
+  let resizeTimer = null;
+  window.addEventListener('resize', ()=>{
+    clearTimeout(resizeTimer);
+    resizeTimer = setTimeout(loadPeaks, 200);
+  });
+
   window.addEventListener('load', ()=>{
     endI.readOnly = false;
     announce();
+    loadPeaks();
   });
 </script>
 </body>
 </html>'''
 
 # ---------- Sistema de progreso ----------
-def update_progress(sid: str, progress: int, message: str, status: str = "processing"):
-    """Actualiza el progreso de una sesión"""
-    with progress_lock:
-        if sid not in progress_store:
-            progress_store[sid] = {}
-        progress_store[sid].update({
-            "progress": progress,
-            "message": message,
-            "status": status,
-            "timestamp": time.time()
-        })
+def _progress_targets(sid: str):
+    """La sesión y las que esperan al mismo trabajo (ver single-flight)"""
+    with inflight_lock:
+        job = inflight_by_leader.get(sid)
+        return [sid] + list(job["followers"]) if job else [sid]
 
-def set_progress_error(sid: str, error: str):
-    """Marca una sesión con error"""
-    with progress_lock:
-        if sid not in progress_store:
-            progress_store[sid] = {}
-        progress_store[sid].update({
-            "status": "error",
-            "error": error,
-            "timestamp": time.time()
-        })
+class ProgressBackend:
+    """Avisos por sesión comunes a los backends: cada cambio despierta solo a los
+    hilos que esperan esa sesión y a los listeners (el despachador SSE)."""
+    cross_process = False  # True: hay cambios de otros procesos que solo se ven consultando
 
-def set_progress_complete(sid: str, message: str = "Completado"):
-    """Marca una sesión como completada"""
-    with progress_lock:
-        if sid not in progress_store:
-            progress_store[sid] = {}
-        progress_store[sid].update({
-            "progress": 100,
-            "message": message,
-            "status": "complete",
-            "timestamp": time.time()
-        })
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waiters = {}    # {sid: Condition sobre self.lock}, solo mientras alguien espera
+        self.listeners = []  # f(sids) tras cada cambio hecho en este proceso
 
-def get_progress(sid: str):
-    """Obtiene el progreso actual de una sesión"""
-    with progress_lock:
-        return progress_store.get(sid, {}).copy()
+    def _notify(self, sids: list):
+        with self.lock:
+            for sid in sids:
+                cond = self.waiters.get(sid)
+                if cond is not None:
+                    cond.changes += 1
+                    cond.notify_all()
+        for fn in self.listeners:
+            fn(sids)
 
-def cleanup_progress(sid: str):
-    """Limpia el progreso de una sesión"""
-    with progress_lock:
-        progress_store.pop(sid, None)
+    def _waiter(self, sid: str):
+        """Condition de sid (con self.lock tomado); se suelta con _unwait"""
+        cond = self.waiters.get(sid)
+        if cond is None:
+            cond = self.waiters[sid] = threading.Condition(self.lock)
+            cond.users, cond.changes = 0, 0
+        cond.users += 1
+        return cond
+
+    def _unwait(self, sid: str, cond):
+        cond.users -= 1
+        if not cond.users:
+            self.waiters.pop(sid, None)
+
+    def get_many(self, sids) -> dict:
+        return {sid: self.get(sid) for sid in sids}
+
+class MemoryProgressBackend(ProgressBackend):
+    """Progreso en un dict del proceso (por defecto; válido con un solo worker)"""
+    def __init__(self):
+        super().__init__()
+        self.store = {}  # {session_id: {"progress": 0-100, "message": str, "status": str, "error": str, "version": int}}
+        self.seq = 0  # versión global; se usa como id de evento SSE
+
+    def apply(self, targets: list, fields: dict):
+        changed = []
+        with self.lock:
+            for t in targets:
+                entry = self.store.setdefault(t, {})
+                if all(entry.get(k) == v for k, v in fields.items()):
+                    continue
+                self.seq += 1
+                entry.update(fields, timestamp=time.time(), version=self.seq)
+                changed.append(t)
+        if changed:
+            self._notify(changed)
+
+    def get(self, sid: str) -> dict:
+        with self.lock:
+            return self.store.get(sid, {}).copy()
+
+    def wait(self, sid: str, after_version: int, timeout: float):
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            cond = self._waiter(sid)
+            try:
+                while True:
+                    entry = self.store.get(sid)
+                    if entry and entry.get("version", 0) > after_version:
+                        return entry.copy()
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return None
+                    cond.wait(remaining)
+            finally:
+                self._unwait(sid, cond)
+
+    def delete(self, sid: str):
+        with self.lock:
+            self.store.pop(sid, None)
+
+class SQLiteProgressBackend(ProgressBackend):
+    """Progreso compartido entre workers de gunicorn en una base SQLite en modo WAL.
+    Las escrituras que no cambian nada se descartan sin transacción de escritura
+    (basta leer la versión de la fila); los suscriptores del mismo proceso se
+    despiertan al instante y los de otros procesos consultan cada PROGRESS_POLL segundos."""
+    cross_process = True
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self.local = threading.local()
+        self.last = {}  # {sid: (versión, estado, instante)} de lo último que escribió o vio este proceso
+        self._last_prune = 0.0
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS progress (sid TEXT PRIMARY KEY, version INTEGER NOT NULL, data TEXT NOT NULL, updated REAL NOT NULL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS seq (id INTEGER PRIMARY KEY CHECK (id = 0), value INTEGER NOT NULL)")
+        conn.execute("INSERT OR IGNORE INTO seq (id, value) VALUES (0, 0)")
+
+    def _conn(self):
+        # Una conexión por hilo y por proceso (no se heredan a través de fork)
+        conn = getattr(self.local, "conn", None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn, self.local.pid = conn, os.getpid()
+        return conn
+
+    def apply(self, targets: list, fields: dict):
+        with self.lock:
+            known = {t: self.last[t][0] for t in targets
+                     if t in self.last and all(self.last[t][1].get(k) == v for k, v in fields.items())}
+        conn = self._conn()
+        if known:
+            # Lo recordado solo vale si ningún otro worker ha cambiado la fila después
+            marks = ",".join("?" * len(known))
+            current = dict(conn.execute(f"SELECT sid, version FROM progress WHERE sid IN ({marks})",
+                                        list(known)).fetchall())
+            pending = [t for t in targets if t not in known or current.get(t) != known[t]]
+        else:
+            pending = list(targets)
+        if not pending:
+            return
+        now = time.time()
+        seen, changed, pruned = {}, [], False
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for t in pending:
+                row = conn.execute("SELECT version, data FROM progress WHERE sid = ?", (t,)).fetchone()
+                entry = json.loads(row[1]) if row else {}
+                if all(entry.get(k) == v for k, v in fields.items()):
+                    seen[t] = (row[0], entry)
+                    continue
+                conn.execute("UPDATE seq SET value = value + 1 WHERE id = 0")
+                version = conn.execute("SELECT value FROM seq WHERE id = 0").fetchone()[0]
+                entry.update(fields, timestamp=now, version=version)
+                conn.execute("INSERT OR REPLACE INTO progress (sid, version, data, updated) VALUES (?, ?, ?, ?)",
+                             (t, version, json.dumps(entry), now))
+                seen[t] = (version, entry)
+                changed.append(t)
+            if now - self._last_prune > 60:
+                self._last_prune, pruned = now, True
+                conn.execute("DELETE FROM progress WHERE updated < ?", (now - SESSION_TTL,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        with self.lock:
+            for t, (version, entry) in seen.items():
+                self.last[t] = (version, entry, now)
+            if pruned:
+                # Los delete() suelen llegar a otro worker (el del SSE): aquí se olvida por edad
+                for t in [t for t, v in self.last.items() if now - v[2] > SESSION_TTL]:
+                    del self.last[t]
+        if changed:
+            self._notify(changed)
+
+    def get(self, sid: str) -> dict:
+        row = self._conn().execute("SELECT data FROM progress WHERE sid = ?", (sid,)).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def get_many(self, sids) -> dict:
+        sids = list(sids)
+        found = {}
+        for i in range(0, len(sids), 500):  # límite de parámetros de SQLite
+            part = sids[i:i + 500]
+            rows = self._conn().execute(f"SELECT sid, data FROM progress WHERE sid IN ({','.join('?' * len(part))})",
+                                        part).fetchall()
+            found.update((sid, json.loads(data)) for sid, data in rows)
+        return {sid: found.get(sid, {}) for sid in sids}
+
+    def wait(self, sid: str, after_version: int, timeout: float):
+        deadline = time.monotonic() + timeout
+        conn = self._conn()
+        with self.lock:
+            cond = self._waiter(sid)
+        try:
+            while True:
+                with self.lock:
+                    seen = cond.changes
+                row = conn.execute("SELECT version, data FROM progress WHERE sid = ?", (sid,)).fetchone()
+                if row and row[0] > after_version:
+                    return json.loads(row[1])
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                with self.lock:
+                    if cond.changes == seen:  # un cambio entre la consulta y aquí no se pierde
+                        cond.wait(min(PROGRESS_POLL, remaining))
+        finally:
+            with self.lock:
+                self._unwait(sid, cond)
+
+    def delete(self, sid: str):
+        self._conn().execute("DELETE FROM progress WHERE sid = ?", (sid,))
+        with self.lock:
+            self.last.pop(sid, None)
+
+def make_progress_backend():
+    if PROGRESS_BACKEND == "sqlite":
+        return SQLiteProgressBackend(PROGRESS_DB)
+    return MemoryProgressBackend()
+
+progress_backend = make_progress_backend()
+
+def _apply_progress(sid: str, fields: dict):
+    """Aplica fields a la sesión y a sus seguidores; despierta a los suscriptores SSE
+    solo si algo cambió. Cada cambio recibe un número de versión creciente."""
+    progress_backend.apply(_progress_targets(sid), fields)
 
-# ---------- Sistema de progreso ----------
 def update_progress(sid: str, progress: int, message: str, status: str = "processing"):
     """Actualiza el progreso de una sesión"""
-    with progress_lock:
-        if sid not in progress_store:
-            progress_store[sid] = {}
-        progress_store[sid].update({
-            "progress": progress,
-            "message": message,
-            "status": status,
-            "timestamp": time.time()
-        })
+    _apply_progress(sid, {"progress": progress, "message": message, "status": status})
 
 def set_progress_error(sid: str, error: str):
     """Marca una sesión con error"""
-    with progress_lock:
-        if sid not in progress_store:
-            progress_store[sid] = {}
-        progress_store[sid].update({
-            "status": "error",
-            "error": error,
-            "timestamp": time.time()
-        })
+    trace = _current_trace.get()
+    if trace is not None and trace.sid == sid:
+        trace.error = error
+    _apply_progress(sid, {"status": "error", "error": error})
 
 def set_progress_complete(sid: str, message: str = "Completado"):
     """Marca una sesión como completada"""
-    with progress_lock:
-        if sid not in progress_store:
-            progress_store[sid] = {}
-        progress_store[sid].update({
-            "progress": 100,
-            "message": message,
-            "status": "complete",
-            "timestamp": time.time()
-        })
+    _apply_progress(sid, {"progress": 100, "message": message, "status": "complete"})
+
+def job_error_message(e: Exception) -> str:
+    """Texto de error para el usuario; los abort() de los helpers traen su descripción"""
+    if isinstance(e, HTTPException) and e.description:
+        return str(e.description)[:300]
+    return str(e)[:300]
 
 def get_progress(sid: str):
     """Obtiene el progreso actual de una sesión"""
-    with progress_lock:
-        return progress_store.get(sid, {}).copy()
+    return progress_backend.get(sid)
+
+def wait_progress(sid: str, after_version: int, timeout: float):
+    """Bloquea hasta que la sesión tenga una versión posterior a after_version.
+    Devuelve una copia del estado o None si vence el timeout."""
+    return progress_backend.wait(sid, after_version, timeout)
 
 def cleanup_progress(sid: str):
     """Limpia el progreso de una sesión"""
-    with progress_lock:
-        progress_store.pop(sid, None)
+    progress_backend.delete(sid)
+
+# ---------- /progress sin un hilo por conexión ----------
+# Con gunicorn la vista no se queda esperando: duplica el socket del cliente, deja
+# en su lugar uno de pega donde gunicorn escribe y cierra su respuesta vacía, y pasa
+# la conexión a un único hilo por worker que, con selectors, escribe los eventos de
+# todas las conexiones abiertas. Así los hilos de gthread quedan para descargas,
+# subidas y el resto de peticiones. Con otro servidor (o SSE_DISPATCH=0) se usa el
+# generador de siempre, que ocupa un hilo mientras la conexión sigue abierta.
+SSE_DISPATCH = os.environ.get("SSE_DISPATCH", "1") != "0"
+SSE_MAX_BUFFER = 64 * 1024  # bytes pendientes para un cliente que no lee antes de cortarlo
+
+def sse_progress_events(sid: str, data: dict, editor_url: str):
+    """(texto SSE de un estado de progreso, si con él termina el stream)"""
+    version = data.get("version", 0)
+    out = f"id: {version}\nevent: progress\ndata: {json.dumps(data)}\n\n"
+    status = data.get("status", "processing")
+    # Si completó, evento final con URL del editor
+    if status == "complete":
+        if os.path.exists(os.path.join(sess_dir(sid), "meta.json")):
+            out += f"id: {version}\nevent: complete\ndata: {json.dumps({'editor_url': editor_url})}\n\n"
+        cleanup_progress(sid)
+        return out, True
+    if status == "error":
+        error_msg = data.get("error", "Error desconocido")
+        out += f"id: {version}\nevent: error_event\ndata: {json.dumps({'error': error_msg})}\n\n"
+        cleanup_progress(sid)
+        return out, True
+    return out, False
+
+class SSEStream:
+    def __init__(self, sock, sid: str, last_id: int, editor_url: str, head: bytes):
+        self.sock, self.sid, self.last_id, self.editor_url = sock, sid, last_id, editor_url
+        self.out = bytearray(head)  # pendiente de enviar
+        self.last_change = self.last_write = time.monotonic()
+        self.done = False           # se cierra en cuanto out quede vacío
+        self.mask = 0
+
+class SSEDispatcher:
+    def __init__(self, backend: ProgressBackend):
+        self.backend = backend
+        self.lock = threading.Lock()
+        self.pid = None
+        self.new = []       # conexiones que el hilo aún no ha recogido
+        self.dirty = set()  # sesiones con cambios desde la última vuelta
+        backend.listeners.append(self.changed)
+
+    def ensure_running(self):
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.new, self.dirty = [], set()  # tras el fork, lo del padre no es de este worker
+            self.wake_r, self.wake_w = socket.socketpair()
+            self.wake_r.setblocking(False)
+            self.wake_w.setblocking(False)
+            self.pid = os.getpid()
+            threading.Thread(target=self._run, daemon=True, name="sse-dispatch").start()
+
+    def _wake(self):
+        try:
+            self.wake_w.send(b"\0")
+        except OSError:
+            pass  # lleno: ya hay un aviso pendiente
+
+    def changed(self, sids):
+        if self.pid != os.getpid():
+            return
+        with self.lock:
+            self.dirty.update(sids)
+        self._wake()
+
+    def hijack(self, environ: dict, sid: str, last_id: int, editor_url: str):
+        """Se queda con la conexión de la petición en curso. Devuelve la respuesta
+        (vacía) que debe dar la vista, o None si el servidor no lo permite."""
+        sock = environ.get("gunicorn.socket")
+        if sock is None or isinstance(sock, ssl.SSLSocket):
+            return None
+        self.ensure_running()
+        try:
+            conn = socket.socket(fileno=os.dup(sock.fileno()))
+        except OSError:
+            return None
+        try:
+            decoy, peer = socket.socketpair()
+            os.dup2(decoy.fileno(), sock.fileno())
+            decoy.close()
+        except OSError:
+            conn.close()
+            return None
+        conn.setblocking(False)
+        head = (f"{environ.get('SERVER_PROTOCOL', 'HTTP/1.1')} 200 OK\r\n"
+                "Content-Type: text/event-stream; charset=utf-8\r\n"
+                "Cache-Control: no-cache\r\nX-Accel-Buffering: no\r\nConnection: close\r\n\r\n"
+                "retry: 2000\n\n")
+        with self.lock:
+            self.new.append(SSEStream(conn, sid, last_id, editor_url, head.encode("latin-1")))
+            self.dirty.add(sid)
+        self._wake()
+        resp = Response(b"")
+        resp.call_on_close(peer.close)  # EOF para gunicorn cuando ya ha escrito
+        return resp
+
+    def _run(self):
+        self.sel = selectors.DefaultSelector()
+        self.sel.register(self.wake_r, selectors.EVENT_READ)
+        self.streams = set()
+        self.next_poll = 0.0
+        while True:
+            try:
+                self._step()
+            except Exception as e:
+                print("SSE:", e, flush=True)
+                time.sleep(1)
+
+    def _timeout(self, now: float) -> float:
+        timeout = SSE_HEARTBEAT
+        for st in self.streams:
+            timeout = min(timeout, st.last_write + SSE_HEARTBEAT - now, st.last_change + SSE_IDLE_TIMEOUT - now)
+        if self.backend.cross_process and self.streams:
+            timeout = min(timeout, self.next_poll - now)
+        return max(timeout, 0)
+
+    def _step(self):
+        for key, mask in self.sel.select(self._timeout(time.monotonic())):
+            st = key.data
+            if st is None:
+                try:
+                    while self.wake_r.recv(4096):
+                        pass
+                except OSError:
+                    pass
+                continue
+            if mask & selectors.EVENT_READ:
+                try:
+                    if not st.sock.recv(4096):  # el cliente cerró la conexión
+                        st.done = True
+                        st.out.clear()
+                except BlockingIOError:
+                    pass
+                except OSError:
+                    st.done = True
+                    st.out.clear()
+
+        with self.lock:
+            new, self.new = self.new, []
+            dirty, self.dirty = self.dirty, set()
+        for st in new:
+            self.streams.add(st)
+            metrics.inc("ytmp3_sse_connections", 1)
+
+        now = time.monotonic()
+        if self.backend.cross_process and now >= self.next_poll:
+            # Los cambios de otros workers no avisan: se consulta cada PROGRESS_POLL
+            self.next_poll = now + PROGRESS_POLL
+            check = [st for st in self.streams if not st.done]
+        else:
+            check = [st for st in self.streams if st.sid in dirty and not st.done]
+        states = self.backend.get_many({st.sid for st in check}) if check else {}
+        for st in check:
+            data = states.get(st.sid)
+            if data and data.get("version", 0) > st.last_id:
+                text, st.done = sse_progress_events(st.sid, data, st.editor_url)
+                st.last_id = data.get("version", st.last_id)
+                st.last_change = now
+                st.out += text.encode()
+
+        for st in list(self.streams):
+            if not st.done and now - st.last_change > SSE_IDLE_TIMEOUT:
+                st.out += f"event: error_event\ndata: {json.dumps({'error': 'Timeout'})}\n\n".encode()
+                st.done = True
+            elif not st.done and not st.out and now - st.last_write >= SSE_HEARTBEAT:
+                st.out += b": keepalive\n\n"
+            if st.out:
+                self._flush(st)
+            if len(st.out) > SSE_MAX_BUFFER:
+                st.done = True
+                st.out.clear()
+            if st.done and not st.out:
+                self._close(st)
+                continue
+            mask = selectors.EVENT_READ | (selectors.EVENT_WRITE if st.out else 0)
+            if mask != st.mask:
+                if st.mask:
+                    self.sel.modify(st.sock, mask, st)
+                else:
+                    self.sel.register(st.sock, mask, st)
+                st.mask = mask
+
+    def _flush(self, st: SSEStream):
+        try:
+            sent = st.sock.send(st.out)
+        except BlockingIOError:
+            return
+        except OSError:
+            st.done = True
+            st.out.clear()
+            return
+        del st.out[:sent]
+        st.last_write = time.monotonic()
+
+    def _close(self, st: SSEStream):
+        if st.mask:
+            self.sel.unregister(st.sock)
+        try:
+            st.sock.close()
+        except OSError:
+            pass
+        self.streams.discard(st)
+        metrics.inc("ytmp3_sse_connections", -1)
+
+sse_dispatcher = SSEDispatcher(progress_backend)
 
 # ---------- util firmas/sesiones ----------
 def sign_token(id_str: str, scope: str) -> str:
@@ -643,212 +1456,2995 @@ def verify_token(id_str: str, scope: str, token: str) -> bool:
 def sess_dir(sid: str) -> str:
     return os.path.join(TMP_BASE, sid)
 
-_last_cleanup = 0
-CLEANUP_INTERVAL = 300  # 5 min
+cancelled_sessions = {}  # {sid: instante de la cancelación}
+cancel_lock = threading.Lock()
 
-def cleanup_expired():
-    """Cleanup expired sessions. Only runs every CLEANUP_INTERVAL seconds."""
-    global _last_cleanup
+def request_cancel(sid: str):
     now = time.time()
-    
-    # Skip if cleaned up recently
-    if now - _last_cleanup < CLEANUP_INTERVAL:
-        return
-    
-    _last_cleanup = now
+    with cancel_lock:
+        cancelled_sessions[sid] = now
+        for k, t in list(cancelled_sessions.items()):
+            if now - t > SESSION_TTL: del cancelled_sessions[k]
+
+def cancel_requested(sid: str) -> bool:
+    """Cancelada en este worker o con el directorio borrado (p. ej. /cancel en otro worker)"""
+    with cancel_lock:
+        if sid in cancelled_sessions:
+            return True
+    return not os.path.isdir(sess_dir(sid))
+
+def pid_alive(pid: int) -> bool:
     try:
-        for name in os.listdir(TMP_BASE):
-            p = os.path.join(TMP_BASE, name)
-            if not os.path.isdir(p): continue
-            try:
-                mtime = os.path.getmtime(p)
-                if now - mtime > SESSION_TTL:
-                    shutil.rmtree(p, ignore_errors=True)
-            except Exception:
-                pass
-    except FileNotFoundError:
-        pass
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True  # existe, aunque sea de otro usuario
+    return True
 
-# ---------- validación y helpers ----------
-YTLINK = re.compile(r'^https?://([a-z0-9-]+\.)*(youtube\.com|youtu\.be)/', re.I)
+# ---------- métricas ----------
+# Registro propio con el formato de texto de Prometheus (sin dependencias). Cada
+# worker vuelca sus valores a METRICS_DIR/<pid>-<id>.json cada METRICS_FLUSH segundos
+# (el id distingue a un worker nuevo que herede el pid de otro) y /metrics suma los
+# ficheros de todos. Los contadores e histogramas de un worker terminado se pasan a
+# retired.json, que solo crece, así que las sumas nunca bajan; los indicadores de
+# estado actual (gauges) solo cuentan los workers vivos.
+METRICS_DIR = os.environ.get("METRICS_DIR", os.path.join(tempfile.gettempdir(), "ytmp3_metrics"))
+METRICS_FLUSH = 5               # s entre volcados de cada worker
+METRICS_STALE = 120             # s sin volcar tras los que un worker se da por terminado
+METRICS_RETAIN = 24 * 3600      # s que se recuerda qué volcados ya se pasaron a retired.json
+METRICS_RETIRED = "retired.json"
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN", "")
+STAGE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
 
-UA_ANDROID = "com.google.android.youtube/19.29.37 (Linux; U; Android 14; en_US)"
-CLIENTS = [
-    ("android", UA_ANDROID),
-    ("android_music", "com.google.android.apps.youtube.music/7.02.52 (Linux; U; Android 14; en_US)"),
-    ("ios", "com.google.ios.youtube/19.29.1 (iPhone16,2; U; CPU iOS 17_5_1 like Mac OS X;)"),
-    ("mweb", "Mozilla/5.0 (Linux; Android 14) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Mobile Safari/537.36"),
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.defs = {}    # {nombre: (tipo, ayuda, límites)}
+        self.values = {}  # {nombre: {etiquetas: valor}}; histogramas: [cuentas..., +Inf, suma, n]
+        self.samplers = []  # funciones que actualizan los gauges antes de cada volcado
+        self.pid = None
+        self.uid = None     # nombre del volcado de este proceso
+
+    def define(self, name: str, kind: str, help_text: str, buckets=None):
+        self.defs[name] = (kind, help_text, tuple(buckets or ()))
+        self.values.setdefault(name, {})
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.values[name]
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        with self.lock:
+            self.values[name][tuple(sorted(labels.items()))] = value
+
+    def observe(self, name: str, value: float, **labels):
+        buckets = self.defs[name][2]
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            h = self.values[name].get(key)
+            if h is None:
+                h = self.values[name][key] = [0] * (len(buckets) + 3)
+            for i, le in enumerate(buckets):
+                if value <= le:
+                    h[i] += 1
+                    break
+            else:
+                h[len(buckets)] += 1  # +Inf
+            h[-2] += value
+            h[-1] += 1
+
+    def sampler(self, fn):
+        self.samplers.append(fn)
+        return fn
+
+    def tracked(self, gen, name: str, **labels):
+        """Envuelve un generador de respuesta: el gauge name cuenta los que siguen abiertos"""
+        self.inc(name, 1, **labels)
+        try:
+            yield from gen
+        finally:
+            self.inc(name, -1, **labels)
+
+    def ensure_running(self):
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.uid = f"{self.pid}-{uuid.uuid4().hex[:8]}"
+            for series in self.values.values():
+                series.clear()  # tras el fork, lo del proceso padre no es de este worker
+            threading.Thread(target=self._run, daemon=True, name="metrics-flush").start()
+
+    def _run(self):
+        while True:
+            time.sleep(METRICS_FLUSH)
+            try:
+                self.flush()
+            except Exception as e:
+                print("métricas:", e, flush=True)
+
+    def flush(self):
+        for fn in self.samplers:
+            fn()
+        with self.lock:
+            data = {name: [[dict(key), value] for key, value in series.items()]
+                    for name, series in self.values.items()}
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        path = os.path.join(METRICS_DIR, f"{self.uid}.json")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(path + ".tmp", path)
+
+    @contextmanager
+    def _retired_lock(self):
+        """Que dos workers no pasen a la vez el mismo volcado a retired.json"""
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(METRICS_DIR, "retired.lock"), "a") as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+
+    def _add(self, total: dict, data: dict, gauges: bool = True):
+        for name, series in data.items():
+            if name not in self.defs or (self.defs[name][0] == "gauge" and not gauges):
+                continue
+            for labels, value in series:
+                if isinstance(value, list) and len(value) != len(self.defs[name][2]) + 3:
+                    continue  # histograma con otra disposición (límites cambiados o volcado antiguo)
+                key = tuple(sorted(labels.items()))
+                prev = total.setdefault(name, {}).get(key)
+                if prev is None:
+                    total[name][key] = value
+                elif isinstance(value, list):
+                    total[name][key] = [a + b for a, b in zip(prev, value)]
+                else:
+                    total[name][key] = prev + value
+
+    def collect(self) -> dict:
+        """Suma de los volcados de todos los workers: {nombre: {etiquetas: valor}}"""
+        self.flush()
+        total = {name: {} for name in self.defs}
+        now = time.time()
+        retired_path = os.path.join(METRICS_DIR, METRICS_RETIRED)
+        with self._retired_lock():
+            try:
+                with open(retired_path, "r", encoding="utf-8") as f:
+                    retired = json.load(f)
+            except (OSError, ValueError):
+                retired = {"values": {}, "folded": {}}
+            folded = retired["folded"]  # {volcado: instante en que se pasó}
+            sums = {}
+            for name, series in retired["values"].items():
+                sums[name] = {tuple(sorted(labels.items())): value for labels, value in series}
+            gone = []
+            for fname in os.listdir(METRICS_DIR):
+                if not fname.endswith(".json") or fname == METRICS_RETIRED:
+                    continue
+                path = os.path.join(METRICS_DIR, fname)
+                uid = fname[:-5]
+                if uid in folded:
+                    gone.append(path)  # ya está en retired.json
+                    continue
+                try:
+                    pid = int(uid.split("-")[0])
+                    with open(path, "r", encoding="utf-8") as f:
+                        data = json.load(f)
+                    stale = now - os.path.getmtime(path) > METRICS_STALE
+                except (OSError, ValueError):
+                    continue
+                if pid_alive(pid) and not stale:
+                    self._add(total, data)
+                else:
+                    self._add(sums, data, gauges=False)
+                    folded[uid] = now
+                    gone.append(path)
+            for uid, t in list(folded.items()):
+                if now - t > METRICS_RETAIN:
+                    del folded[uid]
+            if gone:
+                # Primero retired.json y luego los borrados: si algo falla entre medias,
+                # folded evita sumar dos veces el mismo volcado
+                retired["values"] = {name: [[dict(key), value] for key, value in series.items()]
+                                     for name, series in sums.items()}
+                with open(retired_path + ".tmp", "w", encoding="utf-8") as f:
+                    json.dump(retired, f)
+                os.replace(retired_path + ".tmp", retired_path)
+                for path in gone:
+                    try: os.remove(path)
+                    except OSError: pass
+        self._add(total, retired["values"], gauges=False)
+        return total
+
+    @staticmethod
+    def _labels(key, extra=()) -> str:
+        pairs = list(key) + list(extra)
+        if not pairs:
+            return ""
+        esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in pairs) + "}"
+
+    @staticmethod
+    def _num(v) -> str:
+        return str(int(v)) if float(v).is_integer() else repr(float(v))
+
+    def render(self, values: dict) -> str:
+        lines = []
+        for name, (kind, help_text, buckets) in self.defs.items():
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            for key, value in sorted(values.get(name, {}).items()):
+                if kind != "histogram":
+                    lines.append(f"{name}{self._labels(key)} {self._num(value)}")
+                    continue
+                cumulative = 0
+                for le, count in zip(list(buckets) + ["+Inf"], value):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{self._labels(key, [('le', le if isinstance(le, str) else f'{le:g}')])} {cumulative}")
+                lines.append(f"{name}_sum{self._labels(key)} {self._num(value[-2])}")
+                lines.append(f"{name}_count{self._labels(key)} {value[-1]}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.define("ytmp3_stage_seconds", "histogram", "Duración de cada etapa del pipeline", STAGE_BUCKETS)
+metrics.define("ytmp3_client_attempt_seconds", "histogram", "Extracciones de yt-dlp por cliente de YouTube", STAGE_BUCKETS)
+metrics.define("ytmp3_http_request_seconds", "histogram", "Tiempo hasta la respuesta, por endpoint", STAGE_BUCKETS)
+metrics.define("ytmp3_downloaded_bytes_total", "counter", "Bytes descargados de YouTube")
+metrics.define("ytmp3_uploaded_bytes_total", "counter", "Bytes recibidos en subidas")
+metrics.define("ytmp3_served_bytes_total", "counter", "Bytes enviados a los clientes, por endpoint")
+metrics.define("ytmp3_jobs_running", "gauge", "Trabajos de preparación en curso")
+metrics.define("ytmp3_jobs_queued", "gauge", "Trabajos de preparación en cola")
+metrics.define("ytmp3_sse_connections", "gauge", "Conexiones abiertas a /progress")
+metrics.define("ytmp3_sessions", "gauge", "Sesiones en TMP_BASE")
+metrics.define("ytmp3_tmp_disk_bytes", "gauge", "Disco del volumen de TMP_BASE")
+
+# ---------- trazas por trabajo ----------
+# Cada trabajo (preparar un vídeo, convertir una subida, un recorte) anota sus etapas
+# con tiempos y datos útiles: clientes de YouTube probados, velocidad de descarga,
+# factor de tiempo real de ffmpeg, tamaños. La traza se añade a trace.json junto a
+# meta.json (una lista con los trabajos de la sesión) y se guarda en TRACE_DIR, que
+# comparten los workers y consulta /debug/jobs aunque la sesión ya no exista.
+TRACE_FILE = "trace.json"
+TRACE_DIR = os.environ.get("TRACE_DIR", os.path.join(tempfile.gettempdir(), "ytmp3_traces"))
+TRACE_KEEP = int(os.environ.get("TRACE_KEEP", "500"))   # trazas que se conservan en TRACE_DIR
+TRACE_SLOW = float(os.environ.get("TRACE_SLOW", "30"))  # s a partir de los que un trabajo es lento
+DEBUG_TOKEN = os.environ.get("DEBUG_TOKEN", "")         # sin token, /debug/jobs no existe
+
+_current_trace = contextvars.ContextVar("ytmp3_trace", default=None)
+_current_span = contextvars.ContextVar("ytmp3_span", default=None)
+
+class JobTrace:
+    def __init__(self, kind: str, sid: str, **attrs):
+        self.kind, self.sid = kind, sid
+        self.started = time.time()
+        self.t0 = time.monotonic()
+        self.attrs = attrs
+        self.error = None
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def add_span(self, name: str, t0: float, seconds: float, outcome: str, attrs: dict):
+        span = {"name": name, "at": round(t0 - self.t0, 3), "seconds": round(seconds, 3), "outcome": outcome}
+        span.update(attrs)
+        with self.lock:
+            self.spans.append(span)
+
+    def to_dict(self, outcome: str) -> dict:
+        with self.lock:
+            spans = sorted(self.spans, key=lambda s: s["at"])
+        return {"kind": self.kind, "sid": self.sid, "pid": os.getpid(),
+                "started": datetime.utcfromtimestamp(self.started).isoformat() + "Z",
+                "seconds": round(time.monotonic() - self.t0, 3), "outcome": outcome, "error": self.error,
+                "attrs": self.attrs, "spans": spans}
+
+def save_trace(data: dict):
+    sdir = sess_dir(data["sid"])
+    if os.path.isdir(sdir):
+        # Varios trabajos de la misma sesión pueden acabar a la vez (recortes)
+        with open(os.path.join(sdir, TRACE_FILE), "a+", encoding="utf-8") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                jobs = json.load(f)
+            except ValueError:
+                jobs = []
+            jobs.append(data)
+            f.seek(0)
+            f.truncate()
+            json.dump(jobs, f, ensure_ascii=False)
+
+    os.makedirs(TRACE_DIR, exist_ok=True)
+    name = f"{int(time.time() * 1000):013d}-{data['kind']}-{data['sid']}.json"
+    with open(os.path.join(TRACE_DIR, name + ".tmp"), "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(os.path.join(TRACE_DIR, name + ".tmp"), os.path.join(TRACE_DIR, name))
+
+def prune_traces():
+    """Deja en TRACE_DIR las TRACE_KEEP trazas más recientes (lo llama el janitor)"""
+    try:
+        names = sorted(n for n in os.listdir(TRACE_DIR) if n.endswith(".json"))
+    except FileNotFoundError:
+        return
+    for old in names[:-TRACE_KEEP]:
+        try: os.remove(os.path.join(TRACE_DIR, old))
+        except OSError: pass
+
+class TraceWriter:
+    """Guarda las trazas desde un hilo propio: el trabajo o la petición que acaba
+    (p. ej. /trim) no espera al disco ni al bloqueo de trace.json"""
+
+    def __init__(self, max_pending: int = 1000):
+        self.lock = threading.Lock()
+        self.max_pending = max_pending
+        self.pid = None
+
+    def ensure_running(self):
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pending = queue.Queue(self.max_pending)
+            self.pid = os.getpid()
+            threading.Thread(target=self._run, daemon=True, name="trace-writer").start()
+
+    def put(self, data: dict):
+        self.ensure_running()
+        try:
+            self.pending.put_nowait(data)
+        except queue.Full:
+            print("traza descartada (cola llena):", data["kind"], data["sid"], flush=True)
+
+    def _run(self):
+        while True:
+            data = self.pending.get()
+            try:
+                save_trace(data)
+            except Exception as e:
+                print("traza:", e, flush=True)
+
+trace_writer = TraceWriter()
+
+def load_traces() -> list:
+    """Trazas de TRACE_DIR, de la más reciente a la más antigua"""
+    try:
+        names = sorted((n for n in os.listdir(TRACE_DIR) if n.endswith(".json")), reverse=True)
+    except FileNotFoundError:
+        return []
+    traces = []
+    for name in names:
+        try:
+            with open(os.path.join(TRACE_DIR, name), "r", encoding="utf-8") as f:
+                traces.append(json.load(f))
+        except (OSError, ValueError):
+            pass
+    return traces
+
+@contextmanager
+def job_trace(kind: str, sid: str, **attrs):
+    """Traza del trabajo que corre en este hilo; pipeline_stage y trace_span le
+    añaden etapas. También cuenta el trabajo entero en ytmp3_stage_seconds."""
+    trace = JobTrace(kind, sid, **attrs)
+    token = _current_trace.set(trace)
+    outcome = "error"
+    try:
+        yield trace
+        outcome = "error" if trace.error else "ok"
+    except JobCancelled:
+        outcome = "cancelled"
+        raise
+    except Exception as e:
+        trace.error = trace.error or str(e)[:300]
+        raise
+    finally:
+        _current_trace.reset(token)
+        metrics.observe("ytmp3_stage_seconds", time.monotonic() - trace.t0, stage=kind, outcome=outcome)
+        trace_writer.put(trace.to_dict(outcome))
+
+def run_traced(sid: str, fn, *args, **attrs):
+    """fn(*args) dentro de su propia traza de trabajo"""
+    with job_trace(fn.__name__, sid, **attrs):
+        fn(*args)
+
+def trace_set(**attrs):
+    """Datos del trabajo en curso (si hay traza)"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.attrs.update(attrs)
+
+def trace_span(name: str, t0: float, outcome: str, **attrs):
+    """Etapa que empezó en t0 (time.monotonic) y acaba ahora"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_span(name, t0, time.monotonic() - t0, outcome, attrs)
+
+def span_set(**attrs):
+    """Datos de la etapa en curso. Con bytes se calcula la velocidad y con
+    media_seconds el factor de tiempo real."""
+    span = _current_span.get()
+    if span is not None:
+        span.update(attrs)
+
+@contextmanager
+def pipeline_stage(name: str):
+    """Mide una etapa en ytmp3_stage_seconds con su resultado (ok, error, cancelled)
+    y la añade a la traza del trabajo"""
+    t0 = time.monotonic()
+    outcome = "error"
+    attrs = {}
+    token = _current_span.set(attrs)
+    try:
+        yield attrs
+        outcome = "ok"
+    except JobCancelled:
+        outcome = "cancelled"
+        raise
+    finally:
+        _current_span.reset(token)
+        seconds = time.monotonic() - t0
+        metrics.observe("ytmp3_stage_seconds", seconds, stage=name, outcome=outcome)
+        trace = _current_trace.get()
+        if trace is not None:
+            if seconds > 0 and attrs.get("bytes"):
+                attrs["bytes_per_s"] = round(attrs["bytes"] / seconds)
+            if seconds > 0 and attrs.get("media_seconds"):
+                attrs["realtime_factor"] = round(attrs["media_seconds"] / seconds, 1)
+            trace.add_span(name, t0, seconds, outcome, attrs)
+
+def staged(name: str):
+    """Decorador: toda la función cuenta como la etapa name"""
+    def wrap(fn):
+        @functools.wraps(fn)
+        def inner(*args, **kwargs):
+            with pipeline_stage(name):
+                return fn(*args, **kwargs)
+        return inner
+    return wrap
+
+# ---------- limpieza de sesiones ----------
+# Un hilo por proceso mantiene un montículo (último acceso, sid) y borra por
+# tandas las sesiones caducadas. Solo un worker actúa como limpiador a la vez
+# (flock sobre TMP_BASE/.janitor.lock); los demás quedan de reserva.
+JANITOR_INTERVAL = int(os.environ.get("JANITOR_INTERVAL", "30"))      # s entre pasadas
+JANITOR_BATCH = int(os.environ.get("JANITOR_BATCH", "20"))            # borrados máximos por pasada
+JANITOR_HIGH_WATER = float(os.environ.get("JANITOR_HIGH_WATER", "0.90"))  # uso del volumen que activa el desalojo anticipado
+JANITOR_LOW_WATER = float(os.environ.get("JANITOR_LOW_WATER", "0.80"))    # objetivo del desalojo anticipado
+JANITOR_MIN_IDLE = 120  # s: nunca se desaloja antes de tiempo una sesión usada hace menos
+TOUCH_RESOLUTION = 30   # s: los accesos más seguidos no vuelven a entrar en el montículo
+
+class SessionJanitor:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.heap = []           # (último acceso, sid); puede tener entradas obsoletas
+        self.last_access = {}    # {sid: último acceso registrado}
+        self.pid = None
+        self.metrics = {"sessions": 0, "deleted_expired": 0, "deleted_pressure": 0,
+                        "disk_total": 0, "disk_used": 0, "disk_free": 0, "last_run": 0.0, "active": False}
+
+    def ensure_running(self):
+        if self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.heap, self.last_access = [], {}
+            threading.Thread(target=self._run, daemon=True, name="session-janitor").start()
+
+    def touch(self, sid: str, when: float = None):
+        """Registra un acceso a la sesión"""
+        when = time.time() if when is None else when
+        with self.lock:
+            prev = self.last_access.get(sid)
+            if prev is not None and when - prev < TOUCH_RESOLUTION:
+                return
+            self.last_access[sid] = when
+            heapq.heappush(self.heap, (when, sid))
+
+    def forget(self, sid: str):
+        with self.lock:
+            self.last_access.pop(sid, None)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return dict(self.metrics)
+
+    def _run(self):
+        lock_file = open(os.path.join(TMP_BASE, ".janitor.lock"), "a")
+        while True:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # Otro worker limpia; solo se actualizan las métricas de disco
+                    self._update_disk()
+                    time.sleep(JANITOR_INTERVAL)
+                    continue
+            with self.lock:
+                self.metrics["active"] = True
+            while True:
+                try:
+                    self.run_once()
+                except Exception as e:
+                    print("janitor:", e, flush=True)
+                time.sleep(JANITOR_INTERVAL)
+
+    def _scan(self):
+        """Incorpora sesiones creadas por otros workers (solo las que no conoce)"""
+        try:
+            names = os.listdir(TMP_BASE)
+        except FileNotFoundError:
+            return 0
+        count = 0
+        for name in names:
+            if name.startswith("."): continue
+            count += 1
+            with self.lock:
+                known = name in self.last_access
+            if not known:
+                try:
+                    self.touch(name, os.path.getmtime(os.path.join(TMP_BASE, name)))
+                except OSError:
+                    pass
+        return count
+
+    def _update_disk(self):
+        try:
+            du = shutil.disk_usage(TMP_BASE)
+        except OSError:
+            return None
+        with self.lock:
+            self.metrics.update(disk_total=du.total, disk_used=du.used, disk_free=du.free)
+        return du
+
+    def _delete(self, sid: str):
+        request_cancel(sid)
+        shutil.rmtree(sess_dir(sid), ignore_errors=True)
+        cleanup_progress(sid)
+        self.forget(sid)
+
+    def _pop_candidate(self, older_than: float):
+        """Saca la sesión menos usada si su acceso real es anterior a older_than"""
+        while True:
+            with self.lock:
+                if not self.heap or self.heap[0][0] >= older_than:
+                    return None
+                when, sid = heapq.heappop(self.heap)
+                if self.last_access.get(sid) != when:
+                    continue  # entrada obsoleta: hubo un acceso posterior
+            # La mtime del directorio es la verdad (otros workers también la tocan)
+            try:
+                mtime = os.path.getmtime(sess_dir(sid))
+            except OSError:
+                self.forget(sid)
+                continue
+            # Un trabajo largo puede no tocar el directorio en mucho rato
+            p = get_progress(sid)
+            if p.get("status") in ("queued", "processing") and time.time() - p.get("timestamp", 0) < SESSION_TTL:
+                mtime = max(mtime, p["timestamp"])
+            if mtime > when + 1:
+                with self.lock:
+                    self.last_access[sid] = mtime
+                    heapq.heappush(self.heap, (mtime, sid))
+                continue
+            return sid
+
+    def run_once(self):
+        now = time.time()
+        sessions = self._scan()
+        deleted = 0
+        while deleted < JANITOR_BATCH:
+            sid = self._pop_candidate(now - SESSION_TTL)
+            if sid is None: break
+            self._delete(sid)
+            deleted += 1
+            time.sleep(0.01)  # no acaparar el disco
+        with self.lock:
+            self.metrics["deleted_expired"] += deleted
+        clip_cache_evict()  # caducidad de los recortes aunque nadie recorte
+        prune_traces()
+        # Volumen casi lleno: primero se recorta la caché, luego las sesiones más antiguas
+        du = self._update_disk()
+        if du and du.total and du.used / du.total > JANITOR_HIGH_WATER:
+            excess = du.used - int(JANITOR_LOW_WATER * du.total)
+            clip_cache_evict(max(0, clip_cache_size() - excess))
+            audio_cache_evict(max(0, audio_cache_size() - excess))
+            pressure = 0
+            while pressure < JANITOR_BATCH:
+                du = self._update_disk()
+                if not du or du.used / du.total <= JANITOR_LOW_WATER: break
+                sid = self._pop_candidate(time.time() - JANITOR_MIN_IDLE)
+                if sid is None: break
+                self._delete(sid)
+                pressure += 1
+            with self.lock:
+                self.metrics["deleted_pressure"] += pressure
+            deleted += pressure
+
+        with self.lock:
+            self.metrics["sessions"] = max(0, sessions - deleted)
+            self.metrics["last_run"] = now
+
+janitor = SessionJanitor()
+
+@app.before_request
+def _start_background_services():
+    janitor.ensure_running()
+    metrics.ensure_running()
+    g.request_started = time.monotonic()
+
+def _count_served(body, endpoint: str):
+    try:
+        for chunk in body:
+            metrics.inc("ytmp3_served_bytes_total", len(chunk), endpoint=endpoint)
+            yield chunk
+    finally:
+        close = getattr(body, "close", None)
+        if close:
+            close()
+
+@app.after_request
+def _record_request(response):
+    endpoint = request.endpoint or "other"
+    started = g.get("request_started")
+    if started is not None:
+        metrics.observe("ytmp3_http_request_seconds", time.monotonic() - started, endpoint=endpoint)
+    if request.method != "HEAD":
+        if response.is_streamed and not response.direct_passthrough:
+            response.response = _count_served(response.response, endpoint)
+        elif response.content_length:
+            metrics.inc("ytmp3_served_bytes_total", response.content_length, endpoint=endpoint)
+    return response
+
+# ---------- validación y helpers ----------
+YTLINK = re.compile(r'^https?://([a-z0-9-]+\.)*(youtube\.com|youtu\.be)/', re.I)
+_VIDEO_ID_RE = re.compile(r'(?:[?&]v=|youtu\.be/|/shorts/|/embed/|/live/|/v/)([A-Za-z0-9_-]{11})(?![A-Za-z0-9_-])')
+
+def canonical_video_id(url: str):
+    """Devuelve el ID de 11 caracteres del vídeo o None si no se reconoce"""
+    m = _VIDEO_ID_RE.search(url or "")
+    return m.group(1) if m else None
+
+UA_ANDROID = "com.google.android.youtube/19.29.37 (Linux; U; Android 14; en_US)"
+CLIENTS = [
+    ("android", UA_ANDROID),
+    ("android_music", "com.google.android.apps.youtube.music/7.02.52 (Linux; U; Android 14; en_US)"),
+    ("ios", "com.google.ios.youtube/19.29.1 (iPhone16,2; U; CPU iOS 17_5_1 like Mac OS X;)"),
+    ("mweb", "Mozilla/5.0 (Linux; Android 14) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Mobile Safari/537.36"),
     ("web", "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"),
 ]
 
-def hhmmss_from_seconds(s: float) -> str:
-    s = max(0.0, float(s))
-    h = int(s // 3600); m = int((s % 3600) // 60); sec = s % 60
-    return f"{h}:{m:02d}:{sec:06.3f}" if h>0 else f"{m}:{sec:06.3f}"
+def hhmmss_from_seconds(s: float) -> str:
+    s = max(0.0, float(s))
+    h = int(s // 3600); m = int((s % 3600) // 60); sec = s % 60
+    return f"{h}:{m:02d}:{sec:06.3f}" if h>0 else f"{m}:{sec:06.3f}"
+
+def parse_time_to_seconds(txt: str) -> float:
+    txt = (txt or "").strip()
+    if not txt: return float("nan")
+    parts = txt.split(":")
+    try:
+        if len(parts)==1: return float(parts[0])
+        if len(parts)==2: return int(parts[0])*60 + float(parts[1])
+        if len(parts)==3: return int(parts[0])*3600 + int(parts[1])*60 + float(parts[2])
+    except Exception:
+        return float("nan")
+    return float("nan")
+
+FFMPEG_TIMEOUT = int(os.environ.get("FFMPEG_TIMEOUT", "900"))  # 15 min por proceso
+
+class JobCancelled(Exception):
+    pass
+
+def _watch_ffmpeg(proc, sid: str, timeout: float, activity: list = None):
+    """Mata proc si la sesión se cancela o se supera timeout.
+    Con activity ([instante monotonic del último avance]) timeout cuenta desde el
+    último avance en vez de desde el arranque (motivo "stall").
+    Devuelve (evento para avisar de que terminó, dict con el motivo)."""
+    killed = {"reason": None}
+    finished = threading.Event()
+    def watchdog():
+        start = time.monotonic()
+        while not finished.wait(0.5):
+            if sid and cancel_requested(sid):
+                killed["reason"] = "cancel"
+            elif activity is not None and time.monotonic() - activity[0] > timeout:
+                killed["reason"] = "stall"
+            elif activity is None and time.monotonic() - start > timeout:
+                killed["reason"] = "timeout"
+            if killed["reason"]:
+                proc.kill()
+                return
+    threading.Thread(target=watchdog, daemon=True).start()
+    return finished, killed
+
+def _raise_if_killed(killed: dict):
+    if killed["reason"] == "cancel":
+        raise JobCancelled("Procesamiento cancelado")
+    if killed["reason"] == "timeout":
+        abort(504, "FFmpeg superó el tiempo máximo de procesamiento")
+
+def run_ffmpeg(args: list, duration: float = 0.0, on_progress=None, sid: str = None, timeout: float = None,
+               feed=None):
+    """Ejecuta ffmpeg leyendo -progress pipe:1 línea a línea.
+    on_progress(fracción 0-1) se llama cuando avanza out_time respecto a duration.
+    Si se pasa feed(stdin), corre en otro hilo escribiendo la entrada (pipe:0) y debe cerrarla.
+    Mata el proceso si supera timeout o si la sesión sid se cancela.
+    Devuelve (returncode, últimas líneas de stderr)."""
+    timeout = FFMPEG_TIMEOUT if timeout is None else timeout
+    full = [args[0], "-progress", "pipe:1", "-nostats"] + list(args[1:])
+    proc = subprocess.Popen(full, stdin=subprocess.PIPE if feed else subprocess.DEVNULL,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if feed:
+        threading.Thread(target=feed, args=(proc.stdin,), daemon=True).start()
+
+    # stderr se vacía en otro hilo para que ffmpeg nunca se bloquee escribiendo
+    err_tail = collections.deque(maxlen=20)
+    def drain_stderr():
+        for line in proc.stderr:
+            err_tail.append(line)
+    err_thread = threading.Thread(target=drain_stderr, daemon=True)
+    err_thread.start()
+
+    finished, killed = _watch_ffmpeg(proc, sid, timeout)
+    try:
+        last = -1.0
+        for raw in proc.stdout:
+            key, _, value = raw.decode(errors="ignore").strip().partition("=")
+            # out_time_ms viene en microsegundos pese al nombre
+            if key == "out_time_ms" and on_progress and duration > 0:
+                try:
+                    frac = min(max(int(value) / 1e6 / duration, 0.0), 1.0)
+                except ValueError:
+                    continue
+                if frac - last >= 0.01:
+                    last = frac
+                    on_progress(frac)
+        proc.wait()
+    finally:
+        finished.set()
+        if proc.poll() is None:
+            proc.kill(); proc.wait()
+        err_thread.join(timeout=2)
+
+    _raise_if_killed(killed)
+    return proc.returncode, b"".join(err_tail).decode(errors="ignore")
+
+@staged("convert")
+def ffmpeg_to_mp3(src: str, dst: str, sid: str = None, duration: float = 0.0, span=(75, 100)):
+    """Convierte a MP3 informando del avance de la sesión en el rango span"""
+    lo, hi = span
+    def on_progress(frac):
+        update_progress(sid, int(lo + (hi - lo) * frac), f"Convirtiendo a MP3: {int(frac * 100)}%", "processing")
+    args = [ffbin, "-hide_banner", "-nostdin", "-y", "-i", src, "-vn", "-c:a", "libmp3lame", "-q:a", "0", dst]
+    rc, err = run_ffmpeg(args, duration, on_progress if sid else None, sid=sid)
+    if rc != 0 or not os.path.exists(dst) or os.path.getsize(dst)==0:
+        abort(500, f"FFmpeg falló al convertir a MP3: {err[-400:]}")
+    span_set(media_seconds=duration, output_bytes=os.path.getsize(dst))
+
+# ---------- índice de tramas MP3 ----------
+# Con el desplazamiento de cada trama se puede empezar a decodificar justo antes del
+# recorte (-skip_initial_bytes) en vez de desde el principio del fichero. Se empieza
+# MP3_PREROLL_FRAMES tramas antes porque una trama toma datos de las anteriores
+# (depósito de bits) y el solapamiento de la MDCT ensucia la primera que se decodifica.
+# Los tiempos se cuentan como ffmpeg al decodificar el fichero entero: si hay
+# cabecera LAME, se descartan enc_delay + 529 muestras iniciales.
+# En la ingesta el índice se guarda junto al audio (frames.bin): cabecera <4sIIIIIII
+# y un uint32 por trama. Todas las tramas de capa III tienen las mismas muestras,
+# así que la posición de la trama k es k * frame_samples.
+MP3_PREROLL_FRAMES = 10
+FRAMES_FILE = "frames.bin"
+FRAMES_MAGIC = b"FRM1"
+_FRAMES_HEADER = struct.Struct("<4sIIIIIII")
+_MP3_BITRATES = {
+    3: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),    # MPEG-1
+    2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),        # MPEG-2
+}
+_MP3_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+def _mp3_frame_header(h: bytes):
+    """(longitud, Hz, muestras por trama, canales) de una cabecera de MPEG capa III, o None"""
+    if len(h) < 4 or h[0] != 0xFF or (h[1] & 0xE0) != 0xE0:
+        return None
+    version, layer = (h[1] >> 3) & 3, (h[1] >> 1) & 3
+    br_idx, sr_idx, pad = h[2] >> 4, (h[2] >> 2) & 3, (h[2] >> 1) & 1
+    if version == 1 or layer != 1 or br_idx in (0, 15) or sr_idx == 3:
+        return None
+    rate = _MP3_RATES[version][sr_idx]
+    kbps = _MP3_BITRATES[3 if version == 3 else 2][br_idx]
+    if version == 3:
+        return 144000 * kbps // rate + pad, rate, 1152, 1 if (h[3] >> 6) == 3 else 2
+    return 72000 * kbps // rate + pad, rate, 576, 1 if (h[3] >> 6) == 3 else 2
+
+class Mp3FrameIndex:
+    """Desplazamiento de cada trama de audio de un MP3 (sin la trama Xing/Info)"""
+    def __init__(self, offsets, sample_rate: int, frame_samples: int, skip: int, end_pad: int,
+                 data_end: int, source_size: int):
+        self.offsets = offsets
+        self.sample_rate = sample_rate
+        self.frame_samples = frame_samples
+        self.skip = skip            # muestras que ffmpeg descarta al principio
+        self.end_pad = end_pad      # y al final (relleno del codificador)
+        self.data_end = data_end
+        self.source_size = source_size
+
+    @property
+    def duration(self) -> float:
+        """Duración exacta, la misma que daría ffmpeg decodificando el fichero entero"""
+        samples = len(self.offsets) * self.frame_samples - max(self.skip - 529, 0) - self.end_pad
+        return max(samples, 0) / self.sample_rate
+
+    def save(self, path: str):
+        tmp = path + ".tmp"
+        offsets = array("I", self.offsets)
+        if sys.byteorder == "big":
+            offsets.byteswap()
+        with open(tmp, "wb") as f:
+            f.write(_FRAMES_HEADER.pack(FRAMES_MAGIC, self.sample_rate, self.frame_samples, self.skip,
+                                        self.end_pad, self.data_end, self.source_size, len(offsets)))
+            f.write(offsets.tobytes())
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path, "rb") as f:
+            magic, rate, spf, skip, end_pad, data_end, size, count = _FRAMES_HEADER.unpack(f.read(_FRAMES_HEADER.size))
+            if magic != FRAMES_MAGIC:
+                raise ValueError("frames.bin no válido")
+            offsets = array("I")
+            offsets.frombytes(f.read(4 * count))
+        if len(offsets) != count:
+            raise ValueError("frames.bin incompleto")
+        if sys.byteorder == "big":
+            offsets.byteswap()
+        return cls(offsets, rate, spf, skip, end_pad, data_end, size)
+
+    @classmethod
+    def scan(cls, path: str):
+        """Recorre las cabeceras de trama; None si no es un MP3 que se pueda indexar"""
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < 4:
+                return None
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                pos = 0
+                if mm[:3] == b"ID3" and size >= 10:
+                    pos = 10 + ((mm[6] & 0x7F) << 21 | (mm[7] & 0x7F) << 14 | (mm[8] & 0x7F) << 7 | (mm[9] & 0x7F))
+                    if mm[5] & 0x10:
+                        pos += 10
+                offsets, skip, end_pad, rate, spf, first = array("I"), 0, 0, None, None, True
+                while pos + 4 <= size:
+                    hdr = _mp3_frame_header(mm[pos:pos + 4])
+                    if hdr is None or (rate is not None and (hdr[1], hdr[2]) != (rate, spf)):
+                        if offsets:
+                            break   # ID3v1/APE u otra basura al final
+                        nxt = mm.find(b"\xff", pos + 1, min(size, pos + 65536))
+                        if nxt < 0:
+                            return None
+                        pos = nxt
+                        continue
+                    length, r, s, channels = hdr
+                    if first:
+                        first = False
+                        side = (32 if channels == 2 else 17) if s == 1152 else (17 if channels == 2 else 9)
+                        tag = mm[pos + 4 + side:pos + 8 + side]
+                        if tag in (b"Xing", b"Info"):
+                            flags = int.from_bytes(mm[pos + 8 + side:pos + 12 + side], "big")
+                            lame = pos + 12 + side + 4 * bool(flags & 1) + 4 * bool(flags & 2) + 100 * bool(flags & 4) + 4 * bool(flags & 8)
+                            if mm[lame:lame + 4] == b"LAME" or mm[lame:lame + 4] == b"Lavc":
+                                d = mm[lame + 21:lame + 24]
+                                skip = ((d[0] << 4) | (d[1] >> 4)) + 529
+                                end_pad = ((d[1] & 0x0F) << 8) | d[2]
+                            rate, spf = r, s
+                            pos += length
+                            continue
+                    rate, spf = r, s
+                    offsets.append(pos)
+                    pos += length
+                if not offsets:
+                    return None
+                return cls(offsets, rate, spf, skip, end_pad, min(pos, size), size)
+
+    def sample(self, t: float) -> int:
+        """Muestra del decodificador (contando desde la primera trama) del instante t"""
+        return int(round(t * self.sample_rate)) + self.skip
+
+    def window(self, start: float, end: float):
+        """Qué leer para obtener [start, end) exacto. Devuelve (byte inicial, primera
+        muestra, muestra final) contando muestras desde ese byte, y segundos a leer."""
+        first = self.sample(start)
+        last = self.sample(end)
+        k = max(0, first // self.frame_samples - MP3_PREROLL_FRAMES)
+        if k >= len(self.offsets):
+            return None
+        base = k * self.frame_samples
+        # Un par de tramas de margen al final: ffmpeg deja de leer en cuanto atrim termina
+        limit = (last - base + 2 * self.frame_samples) / self.sample_rate
+        return self.offsets[k], first - base, last - base, limit
+
+_frame_index_cache = collections.OrderedDict()
+_frame_index_lock = threading.Lock()
+
+def mp3_frame_index(path: str):
+    """Índice de tramas de path: el frames.bin de la sesión si lo hay y si no,
+    recorriendo el fichero. Los últimos quedan en memoria."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    key = (path, st.st_ino, st.st_mtime_ns)
+    with _frame_index_lock:
+        if key in _frame_index_cache:
+            _frame_index_cache.move_to_end(key)
+            return _frame_index_cache[key]
+    index = None
+    try:
+        index = Mp3FrameIndex.load(os.path.join(os.path.dirname(path), FRAMES_FILE))
+        if index.source_size != st.st_size:
+            index = None
+    except (OSError, ValueError, struct.error):
+        pass
+    if index is None:
+        try:
+            index = Mp3FrameIndex.scan(path)
+        except (OSError, ValueError):
+            index = None
+    with _frame_index_lock:
+        _frame_index_cache[key] = index
+        while len(_frame_index_cache) > 8:
+            _frame_index_cache.popitem(last=False)
+    return index
+
+def precise_trim_plan(src: str, clips: list):
+    """Entrada y filtros para recortar con precisión los tramos [(inicio, fin, fades)].
+    Devuelve (argumentos de entrada, filtros comunes, filtros de cada tramo)."""
+    lo, hi = min(c[0] for c in clips), max(c[1] for c in clips)
+    index = mp3_frame_index(src) if src.endswith(".mp3") else None
+    window = index.window(lo, hi) if index else None
+    if window:
+        # Solo se decodifica desde el primer tramo (más el preroll) hasta el último; las
+        # muestras se cuentan desde la trama de arranque, así que el corte es exacto.
+        offset, first, _, limit = window
+        base = index.sample(lo) - first
+        inputs = ["-skip_initial_bytes", str(offset), "-t", f"{limit:.6f}", "-i", src]
+        head = ["asetpts=N/SR/TB"]
+        trims = [f"atrim=start_sample={index.sample(s) - base}:end_sample={index.sample(e) - base}" for s, e, _ in clips]
+    else:
+        # Otros formatos (AAC): búsqueda de entrada con un segundo de margen; ffmpeg
+        # decodifica desde ahí y descarta hasta el instante exacto (accurate_seek),
+        # así que los tiempos pasan a contar desde seek sin perder precisión.
+        seek = max(lo - 1.0, 0.0)
+        inputs = (["-ss", f"{seek:.6f}"] if seek > 0 else []) + ["-t", f"{hi - seek + 1.0:.6f}", "-i", src]
+        head = []
+        trims = [f"atrim=start={s - seek:.6f}:end={e - seek:.6f}" for s, e, _ in clips]
+    chains = []
+    for trim, (s, e, fades) in zip(trims, clips):
+        # Fades con tiempo relativo al recorte
+        chain = [trim, "asetpts=PTS-STARTPTS"]
+        if fades:
+            chain += ["afade=t=in:d=0.005", f"afade=t=out:st={max(0.0, e - s - 0.005):.6f}:d=0.005"]
+        chains.append(chain)
+    return inputs, head, chains
+
+@staged("batch_trim")
+def run_ffmpeg_batch_trim(src: str, clips: list, outdir: str, sid: str = None) -> list:
+    """Todos los tramos [(inicio, fin, fades)] en una sola pasada de ffmpeg: el audio
+    se decodifica una vez, asplit lo reparte y cada rama sale a su MP3"""
+    inputs, head, chains = precise_trim_plan(src, clips)
+    labels = "".join(f"[s{i}]" for i in range(len(clips)))
+    graph = [f"[0:a]{','.join(head + [f'asplit={len(clips)}'])}{labels}"]
+    graph += [f"[s{i}]{','.join(chain)}[o{i}]" for i, chain in enumerate(chains)]
+    args = [ffbin, "-hide_banner", "-nostdin", "-y"] + inputs + ["-filter_complex", ";".join(graph)]
+    outputs = []
+    for i in range(len(clips)):
+        dst = os.path.join(outdir, f"clip{i:02d}.mp3")
+        args += ["-map", f"[o{i}]", "-c:a", "libmp3lame", "-q:a", "0", dst]
+        outputs.append(dst)
+    rc, err = run_ffmpeg(args, sid=sid)
+    if rc != 0 or not all(os.path.exists(p) and os.path.getsize(p) > 0 for p in outputs):
+        abort(500, f"FFmpeg falló al recortar: {err[-400:]}")
+    span_set(clips=len(clips), media_seconds=sum(e - s for s, e, _ in clips),
+             output_bytes=sum(os.path.getsize(p) for p in outputs))
+    return outputs
+
+@staged("trim")
+def run_ffmpeg_trim(src: str, dst: str, start: float, end: float, precise: bool, fades: bool, sid: str = None):
+    if end <= start:
+        abort(400, "El tiempo de fin debe ser mayor que el de inicio")
+    clip_len = end - start
+    if clip_len < 0.01:
+        abort(400, "El recorte debe tener al menos 0.01 s")
+
+    args = [ffbin, "-hide_banner", "-nostdin", "-y"]
+    if precise:
+        inputs, head, chains = precise_trim_plan(src, [(start, end, fades)])
+        args += inputs + ["-af", ",".join(head + chains[0]), "-c:a", "libmp3lame", "-q:a", "0", dst]
+    elif not src.endswith(".mp3"):
+        # Fuente AAC (SMART_INGEST): no se puede copiar a MP3, se codifica solo el tramo.
+        args += ["-ss", f"{start:.6f}", "-to", f"{end:.6f}", "-i", src, "-vn", "-c:a", "libmp3lame", "-q:a", "0", dst]
+    else:
+        # Rápido, sin recodificar.
+        args += ["-ss", f"{start:.6f}", "-to", f"{end:.6f}", "-i", src, "-c", "copy", dst]
+
+    rc, err = run_ffmpeg(args, sid=sid)
+    if rc != 0 or not os.path.exists(dst) or os.path.getsize(dst)==0:
+        abort(500, f"FFmpeg falló al recortar: {err[-400:]}")
+    span_set(precise=precise, media_seconds=clip_len, output_bytes=os.path.getsize(dst))
+
+def yt_base_options() -> dict:
+    """Opciones comunes de yt-dlp (con las cookies de YOUTUBE_COOKIES si las hay)"""
+    base_common = {
+        "noplaylist": True,
+        "socket_timeout": 30,
+        "retries": 5,
+        "concurrent_fragment_downloads": 1,
+        "geo_bypass": True,
+        "ffmpeg_location": FFMPEG_DIR,
+        "quiet": True,
+        "no_warnings": True,
+        "max_filesize": MAX_UPLOAD_SIZE,
+        # Anti-bot improvements
+        "extractor_retries": 3,
+        "fragment_retries": 5,
+        "skip_unavailable_fragments": True,
+        "nocheckcertificate": True,
+    }
+    if YT_CACHE_DIR:
+        base_common["cachedir"] = YT_CACHE_DIR
+
+    # Usar cookies si están disponibles (YOUTUBE_COOKIES o YOUTUBE_COOKIES_FILE)
+    cookies_file, _ = yt_cookies.current()
+    if cookies_file:
+        base_common["cookiefile"] = cookies_file
+    return base_common
+
+def yt_client_options(base_common: dict, client: str, ua: str) -> dict:
+    """base_common más la identidad del cliente de YouTube elegido"""
+    opts = dict(base_common)
+    opts.update({
+        "user_agent": ua,
+        "http_headers": {
+            "User-Agent": ua,
+            "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+            "Accept-Language": "en-us,en;q=0.5",
+            "Sec-Fetch-Mode": "navigate",
+        },
+        "extractor_args": {"youtube": {"player_client": [client], "skip": ["hls", "dash"]}},
+    })
+    return opts
+
+# ---------- sesiones de yt-dlp ----------
+# Cada worker guarda YoutubeDL ya construidos por (cliente, uso) y los presta de uno
+# en uno: conservan las conexiones abiertas, el tarro de cookies ya leído y la caché
+# del reproductor y las firmas del extractor de YouTube entre trabajos. Las cookies
+# se copian una vez a un fichero privado del proceso (yt-dlp solo lo lee: al cerrar
+# no escribe en él) y se vuelven a copiar si cambian; los YoutubeDL que las usaban
+# se descartan.
+YOUTUBE_COOKIES_FILE = os.environ.get("YOUTUBE_COOKIES_FILE", "")
+YT_CACHE_DIR = os.environ.get("YT_CACHE_DIR", "")  # caché de yt-dlp en disco (por defecto ~/.cache/yt-dlp)
+YT_COOKIES_CHECK = 30  # s entre comprobaciones de cambios
+YT_POOL_IDLE = int(os.environ.get("YT_POOL_IDLE", "4"))  # YoutubeDL libres por (cliente, uso)
+
+class YtCookies:
+    """Copia privada de las cookies de YouTube para este proceso"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.path = None
+        self.fingerprint = None
+        self.generation = 0
+        self.checked = 0.0
+        self.owner = None  # pid que registró el borrado de su copia al salir
+
+    def _source(self):
+        """(huella, leer contenido) de la fuente actual, o (None, None) sin cookies.
+        OSError si YOUTUBE_COOKIES_FILE no se puede leer."""
+        txt = os.environ.get("YOUTUBE_COOKIES")
+        if txt:
+            return hashlib.sha256(txt.encode()).hexdigest(), lambda: txt
+        if YOUTUBE_COOKIES_FILE:
+            st = os.stat(YOUTUBE_COOKIES_FILE)
+            def read():
+                with open(YOUTUBE_COOKIES_FILE, "r", encoding="utf-8") as f:
+                    return f.read()
+            return (st.st_mtime_ns, st.st_size), read
+        return None, None
+
+    def current(self):
+        """(ruta o None, generación); la generación cambia cada vez que se recargan"""
+        with self.lock:
+            now = time.monotonic()
+            if self.checked and now - self.checked < YT_COOKIES_CHECK:
+                return self.path, self.generation
+            self.checked = now
+            path = os.path.join(tempfile.gettempdir(), f"ytmp3_cookies_{os.getpid()}.txt")
+            tmp = path + ".tmp"
+            try:
+                fingerprint, read = self._source()
+                if fingerprint == self.fingerprint:
+                    return self.path, self.generation
+                if read:
+                    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                    with os.fdopen(fd, "w", encoding="utf-8") as f:
+                        f.write(read())
+                    os.replace(tmp, path)
+                    self._own_copy()
+                else:
+                    path = None
+            except OSError as e:
+                # El fichero desapareció o no se puede leer (p. ej. mientras se
+                # sustituye): se sigue con la copia anterior y se reintenta luego
+                print("cookies de YouTube no recargadas:", e, flush=True)
+                try: os.remove(tmp)
+                except OSError: pass
+                return self.path, self.generation
+            if self.fingerprint is not None:
+                print("cookies de YouTube recargadas", flush=True)
+            self.path, self.fingerprint = path, fingerprint
+            self.generation += 1
+            return self.path, self.generation
+
+    def _own_copy(self):
+        """Primera copia de este proceso: se borra al salir, y de paso las que
+        dejaron workers ya muertos (caída, SIGKILL)"""
+        if self.owner == os.getpid():
+            return
+        self.owner = os.getpid()
+        atexit.register(self._remove, self.owner)
+        tmpdir = tempfile.gettempdir()
+        for name in os.listdir(tmpdir):
+            m = re.fullmatch(r"ytmp3_cookies_(\d+)\.txt(\.tmp)?", name)
+            if m and not pid_alive(int(m.group(1))):
+                try: os.remove(os.path.join(tmpdir, name))
+                except OSError: pass
+
+    def _remove(self, pid: int):
+        if os.getpid() == pid:
+            try: os.remove(os.path.join(tempfile.gettempdir(), f"ytmp3_cookies_{pid}.txt"))
+            except OSError: pass
+
+yt_cookies = YtCookies()
+
+class YtSession:
+    """Un YoutubeDL prestado por YtPool; hook recibe su progreso mientras dure el préstamo"""
+
+    def __init__(self, key: tuple, opts: dict, generation: int):
+        self.key, self.generation = key, generation
+        self.hook = None
+        opts["progress_hooks"] = [self._progress]
+        self.ydl = yt_dlp.YoutubeDL(opts)
+        if opts.get("cookiefile"):
+            self.ydl.cookiejar  # se lee ya y no se vuelve a escribir al cerrar
+            self.ydl.params["cookiefile"] = None
+
+    def _progress(self, d):
+        if self.hook:
+            self.hook(d)
+
+class YtPool:
+    """YoutubeDL reutilizables por (cliente, uso). Uso "download" para extraer y
+    descargar; "stream" elige formatos para /download en streaming."""
+
+    def __init__(self, idle_max: int):
+        self.idle_max = idle_max
+        self.lock = threading.Lock()
+        self.idle = {}  # {(cliente, uso): [YtSession]}
+        self.generation = None
+
+    def _options(self, client: str, ua: str, purpose: str) -> dict:
+        opts = yt_client_options(yt_base_options(), client, ua)
+        if purpose == "stream":
+            opts["format"] = STREAM_FORMAT
+        else:
+            # AAC permite servir el audio al editor sin recodificar (ver ingest_source)
+            opts["format"] = "bestaudio[acodec^=mp4a]/bestaudio/best" if SMART_INGEST else "bestaudio/best"
+        return opts
+
+    def acquire(self, client: str, ua: str, purpose: str = "download") -> YtSession:
+        _, generation = yt_cookies.current()
+        key = (client, purpose)
+        stale = []
+        with self.lock:
+            if generation != self.generation:
+                # Cookies nuevas: los YoutubeDL libres llevan el tarro anterior
+                stale = [s for sessions in self.idle.values() for s in sessions]
+                self.idle.clear()
+                self.generation = generation
+            sessions = self.idle.get(key)
+            sess = sessions.pop() if sessions else None
+        for s in stale:
+            s.ydl.close()
+        return sess or YtSession(key, self._options(client, ua, purpose), generation)
+
+    def release(self, sess: YtSession):
+        sess.hook = None
+        with self.lock:
+            sessions = self.idle.setdefault(sess.key, [])
+            if sess.generation == self.generation and len(sessions) < self.idle_max:
+                sessions.append(sess)
+                return
+        sess.ydl.close()
+
+    @contextmanager
+    def session(self, client: str, ua: str, purpose: str = "download", hook=None, outtmpl: str = None):
+        """Presta un YoutubeDL con el progreso y la plantilla de salida de este trabajo"""
+        sess = self.acquire(client, ua, purpose)
+        sess.hook = hook
+        if outtmpl:
+            sess.ydl.params["outtmpl"]["default"] = outtmpl
+        try:
+            yield sess.ydl
+        finally:
+            self.release(sess)
+
+yt_pool = YtPool(YT_POOL_IDLE)
+
+# ---------- salud de los clientes de YouTube ----------
+# Cada extracción anota si el cliente funcionó y cuánto tardó (medias móviles). Los
+# clientes se prueban por coste esperado: su latencia más, si falla, lo que cuesta
+# pasar al siguiente (CLIENT_FAIL_PENALTY); tras varios fallos seguidos un cliente se aparta durante una pausa que se
+# duplica mientras siga fallando. Con CLIENT_HEALTH_FILE el estado se comparte
+# entre workers; con CLIENT_HEDGE los dos mejores compiten y gana el primero.
+CLIENT_EWMA = 0.3                 # peso de cada intento en las medias
+CLIENT_LATENCY_PRIOR = 5.0        # s supuestos para un cliente aún sin medir
+CLIENT_FAIL_PENALTY = 10.0        # s que cuesta un fallo (reintentos y siguiente cliente)
+CLIENT_FAIL_THRESHOLD = int(os.environ.get("CLIENT_FAIL_THRESHOLD", "3"))  # fallos seguidos que lo apartan
+CLIENT_COOLDOWN = int(os.environ.get("CLIENT_COOLDOWN", "60"))             # primera pausa, en s
+CLIENT_COOLDOWN_MAX = int(os.environ.get("CLIENT_COOLDOWN_MAX", "1800"))
+CLIENT_HEALTH_FILE = os.environ.get("CLIENT_HEALTH_FILE", "")              # JSON compartido (opcional)
+CLIENT_HEDGE = os.environ.get("CLIENT_HEDGE", "0") == "1"
+CLIENT_HEDGE_DELAY = float(os.environ.get("CLIENT_HEDGE_DELAY", "0"))      # s antes de lanzar el segundo
+
+# Errores del propio vídeo: ningún cliente los arregla y no cuentan contra él
+_VIDEO_FAULT_RE = re.compile(r"Private video|has been removed|not available in your country|"
+                             r"members-only|Join this channel|account associated with this video", re.I)
+
+class ClientHealth:
+    """Éxito y latencia de cada cliente de yt-dlp, con cortacircuitos"""
+
+    def __init__(self, path: str = ""):
+        self.path = path
+        self.lock = threading.Lock()
+        self.stats = {}  # {cliente: {"ok", "latency", "fails", "trips", "open_until"}}
+
+    @contextmanager
+    def _shared(self, write: bool):
+        """Con fichero compartido, relee el estado (y lo guarda si write) bajo flock"""
+        if not self.path:
+            yield
+            return
+        with open(self.path + ".lock", "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                try:
+                    with open(self.path, "r", encoding="utf-8") as f:
+                        self.stats = json.load(f)
+                except (OSError, ValueError):
+                    pass
+                yield
+                if write:
+                    tmp = f"{self.path}.{os.getpid()}.tmp"
+                    with open(tmp, "w", encoding="utf-8") as f:
+                        json.dump(self.stats, f)
+                    os.replace(tmp, self.path)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def record(self, client: str, ok: bool, latency: float):
+        with self.lock, self._shared(True):
+            e = self.stats.setdefault(client, {"ok": 1.0, "latency": None, "fails": 0, "trips": 0, "open_until": 0.0})
+            e["ok"] += CLIENT_EWMA * ((1.0 if ok else 0.0) - e["ok"])
+            e["latency"] = latency if e["latency"] is None else e["latency"] + CLIENT_EWMA * (latency - e["latency"])
+            if ok:
+                e.update(fails=0, trips=0, open_until=0.0)
+                return
+            e["fails"] += 1
+            if e["fails"] >= CLIENT_FAIL_THRESHOLD:
+                # Tras la pausa se deja un intento; si vuelve a fallar, pausa doble
+                e["open_until"] = time.time() + min(CLIENT_COOLDOWN * 2 ** e["trips"], CLIENT_COOLDOWN_MAX)
+                e["trips"] += 1
+
+    def order(self, clients: list) -> list:
+        """clients ordenados: primero los disponibles, por coste esperado"""
+        now = time.time()
+        with self.lock, self._shared(False):
+            stats = {name: dict(e) for name, e in self.stats.items()}
+
+        def key(item):
+            i, (client, _) = item
+            e = stats.get(client) or {}
+            latency = e.get("latency")
+            cost = (CLIENT_LATENCY_PRIOR if latency is None else latency) + (1.0 - e.get("ok", 1.0)) * CLIENT_FAIL_PENALTY
+            return (e.get("open_until", 0.0) > now, cost, i)
+        return [c for _, c in sorted(enumerate(clients), key=key)]
+
+    def snapshot(self) -> dict:
+        now = time.time()
+        with self.lock, self._shared(False):
+            return {client: {"ok": round(e["ok"], 3),
+                             "latency": round(e["latency"], 3) if e["latency"] is not None else None,
+                             "fails": e["fails"], "cooldown": max(0, round(e["open_until"] - now))}
+                    for client, e in self.stats.items()}
+
+client_health = ClientHealth(CLIENT_HEALTH_FILE)
+
+def yt_try_client(url: str, client: str, ua: str):
+    """Extracción sin procesar con un cliente, anotando el resultado en client_health"""
+    t0 = time.monotonic()
+    try:
+        with yt_pool.session(client, ua) as ydl:
+            info = ydl.extract_info(url, download=False, process=False)
+    except yt_dlp.utils.DownloadError as e:
+        video_fault = _VIDEO_FAULT_RE.search(str(e))
+        if not video_fault:
+            client_health.record(client, False, time.monotonic() - t0)
+        outcome = "video_error" if video_fault else "error"
+        metrics.observe("ytmp3_client_attempt_seconds", time.monotonic() - t0, client=client, outcome=outcome)
+        trace_span("client", t0, outcome, client=client, error=str(e)[:200])
+        raise
+    client_health.record(client, True, time.monotonic() - t0)
+    metrics.observe("ytmp3_client_attempt_seconds", time.monotonic() - t0, client=client, outcome="ok")
+    trace_span("client", t0, "ok", client=client)
+    return info
+
+def yt_race_clients(url: str, pair: list):
+    """Lanza dos clientes a la vez (el segundo tras CLIENT_HEDGE_DELAY, o antes si el
+    primero falla). Devuelve ((cliente, ua), info, errores); sin ganador, info es
+    None. El perdedor sigue en segundo plano y solo anota su resultado."""
+    results = queue.Queue()
+    first_failed, won = threading.Event(), threading.Event()
+
+    def run(client, ua, delay):
+        if delay:
+            first_failed.wait(delay)
+        if won.is_set():
+            results.put((client, ua, None, None))
+            return
+        try:
+            results.put((client, ua, yt_try_client(url, client, ua), None))
+        except Exception as e:
+            results.put((client, ua, None, e))
+
+    for i, (client, ua) in enumerate(pair):
+        # Con el contexto copiado, los intentos quedan en la traza del trabajo
+        threading.Thread(target=contextvars.copy_context().run, args=(run, client, ua, CLIENT_HEDGE_DELAY * i),
+                         daemon=True).start()
+    errors = []
+    for _ in pair:
+        client, ua, info, err = results.get()
+        if info is not None:
+            won.set()
+            return (client, ua), info, errors
+        first_failed.set()
+        if err is not None:
+            errors.append(err)
+    return None, None, errors
+
+# ---------- caché de extracciones de yt-dlp ----------
+# La extracción (página, reproductor, firmas) es lo caro de yt-dlp. Se hace una sola
+# vez sin procesar (process=False) y la descarga procesa ese mismo resultado con
+# process_ie_result, sin volver a YouTube. El resultado se guarda unos minutos por ID
+# de vídeo para que /download o una nueva preparación del mismo vídeo tampoco repitan
+# la extracción (las URL de los formatos caducan a las pocas horas).
+YT_INFO_TTL = int(os.environ.get("YT_INFO_TTL", "300"))  # 0 desactiva la caché
+YT_INFO_MAX = 64
+_yt_info_cache = collections.OrderedDict()  # {video_id: (instante, (cliente, ua), info sin procesar)}
+_yt_info_lock = threading.Lock()
+
+def yt_info_forget(url: str):
+    """Descarta la extracción guardada (p. ej. si sus URL ya no sirven)"""
+    with _yt_info_lock:
+        _yt_info_cache.pop(canonical_video_id(url), None)
+
+@staged("extract")
+def yt_extract_raw(url: str):
+    """Extrae el vídeo sin procesar con el primer cliente que funcione.
+    Devuelve ((cliente, ua), info, si venía de la caché); info es una copia propia."""
+    video_id = canonical_video_id(url) if YT_INFO_TTL > 0 else None
+    if video_id:
+        with _yt_info_lock:
+            hit = _yt_info_cache.get(video_id)
+            if hit and time.monotonic() - hit[0] < YT_INFO_TTL:
+                _yt_info_cache.move_to_end(video_id)
+                span_set(client=hit[1][0], cached=True)
+                return hit[1], copy.deepcopy(hit[2]), True
+
+    order = client_health.order(CLIENTS)
+    chosen = info = last_err = None
+    if CLIENT_HEDGE and len(order) > 1:
+        chosen, info, errors = yt_race_clients(url, order[:2])
+        for e in errors if info is None else ():
+            if not isinstance(e, yt_dlp.utils.DownloadError) or _VIDEO_FAULT_RE.search(str(e)):
+                raise e
+            last_err = e
+        order = order[2:]
+    for client, ua in order:
+        if info is not None:
+            break
+        try:
+            info = yt_try_client(url, client, ua)
+            chosen = (client, ua)
+        except yt_dlp.utils.DownloadError as e:
+            if _VIDEO_FAULT_RE.search(str(e)):
+                raise
+            last_err = e
+    if info is not None:
+        if video_id:
+            with _yt_info_lock:
+                _yt_info_cache[video_id] = (time.monotonic(), chosen, copy.deepcopy(info))
+                _yt_info_cache.move_to_end(video_id)
+                while len(_yt_info_cache) > YT_INFO_MAX:
+                    _yt_info_cache.popitem(last=False)
+        span_set(client=chosen[0], cached=False)
+        return chosen, info, False
+    raise last_err if last_err else RuntimeError("No se pudo extraer información del vídeo")
+
+# ---------- descarga por rangos en paralelo ----------
+# YouTube limita la velocidad de cada conexión, así que el audio elegido se pide en
+# trozos de PARALLEL_RANGE bytes por varias conexiones a la vez y cada trozo se
+# escribe en su sitio del fichero (os.pwrite). El primer trozo va solo para conocer
+# el tamaño total. Cada trabajo abre como mucho DOWNLOAD_CONNECTIONS conexiones y el
+# proceso entero DOWNLOAD_CONNECTIONS_TOTAL. Si el formato no es un fichero HTTP
+# simple o algo falla, descarga yt-dlp como siempre.
+PARALLEL_DOWNLOAD = os.environ.get("PARALLEL_DOWNLOAD", "1") != "0" and hasattr(os, "pwrite")
+PARALLEL_RANGE = 1024 * 1024
+PARALLEL_RETRIES = 3
+DOWNLOAD_CONNECTIONS = int(os.environ.get("DOWNLOAD_CONNECTIONS", "4"))              # por trabajo
+DOWNLOAD_CONNECTIONS_TOTAL = int(os.environ.get("DOWNLOAD_CONNECTIONS_TOTAL", "8"))  # en todo el proceso
+download_connections = threading.BoundedSemaphore(DOWNLOAD_CONNECTIONS_TOTAL)
+
+class RangeFetcher:
+    """Descarga fmt["url"] a path por rangos, con progreso agregado para progress_hook"""
+
+    def __init__(self, ydl, fmt: dict, path: str, sid: str = None, progress_hook=None):
+        self.ydl, self.path, self.sid, self.hook = ydl, path, sid, progress_hook
+        self.url = fmt["url"]
+        self.headers = dict(fmt.get("http_headers") or {})
+        self.total = None
+        self.ranged = False  # el servidor respondió 206 con el tamaño total
+        self.done = 0
+        self.lock = threading.Lock()
+        self.last_report = 0.0
+        self.failed = threading.Event()
+
+    def _report(self, n: int, final: bool = False):
+        if n:
+            metrics.inc("ytmp3_downloaded_bytes_total", n, mode="parallel")
+        with self.lock:
+            self.done += n
+            now = time.monotonic()
+            if not final and now - self.last_report < 0.5:
+                return
+            self.last_report = now
+            d = {"status": "finished" if final else "downloading", "downloaded_bytes": self.done,
+                 "total_bytes": self.total, "filename": self.path}
+        if self.hook:
+            self.hook(d)
+
+    def _fetch(self, fd: int, start: int, end: int):
+        """Escribe [start, end] en su posición; reintenta desde lo ya recibido.
+        La primera respuesta con Content-Range fija self.total."""
+        pos = start
+        for attempt in range(PARALLEL_RETRIES):
+            if self.failed.is_set():
+                return
+            if self.sid and cancel_requested(self.sid):
+                raise JobCancelled("Descarga cancelada")
+            req = YDLRequest(self.url, headers=dict(self.headers, Range=f"bytes={pos}-{end}"))
+            try:
+                with download_connections:
+                    resp = self.ydl.urlopen(req)
+                    try:
+                        if resp.status != 206:
+                            if pos != 0:
+                                raise RuntimeError("el servidor no acepta rangos")
+                            end = None  # llega el fichero entero
+                            self.total = int(resp.headers.get("Content-Length") or 0) or None
+                            if self.total and self.total > MAX_UPLOAD_SIZE:
+                                raise RuntimeError("El audio supera el tamaño máximo permitido")
+                        else:
+                            m = re.search(r"/(\d+)$", resp.headers.get("Content-Range") or "")
+                            if m:
+                                if self.total is None:
+                                    self.total, self.ranged = int(m.group(1)), True
+                                end = min(end, self.total - 1)
+                            elif self.total is None:
+                                # Sin el tamaño total no se sabe cuántos rangos pedir ni
+                                # si este trozo es el fichero entero: que descargue yt-dlp
+                                raise RuntimeError("respuesta 206 sin tamaño total")
+                        while True:
+                            chunk = resp.read(STREAM_CHUNK)
+                            if not chunk:
+                                break
+                            if end is None and pos + len(chunk) > MAX_UPLOAD_SIZE:
+                                raise RuntimeError("El audio supera el tamaño máximo permitido")
+                            os.pwrite(fd, chunk, pos)
+                            pos += len(chunk)
+                            self._report(len(chunk))
+                    finally:
+                        resp.close()
+                if end is None:
+                    if self.total and pos < self.total:
+                        raise RuntimeError("respuesta incompleta")
+                    return
+                if pos > end:
+                    return
+            except (JobCancelled, RuntimeError):
+                raise
+            except Exception as e:
+                # Un 4xx (URL caducada, prohibida) no se arregla reintentando
+                if attempt == PARALLEL_RETRIES - 1 or 400 <= (getattr(e, "status", None) or 0) < 500:
+                    raise
+                print(f"rango {pos}-{end}: {e}; reintento", flush=True)
+                time.sleep(0.5 * 2 ** attempt)
+        raise RuntimeError(f"rango {start}-{end} incompleto")
+
+    def run(self):
+        fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            self._fetch(fd, 0, PARALLEL_RANGE - 1)
+            if self.ranged:
+                if self.total > MAX_UPLOAD_SIZE:
+                    raise RuntimeError("El audio supera el tamaño máximo permitido")
+                ranges = collections.deque((s, min(s + PARALLEL_RANGE, self.total) - 1)
+                                           for s in range(PARALLEL_RANGE, self.total, PARALLEL_RANGE))
+                errors = []
+
+                def worker():
+                    while not self.failed.is_set():
+                        try:
+                            start, end = ranges.popleft()
+                        except IndexError:
+                            return
+                        try:
+                            self._fetch(fd, start, end)
+                        except Exception as e:
+                            errors.append(e)
+                            self.failed.set()
+
+                threads = [threading.Thread(target=worker, daemon=True)
+                           for _ in range(min(DOWNLOAD_CONNECTIONS, len(ranges)))]
+                for t in threads: t.start()
+                for t in threads: t.join()
+                if errors:
+                    raise errors[0]
+                os.ftruncate(fd, self.total)
+            self.total = self.total or self.done
+        finally:
+            os.close(fd)
+        self._report(0, final=True)
+
+def parallel_download(ydl, info: dict, sid: str = None, progress_hook=None):
+    """Descarga por rangos el formato ya elegido en info. Devuelve la ruta final o
+    None si no es aplicable o falla (entonces descarga yt-dlp)."""
+    formats = info.get("requested_formats") or [info]
+    fmt = formats[0]
+    if len(formats) != 1 or not fmt.get("url") or not str(fmt.get("protocol") or "").startswith("http"):
+        return None
+    path = ydl.prepare_filename(info)
+    part = path + ".part"
+    try:
+        RangeFetcher(ydl, fmt, part, sid, progress_hook).run()
+        os.replace(part, path)
+    except JobCancelled:
+        raise
+    except Exception as e:
+        print("descarga en paralelo fallida, se usa yt-dlp:", e, flush=True)
+        try: os.remove(part)
+        except OSError: pass
+        return None
+    return path
+
+def yt_extract_then_download(url: str, outtmpl: str, sid: str = None):
+    if sid:
+        update_progress(sid, 10, "Extrayendo información del vídeo...", "processing")
+
+    chosen, info, cached = yt_extract_raw(url)
+
+    if sid:
+        update_progress(sid, 30, "Descargando audio...", "processing")
+
+    duration = float(info.get("duration") or 0.0)
+    title = info.get("title") or "audio"
+    client, ua = chosen
+
+    # Hook de progreso para yt-dlp
+    def progress_hook(d):
+        if sid and d['status'] == 'downloading':
+            total = d.get('total_bytes') or d.get('total_bytes_estimate')
+            if not total:
+                return
+            try:
+                percent = d.get('downloaded_bytes', 0) / total * 100
+                # Mapear 30-70% del progreso total
+                progress = 30 + (percent * 0.4)
+                update_progress(sid, int(progress), f"Descargando: {int(percent)}%", "processing")
+            except:
+                pass
+
+    try:
+        with pipeline_stage("download") as span, yt_pool.session(client, ua, hook=progress_hook, outtmpl=outtmpl) as ydl:
+            media_path = None
+            span.update(client=client, mode="parallel")
+            if PARALLEL_DOWNLOAD:
+                result = ydl.process_ie_result(copy.deepcopy(info), download=False)
+                media_path = parallel_download(ydl, result, sid, progress_hook)
+            if media_path is None:
+                span["mode"] = "ytdlp"
+                result = ydl.process_ie_result(info, download=True)
+                media_path = ydl.prepare_filename(result)
+                if os.path.exists(media_path):
+                    metrics.inc("ytmp3_downloaded_bytes_total", os.path.getsize(media_path), mode="ytdlp")
+            span.update(format=result.get("format_id"), ext=result.get("ext"),
+                        bytes=os.path.getsize(media_path) if os.path.exists(media_path) else 0)
+    except yt_dlp.utils.DownloadError:
+        yt_info_forget(url)
+        if not cached:
+            raise
+        # La extracción guardada pudo caducar: se repite una vez desde cero
+        return yt_extract_then_download(url, outtmpl, sid)
+
+    if sid:
+        update_progress(sid, 70, "Audio descargado", "processing")
+
+    return {"title": title, "duration": duration}, media_path
+
+# ---------- descarga directa en streaming ----------
+# /download sin ficheros temporales: un hilo baja el audio por rangos HTTP con la
+# sesión de yt-dlp (cookies, cabeceras del cliente) y lo escribe en el stdin de
+# ffmpeg; la respuesta va leyendo el MP3 de su stdout. Los únicos búferes son las
+# tuberías y un trozo en cada lado, así que un cliente lento frena toda la cadena
+# hasta la conexión con YouTube en vez de acumular datos en memoria o en disco.
+STREAM_DOWNLOAD = os.environ.get("STREAM_DOWNLOAD", "1") != "0"
+STREAM_FORMAT = "bestaudio[protocol^=http]/best[protocol^=http]"
+STREAM_RANGE = 10 * 1024 * 1024  # YouTube limita la velocidad de peticiones sin Range
+STREAM_CHUNK = 64 * 1024
+# Sin límite de tiempo total (un vídeo largo o un cliente lento pueden tardar lo que
+# sea): se corta solo si ni entran datos en ffmpeg ni salen hacia el cliente.
+STREAM_STALL_TIMEOUT = int(os.environ.get("STREAM_STALL_TIMEOUT", "120"))
+
+class StreamUnavailable(Exception):
+    """No se puede servir en streaming; /download usa el camino con ficheros temporales"""
+
+class StreamBroken(Exception):
+    """La descarga en streaming se cortó a medias; se deja la respuesta sin cerrar"""
+
+def yt_open_audio_stream(url: str):
+    """Extrae el vídeo con el primer cliente que funcione y se queda prestada una
+    sesión de yt-dlp de ese cliente. Devuelve (sesión, info, formato elegido)."""
+    (client, ua), raw, _ = yt_extract_raw(url)
+    sess = yt_pool.acquire(client, ua, "stream")
+    try:
+        info = sess.ydl.process_ie_result(raw, download=False)
+    except yt_dlp.utils.DownloadError as e:
+        yt_pool.release(sess)
+        raise StreamUnavailable(str(e)) from e
+    except Exception:
+        yt_pool.release(sess)
+        raise
+    fmt = (info.get("requested_formats") or [info])[0]
+    if fmt.get("url") and str(fmt.get("protocol") or "").startswith("http"):
+        return sess, info, fmt
+    yt_pool.release(sess)
+    raise StreamUnavailable("Sin formato de audio HTTP directo")
+
+def _feed_ffmpeg(sess: YtSession, fmt: dict, stdin, stop: threading.Event, errors: list, activity: list):
+    """Hilo escritor: pide el audio por rangos y lo pasa a ffmpeg. Cierra stdin
+    (fin de la entrada para ffmpeg) y devuelve la sesión de yt-dlp al terminar."""
+    ydl = sess.ydl
+    headers = dict(fmt.get("http_headers") or {})
+    pos, total = 0, fmt.get("filesize")
+    try:
+        while not stop.is_set():
+            req = YDLRequest(fmt["url"], headers=dict(headers, Range=f"bytes={pos}-{pos + STREAM_RANGE - 1}"))
+            resp = ydl.urlopen(req)
+            try:
+                got = 0
+                while not stop.is_set():
+                    chunk = resp.read(STREAM_CHUNK)
+                    if not chunk:
+                        break
+                    stdin.write(chunk)
+                    got += len(chunk)
+                    activity[0] = time.monotonic()
+                whole = resp.status != 206  # el servidor ignoró Range: ya llegó todo
+                m = re.search(r"/(\d+)$", resp.headers.get("Content-Range") or "")
+                if m:
+                    total = int(m.group(1))
+            finally:
+                resp.close()
+            pos += got
+            metrics.inc("ytmp3_downloaded_bytes_total", got, mode="stream")
+            if whole or got == 0 or (total and pos >= total) or (not total and got < STREAM_RANGE):
+                break
+    except Exception as e:
+        if not stop.is_set():  # con stop, la tubería rota es la desconexión del cliente
+            errors.append(e)
+    finally:
+        try: stdin.close()
+        except OSError: pass
+        yt_pool.release(sess)
+
+def stream_download(url: str):
+    """(info, generador de trozos MP3). Espera al primer trozo antes de devolver,
+    así los fallos de arranque aún pueden responderse con un error normal."""
+    sess, info, fmt = yt_open_audio_stream(url)
+    args = [ffbin, "-hide_banner", "-v", "error", "-i", "pipe:0", "-vn",
+            "-c:a", "libmp3lame", "-q:a", "0", "-f", "mp3", "pipe:1"]
+    proc = finished = None
+    try:
+        proc = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        activity = [time.monotonic()]
+        finished, killed = _watch_ffmpeg(proc, None, STREAM_STALL_TIMEOUT, activity)
+        stop, errors = threading.Event(), []
+        writer = threading.Thread(target=_feed_ffmpeg, args=(sess, fmt, proc.stdin, stop, errors, activity),
+                                  daemon=True)
+        writer.start()
+    except BaseException:
+        # Hasta que arranca el escritor (que la devuelve al terminar) la sesión es de aquí
+        yt_pool.release(sess)
+        if finished is not None:
+            finished.set()
+        if proc is not None:
+            proc.kill()
+            proc.wait()
+            proc.stdin.close()
+            proc.stdout.close()
+        raise
+
+    def cleanup():
+        stop.set()
+        finished.set()
+        if proc.poll() is None:
+            proc.kill()
+        proc.wait()
+        proc.stdout.close()
+        writer.join(timeout=1)  # si está esperando a la red, acabará solo (es daemon)
+
+    first = proc.stdout.read1(STREAM_CHUNK)
+    if not first:
+        cleanup()
+        raise StreamUnavailable(str(errors[0]) if errors else "FFmpeg no produjo audio")
+
+    def generate():
+        try:
+            yield first
+            while True:
+                activity[0] = time.monotonic()
+                chunk = proc.stdout.read1(STREAM_CHUNK)
+                if not chunk:
+                    break
+                yield chunk
+            proc.wait()
+            if errors or killed["reason"] or proc.returncode:
+                # Salir con excepción deja el cuerpo chunked sin su trozo final: el
+                # cliente ve la descarga cortada en vez de un MP3 truncado con 200
+                reason = errors[:1] or killed["reason"] or f"ffmpeg salió con {proc.returncode}"
+                print("descarga en streaming incompleta:", reason, flush=True)
+                raise StreamBroken(str(reason))
+        finally:
+            cleanup()
+
+    return info, generate()
+
+_DURATION_RE = re.compile(r"Duration:\s*(\d+):(\d+):(\d+\.\d+)")
+_AUDIO_CODEC_RE = re.compile(r"Stream #\S+.*?: Audio: (\w+)")
+def probe_media(path: str):
+    """(duración en segundos, códec del primer audio) leyendo la cabecera con ffmpeg -i"""
+    try:
+        proc = subprocess.run([ffbin, "-hide_banner", "-nostdin", "-i", path],
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=30)
+    except Exception:
+        return 0.0, None
+    text = proc.stderr.decode(errors="ignore")
+    duration = 0.0
+    m = _DURATION_RE.search(text)
+    if m:
+        duration = int(m.group(1))*3600 + int(m.group(2))*60 + float(m.group(3))
+    c = _AUDIO_CODEC_RE.search(text)
+    return duration, (c.group(1) if c else None)
+
+def probe_duration_seconds(path: str) -> float:
+    return probe_media(path)[0]
+
+# ---------- análisis del audio: pirámide de picos ----------
+# El audio fuente se decodifica una sola vez a PCM mono de 8 kHz. El nivel 0 guarda
+# el mínimo y el máximo de cada tramo de 10 ms; cada nivel siguiente junta dos tramos
+# del anterior. peaks.bin: cabecera <4sIIH (firma, Hz, muestras por tramo del nivel 0,
+# niveles), un uint32 por nivel con su número de tramos y, nivel tras nivel, pares
+# min/max en int8. /peaks lee solo el trozo que pide el editor.
+ANALYSIS_RATE = 8000
+ANALYSIS_CHUNK = 64 * 1024  # bytes de PCM por lectura (4 s)
+PEAKS_FILE = "peaks.bin"
+PEAKS_MAGIC = b"PKS1"
+PEAKS_BUCKET = 80           # 10 ms
+PEAKS_LEVELS = 10           # de 10 ms a 5,12 s por tramo
+PEAKS_MAX_WIDTH = 8192
+_PEAKS_HEADER = struct.Struct("<4sIIH")
+
+def decode_pcm(src: str, sid: str = None, timeout: float = None):
+    """Genera bloques array('h') con el primer audio de src en PCM mono a ANALYSIS_RATE"""
+    timeout = FFMPEG_TIMEOUT if timeout is None else timeout
+    args = [ffbin, "-hide_banner", "-nostdin", "-v", "error", "-i", src, "-vn", "-map", "0:a:0",
+            "-ac", "1", "-ar", str(ANALYSIS_RATE), "-f", "s16le", "pipe:1"]
+    proc = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    finished, killed = _watch_ffmpeg(proc, sid, timeout)
+    try:
+        pending = b""
+        while True:
+            data = proc.stdout.read(ANALYSIS_CHUNK)
+            if not data:
+                break
+            if pending:
+                data = pending + data
+            cut = len(data) & ~1
+            pending = data[cut:]
+            samples = array("h")
+            samples.frombytes(data[:cut])
+            if sys.byteorder == "big":
+                samples.byteswap()
+            yield samples
+        proc.wait()
+    finally:
+        finished.set()
+        if proc.poll() is None:
+            proc.kill(); proc.wait()
+    _raise_if_killed(killed)
+    if proc.returncode != 0:
+        raise RuntimeError("FFmpeg no pudo decodificar el audio")
+
+class PeaksBuilder:
+    """Mínimo y máximo por tramo de PEAKS_BUCKET muestras; min()/max() recorren
+    los trozos del array en C, sin bucle Python por muestra"""
+    def __init__(self):
+        self.mins = array("h")
+        self.maxs = array("h")
+        self.rest = array("h")
+        self._levels = None
+
+    def feed(self, samples):
+        if self.rest:
+            samples = self.rest + samples
+        b = PEAKS_BUCKET
+        full = len(samples) - len(samples) % b
+        chunks = [samples[i:i + b] for i in range(0, full, b)]
+        self.mins.extend(map(min, chunks))
+        self.maxs.extend(map(max, chunks))
+        self.rest = samples[full:]
+
+    def levels(self) -> list:
+        if self._levels is not None:
+            return self._levels
+        if self.rest:
+            self.mins.append(min(self.rest)); self.maxs.append(max(self.rest))
+            self.rest = array("h")
+        levels = [(self.mins, self.maxs)]
+        while len(levels) < PEAKS_LEVELS and len(levels[-1][0]) > 1:
+            mn, mx = levels[-1]
+            if len(mn) % 2:
+                mn = mn + mn[-1:]; mx = mx + mx[-1:]
+            levels.append((array("h", map(min, mn[0::2], mn[1::2])),
+                           array("h", map(max, mx[0::2], mx[1::2]))))
+        self._levels = levels
+        return levels
+
+    def write(self, path: str):
+        levels = self.levels()
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(_PEAKS_HEADER.pack(PEAKS_MAGIC, ANALYSIS_RATE, PEAKS_BUCKET, len(levels)))
+            f.write(struct.pack(f"<{len(levels)}I", *(len(mn) for mn, _ in levels)))
+            for mn, mx in levels:
+                pairs = array("b", bytes(2 * len(mn)))
+                pairs[0::2] = array("b", [v >> 8 for v in mn])
+                pairs[1::2] = array("b", [v >> 8 for v in mx])
+                f.write(pairs.tobytes())
+        os.replace(tmp, path)
+
+def read_peaks(path: str, start: float = 0.0, end: float = None, width: int = 1000):
+    """Tramos de [start, end) al nivel más grueso que aún da al menos width tramos.
+    Devuelve (nivel, segundos por tramo, segundo del primer tramo, bytes min/max)."""
+    with open(path, "rb") as f:
+        magic, rate, bucket, nlevels = _PEAKS_HEADER.unpack(f.read(_PEAKS_HEADER.size))
+        if magic != PEAKS_MAGIC or not nlevels:
+            raise ValueError("peaks.bin no válido")
+        counts = struct.unpack(f"<{nlevels}I", f.read(4 * nlevels))
+
+        def bounds(level):
+            span = bucket * (1 << level) / rate
+            lo = min(int(max(start, 0.0) / span), counts[level])
+            hi = counts[level] if end is None else min(counts[level], math.ceil(end / span))
+            return span, lo, max(hi, lo)
+
+        level, (span, lo, hi) = 0, bounds(0)
+        for lv in range(1, nlevels):
+            b = bounds(lv)
+            if b[2] - b[1] < width:
+                break
+            level, (span, lo, hi) = lv, b
+
+        f.seek(_PEAKS_HEADER.size + 4 * nlevels + 2 * sum(counts[:level]) + 2 * lo)
+        return level, span, lo * span, f.read(2 * (hi - lo))
+
+# ---------- análisis del audio: silencios y ataques ----------
+# Sale de la envolvente de picos de 10 ms del mismo paso de decodificación.
+# Un tramo es silencio si su pico queda SILENCE_REL_DB por debajo del percentil 90
+# del audio (y nunca se exige menos de -60 dBFS); hace falta SILENCE_MIN_LEN seguido.
+# Un ataque es un salto de ONSET_RISE_DB respecto a 30 ms antes.
+SILENCE_FILE = "silence.json"
+ANALYSIS_FILES = (PEAKS_FILE, SILENCE_FILE)
+SILENCE_REL_DB = float(os.environ.get("SILENCE_REL_DB", "-30"))
+SILENCE_MIN_LEN = 0.15
+ONSET_RISE_DB = 12.0
+ONSET_GAP = 0.1    # separación mínima entre ataques
+SNAP_WINDOW = float(os.environ.get("SNAP_WINDOW", "1.0"))  # segundos alrededor del punto marcado
+SNAP_PAD = 0.05    # margen dentro del silencio, antes o después del sonido
+
+def build_silence_index(mins, maxs) -> dict:
+    """Silencios [[inicio, fin], ...] y ataques [t, ...] a partir de los picos de nivel 0"""
+    frame = PEAKS_BUCKET / ANALYSIS_RATE
+    amp = array("i", map(max, map(abs, mins), maxs))
+    n = len(amp)
+    if not n:
+        return {"frame": frame, "threshold": 0, "silences": [], "onsets": []}
+    loud = sorted(amp)[int(n * 0.9)]
+    threshold = max(int(loud * 10 ** (SILENCE_REL_DB / 20)), 33)  # 33 ~ -60 dBFS
+
+    silences, run_start = [], None
+    min_frames = int(SILENCE_MIN_LEN / frame)
+    for i, a in enumerate(amp):
+        if a < threshold:
+            if run_start is None:
+                run_start = i
+        elif run_start is not None:
+            if i - run_start >= min_frames:
+                silences.append([round(run_start * frame, 3), round(i * frame, 3)])
+            run_start = None
+    if run_start is not None and n - run_start >= min_frames:
+        silences.append([round(run_start * frame, 3), round(n * frame, 3)])
+
+    rise = 10 ** (ONSET_RISE_DB / 20)
+    onsets, last = [], -ONSET_GAP
+    for i, (before, a) in enumerate(zip(amp, amp[3:]), start=3):
+        if a >= threshold and a >= rise * max(before, threshold / 2):
+            t = i * frame
+            if t - last >= ONSET_GAP:
+                onsets.append(round(t, 3))
+                last = t
+    return {"frame": frame, "threshold": threshold, "silences": silences, "onsets": onsets}
+
+def load_silence_index(sdir: str):
+    try:
+        with open(os.path.join(sdir, SILENCE_FILE), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def snap_time(index: dict, t: float, kind: str = "start", window: float = SNAP_WINDOW) -> float:
+    """Punto tranquilo más cercano a t. Para un inicio, justo antes de que empiece
+    el sonido; para un fin, justo después de que acabe. Si no hay ninguno a menos
+    de window segundos, se devuelve t."""
+    if not index:
+        return t
+    candidates = []
+    for s, e in index.get("silences", ()):
+        if s <= t <= e:
+            return t
+        pad = min(SNAP_PAD, (e - s) / 2)
+        candidates.append(e - pad if kind == "start" else s + pad)
+    if not any(abs(c - t) <= window for c in candidates):
+        # Sin silencios cerca: cortar justo antes del ataque más próximo
+        candidates = [max(o - 0.01, 0.0) for o in index.get("onsets", ())]
+    best = min(candidates, key=lambda c: abs(c - t), default=None)
+    return best if best is not None and abs(best - t) <= window else t
+
+@staged("analyze")
+def analyze_audio(src: str, sdir: str, sid: str, duration: float = 0.0, span=(95, 99)):
+    """Decodifica una vez el audio fuente y deja en la sesión sus artefactos de análisis.
+    Si falla, la sesión sigue siendo válida: el editor funciona sin forma de onda."""
+    lo, hi = span
+    update_progress(sid, lo, "Analizando el audio...", "processing")
+    span_set(media_seconds=duration)
+    peaks = PeaksBuilder()
+    try:
+        done, last = 0, -1.0
+        for samples in decode_pcm(src, sid):
+            peaks.feed(samples)
+            done += len(samples)
+            if duration > 0:
+                frac = min(done / ANALYSIS_RATE / duration, 1.0)
+                if frac - last >= 0.05:
+                    last = frac
+                    update_progress(sid, int(lo + (hi - lo) * frac), f"Analizando el audio: {int(frac * 100)}%", "processing")
+        peaks.write(os.path.join(sdir, PEAKS_FILE))
+        mins, maxs = peaks.levels()[0]
+        tmp = os.path.join(sdir, SILENCE_FILE + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(build_silence_index(mins, maxs), f)
+        os.replace(tmp, os.path.join(sdir, SILENCE_FILE))
+    except (JobCancelled, HTTPException):
+        raise
+    except Exception as e:
+        print("análisis:", e, flush=True)
+
+# ---------- ingesta del audio fuente ----------
+# Con SMART_INGEST el editor recibe el audio descargado tal cual si el navegador
+# ya sabe reproducirlo (MP3 o AAC); solo se copia el flujo a un contenedor limpio.
+# La codificación a MP3 se hace en /trim, sobre el recorte final.
+SMART_INGEST = os.environ.get("SMART_INGEST", "1") != "0"
+SOURCE_MIMETYPES = {"source.mp3": "audio/mpeg", "source.m4a": "audio/mp4"}
+INGEST_FORMATS = ("mp3", "m4a") if SMART_INGEST else ("mp3",)
+SESSION_ARTIFACTS = ANALYSIS_FILES + (FRAMES_FILE,)  # ficheros derivados del audio fuente que viajan con él
+
+def session_source(sdir: str, meta: dict = None) -> str:
+    """Ruta del audio fuente de la sesión según meta.json (source.mp3 por defecto)"""
+    if meta is None:
+        try:
+            with open(os.path.join(sdir, "meta.json"), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            meta = {}
+    name = meta.get("source") or "source.mp3"
+    return os.path.join(sdir, name if name in SOURCE_MIMETYPES else "source.mp3")
+
+@staged("ingest")
+def ingest_source(media_path: str, sdir: str, sid: str, duration: float) -> str:
+    """Deja el audio fuente en la sesión y devuelve su nombre de fichero"""
+    codec = probe_media(media_path)[1] if SMART_INGEST else None
+    if codec in ("mp3", "aac"):
+        name = "source.mp3" if codec == "mp3" else "source.m4a"
+        dst = os.path.join(sdir, name)
+        update_progress(sid, 75, "Preparando audio sin recodificar...", "processing")
+        args = [ffbin, "-hide_banner", "-nostdin", "-y", "-i", media_path, "-map", "0:a:0", "-c:a", "copy"]
+        if codec == "aac":
+            args += ["-movflags", "+faststart"]  # índice al principio: el navegador puede buscar enseguida
+        def on_progress(frac):
+            update_progress(sid, int(75 + 20 * frac), f"Preparando audio: {int(frac * 100)}%", "processing")
+        rc, _ = run_ffmpeg(args + [dst], duration, on_progress, sid=sid)
+        if rc == 0 and os.path.exists(dst) and os.path.getsize(dst) > 0:
+            span_set(mode="copy", codec=codec, media_seconds=duration, output_bytes=os.path.getsize(dst))
+            return name
+        # Si la copia del flujo falla, se recodifica como siempre
+        try: os.remove(dst)
+        except OSError: pass
+
+    with stage_slot(encode_slots, sid, "Esperando turno para convertir...", 70):
+        update_progress(sid, 75, "Convirtiendo a MP3...", "processing")
+        ffmpeg_to_mp3(media_path, os.path.join(sdir, "source.mp3"), sid, duration, (75, 95))
+    span_set(mode="encode", codec=codec)
+    return "source.mp3"
+
+@staged("index")
+def index_source(sdir: str, source: str):
+    """Guarda frames.bin si el audio fuente es MP3 y devuelve su duración exacta (o None)"""
+    if not source.endswith(".mp3"):
+        return None
+    try:
+        index = Mp3FrameIndex.scan(os.path.join(sdir, source))
+        if index is None:
+            return None
+        index.save(os.path.join(sdir, FRAMES_FILE))
+    except (OSError, ValueError):
+        return None
+    return index.duration
+
+def derive_title_from_filename(filename: str) -> str:
+    name = os.path.basename(filename or "").strip()
+    name = secure_filename(name)
+    base, _ = os.path.splitext(name)
+    base = base.strip()
+    return base or "audio"
+
+def safe_download_name(base: str) -> str:
+    base = (base or "audio")
+    base = re.sub(r'[\\/:*?"<>|]+', '_', base).strip()
+    base = re.sub(r'\s+', ' ', base)
+    return base or "audio"
+
+def write_meta(sdir: str, meta: dict):
+    with open(os.path.join(sdir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False)
+
+# ---------- caché de audio preparado ----------
+# Cada entrada es un directorio <video_id>.<formato> con los ficheros de sesión
+# reutilizables (el audio fuente y sus artefactos) y un info.json. Los ficheros se enlazan (hardlink)
+# en la sesión nueva, así que desalojar la entrada no afecta a sesiones vivas.
+AUDIO_CACHE_DIR = os.path.join(tempfile.gettempdir(), "ytmp3_cache")
+os.makedirs(AUDIO_CACHE_DIR, exist_ok=True)
+AUDIO_CACHE_MAX_BYTES = int(os.environ.get("AUDIO_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))  # 0 = desactivada
+AUDIO_CACHE_TTL = int(os.environ.get("AUDIO_CACHE_TTL", str(6 * 3600)))  # 6 h
+audio_cache_lock = threading.Lock()
+
+def audio_cache_path(video_id: str, fmt: str) -> str:
+    return os.path.join(AUDIO_CACHE_DIR, f"{video_id}.{fmt}")
+
+def shareable_files(sdir: str, source_name: str) -> list:
+    """Ficheros de una sesión preparada que otras sesiones pueden enlazar"""
+    return [source_name] + [n for n in SESSION_ARTIFACTS if os.path.exists(os.path.join(sdir, n))]
+
+def _dir_size(path: str) -> int:
+    total = 0
+    try:
+        for name in os.listdir(path):
+            try: total += os.path.getsize(os.path.join(path, name))
+            except OSError: pass
+    except OSError:
+        pass
+    return total
+
+def _link_or_copy(src: str, dst: str):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+def audio_cache_get(video_id: str):
+    """Devuelve el info.json de la primera entrada válida entre los formatos aceptados"""
+    if not video_id or AUDIO_CACHE_MAX_BYTES <= 0:
+        return None
+    for fmt in INGEST_FORMATS:
+        entry = audio_cache_path(video_id, fmt)
+        try:
+            with open(os.path.join(entry, "info.json"), "r", encoding="utf-8") as f:
+                info = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if time.time() - float(info.get("cached_at") or 0) > AUDIO_CACHE_TTL:  # TTL desde la creación
+            continue
+        info.setdefault("source", "source.mp3")
+        if os.path.exists(os.path.join(entry, info["source"])):
+            return dict(info, fmt=fmt)
+    return None
+
+def audio_cache_link(video_id: str, sdir: str, info: dict) -> bool:
+    """Enlaza los ficheros de la entrada en la sesión. False si la entrada desapareció."""
+    entry = audio_cache_path(video_id, info["fmt"])
+    linked = []
+    try:
+        for name in os.listdir(entry):
+            if name == "info.json": continue
+            dst = os.path.join(sdir, name)
+            _link_or_copy(os.path.join(entry, name), dst)
+            linked.append(dst)
+        os.utime(entry, None)  # LRU: marca de último uso
+    except OSError:
+        for p in linked:
+            try: os.remove(p)
+            except OSError: pass
+        return False
+    return os.path.exists(os.path.join(sdir, info["source"]))
+
+def audio_cache_put(video_id: str, sdir: str, info: dict):
+    """Publica los ficheros de la sesión en la caché de forma atómica.
+    info debe incluir "source", el nombre del fichero de audio de la sesión."""
+    if not video_id or AUDIO_CACHE_MAX_BYTES <= 0:
+        return
+    entry = audio_cache_path(video_id, os.path.splitext(info["source"])[1].lstrip("."))
+    tmp = os.path.join(AUDIO_CACHE_DIR, f".tmp-{uuid.uuid4().hex}")
+    try:
+        os.makedirs(tmp)
+        for name in shareable_files(sdir, info["source"]):
+            _link_or_copy(os.path.join(sdir, name), os.path.join(tmp, name))
+        data = dict(info)
+        data.setdefault("cached_at", time.time())  # al completar una entrada se conserva su antigüedad
+        with open(os.path.join(tmp, "info.json"), "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        with audio_cache_lock:
+            if os.path.isdir(entry):
+                shutil.rmtree(entry, ignore_errors=True)
+            os.rename(tmp, entry)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+        return
+    audio_cache_evict()
+
+def audio_cache_size() -> int:
+    try:
+        return sum(_dir_size(os.path.join(AUDIO_CACHE_DIR, n)) for n in os.listdir(AUDIO_CACHE_DIR)
+                   if os.path.isdir(os.path.join(AUDIO_CACHE_DIR, n)))
+    except OSError:
+        return 0
+
+def _remove_idle_lock(path: str, now: float):
+    """Borra un <video_id>.lock sin usar desde hace una hora. Se borra con el bloqueo
+    tomado, así que nadie lo tiene; quien lo abrió antes lo detecta y reabre."""
+    try:
+        if now - os.path.getmtime(path) < 3600:
+            return
+        with open(path, "a") as fh:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return
+            os.remove(path)
+    except OSError:
+        pass
+
+def audio_cache_evict(max_bytes: int = None):
+    """Elimina entradas caducadas y las menos usadas hasta respetar el límite de tamaño"""
+    max_bytes = AUDIO_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    now = time.time()
+    entries = []
+    with audio_cache_lock:
+        try:
+            names = os.listdir(AUDIO_CACHE_DIR)
+        except OSError:
+            return
+        for name in names:
+            p = os.path.join(AUDIO_CACHE_DIR, name)
+            if name.endswith(".lock"):
+                _remove_idle_lock(p, now)
+                continue
+            if not os.path.isdir(p): continue
+            try:
+                mtime = os.path.getmtime(p)
+            except OSError:
+                continue
+            # Restos de publicaciones interrumpidas
+            if name.startswith(".tmp-"):
+                if now - mtime > 3600: shutil.rmtree(p, ignore_errors=True)
+                continue
+            try:
+                created = os.path.getmtime(os.path.join(p, "info.json"))
+            except OSError:
+                created = mtime
+            if now - created > AUDIO_CACHE_TTL:
+                shutil.rmtree(p, ignore_errors=True)
+                continue
+            entries.append((mtime, _dir_size(p), p))
+        total = sum(size for _, size, _ in entries)
+        for _, size, p in sorted(entries):
+            if total <= max_bytes: break
+            shutil.rmtree(p, ignore_errors=True)
+            total -= size
+
+# ---------- caché de recortes ----------
+# Un recorte se identifica por el hash del audio fuente y sus parámetros normalizados.
+# Los ficheros se guardan en CLIP_CACHE_DIR (compartido por sesiones y workers) y cada
+# sesión enlaza los suyos en clips/. Como son hardlinks, tocar la mtime de uno
+# refresca el otro, y borrar la entrada global no afecta a la sesión.
+CLIP_CACHE_DIR = os.path.join(tempfile.gettempdir(), "ytmp3_clips")
+os.makedirs(CLIP_CACHE_DIR, exist_ok=True)
+CLIP_CACHE_MAX_BYTES = int(os.environ.get("CLIP_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))  # 0 = sin caché global
+CLIP_CACHE_TTL = int(os.environ.get("CLIP_CACHE_TTL", str(SESSION_TTL)))  # desde el último uso
+CLIP_CACHE_PER_SESSION = int(os.environ.get("CLIP_CACHE_PER_SESSION", "10"))
+clip_cache_lock = threading.Lock()
+
+def file_hash(path: str) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def session_source_hash(sdir: str, meta: dict) -> str:
+    """Hash del audio fuente; las sesiones anteriores a la caché lo calculan una vez"""
+    if not meta.get("source_hash"):
+        meta["source_hash"] = file_hash(session_source(sdir, meta))
+        write_meta(sdir, meta)
+    return meta["source_hash"]
+
+def clip_key(source_hash: str, start: float, end: float, precise: bool, fades: bool, fmt: str = "mp3") -> str:
+    fades = fades and precise  # sin corte preciso no hay fundidos
+    raw = f"{source_hash}:{round(start * 1000)}:{round(end * 1000)}:{int(precise)}:{int(fades)}:{fmt}"
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+def _touch(path: str):
+    try: os.utime(path, None)
+    except OSError: pass
+
+def clip_cache_get(sdir: str, key: str):
+    """Ruta del recorte en la sesión si ya se hizo aquí o en otra sesión con el mismo audio"""
+    local = os.path.join(sdir, "clips", f"{key}.mp3")
+    if not os.path.exists(local):
+        shared = os.path.join(CLIP_CACHE_DIR, f"{key}.mp3")
+        if CLIP_CACHE_MAX_BYTES <= 0 or not os.path.exists(shared):
+            return None
+        try:
+            os.makedirs(os.path.dirname(local), exist_ok=True)
+            _link_or_copy(shared, local)
+        except OSError:
+            return None
+    _touch(local)
+    clip_session_evict(sdir)
+    return local
+
+def clip_cache_put(sdir: str, key: str, path: str) -> str:
+    """Guarda en la sesión (y en la caché global) el recorte recién hecho en path"""
+    local = os.path.join(sdir, "clips", f"{key}.mp3")
+    os.replace(path, local)
+    if CLIP_CACHE_MAX_BYTES > 0:
+        tmp = os.path.join(CLIP_CACHE_DIR, f".tmp-{uuid.uuid4().hex}")
+        try:
+            _link_or_copy(local, tmp)
+            os.replace(tmp, os.path.join(CLIP_CACHE_DIR, f"{key}.mp3"))
+        except OSError:
+            try: os.remove(tmp)
+            except OSError: pass
+        clip_cache_evict()
+    clip_session_evict(sdir)
+    return local
+
+def clip_session_evict(sdir: str):
+    """Deja en la sesión solo los CLIP_CACHE_PER_SESSION recortes usados más recientemente"""
+    clips_dir = os.path.join(sdir, "clips")
+    try:
+        entries = [(os.path.getmtime(os.path.join(clips_dir, n)), n) for n in os.listdir(clips_dir)
+                   if n.endswith(".mp3") and not n.startswith(".")]
+    except OSError:
+        return
+    for _, name in sorted(entries, reverse=True)[CLIP_CACHE_PER_SESSION:]:
+        try: os.remove(os.path.join(clips_dir, name))
+        except OSError: pass
+
+def clip_cache_size() -> int:
+    try:
+        return sum(os.path.getsize(os.path.join(CLIP_CACHE_DIR, n)) for n in os.listdir(CLIP_CACHE_DIR))
+    except OSError:
+        return 0
+
+def clip_cache_evict(max_bytes: int = None):
+    """Elimina recortes caducados y los menos usados hasta respetar el límite de tamaño"""
+    max_bytes = CLIP_CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    now = time.time()
+    entries = []
+    with clip_cache_lock:
+        try:
+            names = os.listdir(CLIP_CACHE_DIR)
+        except OSError:
+            return
+        for name in names:
+            p = os.path.join(CLIP_CACHE_DIR, name)
+            try:
+                st = os.stat(p)
+            except OSError:
+                continue
+            limit = 3600 if name.startswith(".tmp-") else CLIP_CACHE_TTL
+            if now - st.st_mtime > limit:
+                try: os.remove(p)
+                except OSError: pass
+                continue
+            if not name.startswith(".tmp-"):
+                entries.append((st.st_mtime, st.st_size, p))
+        total = sum(size for _, size, _ in entries)
+        for _, size, p in sorted(entries):
+            if total <= max_bytes: break
+            try: os.remove(p)
+            except OSError: pass
+            total -= size
+
+# ---------- single-flight de /prepare ----------
+def singleflight_join(video_id: str, sid: str) -> bool:
+    """Si ya hay un trabajo en curso para el vídeo, sid se une a él y devuelve True.
+    Si no, sid pasa a ser el líder y devuelve False."""
+    if not video_id:
+        return False
+    with inflight_lock:
+        job = inflight_jobs.get(video_id)
+        if job is None:
+            job = {"leader": sid, "followers": []}
+            inflight_jobs[video_id] = job
+            inflight_by_leader[sid] = job
+            return False
+        job["followers"].append(sid)
+        leader = job["leader"]
+    # El seguidor arranca con el estado actual del líder
+    current = get_progress(leader)
+    update_progress(sid, current.get("progress", 0), current.get("message") or "Esperando al mismo vídeo...",
+                    current.get("status", "processing"))
+    return True
+
+def singleflight_finish(video_id: str, sid: str):
+    """Cierra el trabajo del líder y devuelve sus seguidores"""
+    if not video_id:
+        return []
+    with inflight_lock:
+        job = inflight_by_leader.pop(sid, None)
+        if job is None:
+            return []
+        if inflight_jobs.get(video_id) is job:
+            del inflight_jobs[video_id]
+        return list(job["followers"])
+
+def singleflight_handoff(video_id: str, url: str, followers: list):
+    """Los seguidores de un líder cancelado (o que falló por algo suyo) no corren su
+    suerte: el primero que sigue activo pasa a líder y se vuelve a encolar"""
+    live = []
+    for f_sid in followers:
+        if cancel_requested(f_sid):
+            cleanup_progress(f_sid)
+        else:
+            live.append(f_sid)
+    if not live:
+        return
+    with inflight_lock:
+        job = inflight_jobs.get(video_id)
+        if job is not None:
+            # Otra petición ya empezó el mismo vídeo: se esperan a ese trabajo
+            job["followers"].extend(live)
+            return
+        leader = live[0]
+        job = {"leader": leader, "followers": live[1:]}
+        inflight_jobs[video_id] = job
+        inflight_by_leader[leader] = job
+    update_progress(leader, 0, "Reintentando la preparación...", "processing")
+    try:
+        scheduler.submit(leader, process_video, leader, url, video_id)
+    except QueueFull:
+        msg = "El servidor está ocupado. Inténtalo de nuevo en unos segundos."
+        for f_sid in [leader] + singleflight_finish(video_id, leader):
+            set_progress_error(f_sid, msg)
+            shutil.rmtree(sess_dir(f_sid), ignore_errors=True)
+
+@contextmanager
+def video_file_lock(video_id: str, sid: str):
+    """Bloqueo entre workers de gunicorn para no preparar el mismo vídeo dos veces"""
+    if fcntl is None or not video_id:
+        yield
+        return
+    path = os.path.join(AUDIO_CACHE_DIR, f"{video_id}.lock")
+    while True:
+        fh = open(path, "a")
+        try:
+            fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            update_progress(sid, 5, "Este vídeo se está preparando en otra petición, esperando...", "processing")
+            fcntl.flock(fh, fcntl.LOCK_EX)
+        # audio_cache_evict borra los .lock libres: si mientras se esperaba este ya
+        # no es el fichero de la ruta, el bloqueo no vale y se vuelve a abrir
+        try:
+            same = os.fstat(fh.fileno()).st_ino == os.stat(path).st_ino
+        except OSError:
+            same = False
+        if same:
+            break
+        fh.close()
+    try:
+        os.utime(path, None)
+        yield
+    finally:
+        fcntl.flock(fh, fcntl.LOCK_UN)
+        fh.close()
+
+def materialize_session(src_sdir: str, dst_sid: str, meta: dict) -> bool:
+    """Crea la sesión dst_sid enlazando los ficheros ya preparados de src_sdir"""
+    dst = sess_dir(dst_sid)
+    try:
+        os.makedirs(dst, exist_ok=True)
+        for name in shareable_files(src_sdir, meta.get("source") or "source.mp3"):
+            _link_or_copy(os.path.join(src_sdir, name), os.path.join(dst, name))
+        write_meta(dst, dict(meta, created=datetime.utcnow().isoformat() + "Z"))
+        return True
+    except OSError:
+        shutil.rmtree(dst, ignore_errors=True)
+        return False
+
+# ---------- planificador de trabajos ----------
+# Un pool fijo de hilos con cola acotada sustituye al hilo por petición. Las
+# etapas pesadas además se limitan por separado: descargas y codificaciones.
+MAX_CONCURRENT_DOWNLOADS = int(os.environ.get("MAX_CONCURRENT_DOWNLOADS", "2"))
+MAX_CONCURRENT_ENCODES = int(os.environ.get("MAX_CONCURRENT_ENCODES", "1"))
+JOB_QUEUE_SIZE = int(os.environ.get("JOB_QUEUE_SIZE", "20"))
+QUEUE_RETRY_AFTER = 30  # segundos sugeridos al cliente cuando la cola está llena
+
+download_slots = threading.BoundedSemaphore(max(1, MAX_CONCURRENT_DOWNLOADS))
+encode_slots = threading.BoundedSemaphore(max(1, MAX_CONCURRENT_ENCODES))
+
+class QueueFull(Exception):
+    pass
+
+class JobScheduler:
+    def __init__(self, workers: int, max_queue: int):
+        self.workers = max(1, workers)
+        self.max_queue = max(0, max_queue)
+        self.cond = threading.Condition()
+        self.pending = collections.deque()  # (sid, fn, args, instante de entrada)
+        self.running = 0
+        self.threads = []
+        self.pid = None
+        self.snapshots = 0        # instantáneas de la cola tomadas
+        self.report_lock = threading.Lock()
+        self.reported = 0         # última instantánea publicada
+
+    def _ensure_threads(self):
+        # Los hilos se crean en el proceso que los usa (gunicorn hace fork)
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.threads = []
+            self.running = 0
+        while len(self.threads) < self.workers:
+            t = threading.Thread(target=self._worker, daemon=True, name=f"job-worker-{len(self.threads)}")
+            t.start()
+            self.threads.append(t)
+
+    def _positions(self):
+        """Instantánea (número, [(posición, sid)]) de la cola. Se toma con self.cond y
+        se publica sin él: con el backend SQLite cada aviso es una escritura en disco."""
+        self.snapshots += 1
+        return self.snapshots, [(pos, sid) for pos, (sid, _, _, _) in enumerate(self.pending, start=1)]
+
+    def _report_positions(self, snapshot):
+        if snapshot is None:
+            return
+        seq, positions = snapshot
+        with self.report_lock:
+            # Una instantánea más nueva ya se publicó: esta diría posiciones viejas
+            # (o "en cola" de un trabajo que ya empezó)
+            if seq < self.reported:
+                return
+            self.reported = seq
+            for pos, sid in positions:
+                update_progress(sid, 0, f"En cola: posición {pos}", "queued")
+
+    def submit(self, sid: str, fn, *args):
+        """Encola fn(*args). Lanza QueueFull si la cola está llena."""
+        positions = None
+        with self.cond:
+            self._ensure_threads()
+            idle = self.workers - self.running - len(self.pending)
+            if idle <= 0 and len(self.pending) >= self.max_queue:
+                raise QueueFull()
+            self.pending.append((sid, fn, args, time.monotonic()))
+            if idle <= 0:
+                positions = self._positions()
+            self.cond.notify()
+        self._report_positions(positions)
+
+    def stats(self) -> dict:
+        with self.cond:
+            return {"queued": len(self.pending), "running": self.running, "workers": self.workers}
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                sid, fn, args, queued_at = self.pending.popleft()
+                self.running += 1
+                positions = self._positions()
+            self._report_positions(positions)
+            waited = time.monotonic() - queued_at
+            metrics.observe("ytmp3_stage_seconds", waited, stage="queue", outcome="ok")
+            try:
+                run_traced(sid, fn, *args, queued_seconds=round(waited, 3))
+            except Exception as e:
+                set_progress_error(sid, job_error_message(e))
+            finally:
+                with self.cond:
+                    self.running -= 1
+
+scheduler = JobScheduler(MAX_CONCURRENT_DOWNLOADS + MAX_CONCURRENT_ENCODES, JOB_QUEUE_SIZE)
+
+@metrics.sampler
+def _sample_jobs():
+    stats = scheduler.stats()
+    metrics.set("ytmp3_jobs_running", stats["running"])
+    metrics.set("ytmp3_jobs_queued", stats["queued"])
+
+@contextmanager
+def stage_slot(slots, sid: str, waiting_msg: str, progress: int):
+    """Ocupa un hueco de la etapa; avisa al usuario si tiene que esperar"""
+    if not slots.acquire(blocking=False):
+        update_progress(sid, progress, waiting_msg, "processing")
+        slots.acquire()
+    try:
+        yield
+    finally:
+        slots.release()
+
+# ---------- pipeline de preparación ----------
+def process_video(sid: str, url: str, video_id: str):
+    """Descarga y convierte a MP3 en segundo plano, compartiendo el trabajo con
+    otras sesiones que pidieron el mismo vídeo a la vez"""
+    sdir = sess_dir(sid)
+    meta = None
+    extraction_failed = False  # el vídeo no se pudo obtener: lo mismo les pasaría a los seguidores
+    try:
+        os.makedirs(sdir, exist_ok=True)
+        outtmpl = os.path.join(sdir, "%(title).200B.%(ext)s")
+
+        with video_file_lock(video_id, sid):
+            # Si otro usuario ya preparó este vídeo, reutilizar su audio fuente
+            cached = audio_cache_get(video_id)
+            trace_set(video_id=video_id, audio_cache="miss")
+            if cached and audio_cache_link(video_id, sdir, cached):
+                trace_set(audio_cache="hit")
+                meta = {"title": cached.get("title") or "audio", "duration": float(cached.get("duration") or 0.0),
+                        "source": cached["source"], "source_hash": cached.get("source_hash"), "video_id": video_id,
+                        "created": datetime.utcnow().isoformat() + "Z"}
+                write_meta(sdir, meta)
+                # Entradas de caché anteriores al análisis o al índice: se completan una vez
+                stale = False
+                if not all(os.path.exists(os.path.join(sdir, n)) for n in ANALYSIS_FILES):
+                    analyze_audio(session_source(sdir, meta), sdir, sid, meta["duration"])
+                    stale = True
+                if not os.path.exists(os.path.join(sdir, FRAMES_FILE)) and index_source(sdir, meta["source"]):
+                    stale = True
+                if stale:
+                    audio_cache_put(video_id, sdir, cached)
+            else:
+                with stage_slot(download_slots, sid, "Esperando turno para descargar...", 5):
+                    update_progress(sid, 5, "Iniciando descarga...", "processing")
+                    try:
+                        info, media_path = yt_extract_then_download(url, outtmpl, sid)
+                    except JobCancelled:
+                        raise
+                    except Exception:
+                        extraction_failed = True
+                        raise
+
+                if not (media_path and os.path.exists(media_path)):
+                    extraction_failed = True
+                    raise RuntimeError("No se descargó el audio")
+
+                duration = float(info.get("duration") or 0.0)
+                source = ingest_source(media_path, sdir, sid, duration)
+                duration = index_source(sdir, source) or duration
+                analyze_audio(os.path.join(sdir, source), sdir, sid, duration)
+
+                try:
+                    if os.path.exists(media_path): os.remove(media_path)
+                except Exception:
+                    pass
+
+                source_hash = file_hash(os.path.join(sdir, source))
+                meta = {"title": info.get("title") or "audio", "duration": duration, "source": source,
+                        "source_hash": source_hash, "video_id": video_id, "created": datetime.utcnow().isoformat() + "Z"}
+                write_meta(sdir, meta)
+                audio_cache_put(video_id, sdir, {"title": meta["title"], "duration": duration, "source": source,
+                                                 "source_hash": source_hash})
+
+    except Exception as e:
+        # Se cierra el trabajo antes de avisar: el error de esta sesión no llega a los seguidores
+        followers = singleflight_finish(video_id, sid)
+        set_progress_error(sid, job_error_message(e))
+        shutil.rmtree(sdir, ignore_errors=True)
+        if not extraction_failed:
+            singleflight_handoff(video_id, url, followers)
+            return
+        for f_sid in followers:
+            if cancel_requested(f_sid):
+                cleanup_progress(f_sid)
+                continue
+            set_progress_error(f_sid, job_error_message(e))
+            shutil.rmtree(sess_dir(f_sid), ignore_errors=True)
+        return
+
+    # Las sesiones que esperaban reciben su copia antes de anunciar el final
+    for f_sid in singleflight_finish(video_id, sid):
+        if cancel_requested(f_sid):
+            # /cancel o el janitor ya borraron la sesión: no se vuelve a crear
+            cleanup_progress(f_sid)
+            continue
+        if materialize_session(sdir, f_sid, meta):
+            set_progress_complete(f_sid, "Audio preparado correctamente")
+        else:
+            set_progress_error(f_sid, "No se pudo preparar la sesión")
+    set_progress_complete(sid, "Audio preparado correctamente")
+
+def finish_upload(sid: str, sdir: str, original_path: str, title: str):
+    """Pasos comunes tras convertir una subida a source.mp3"""
+    src_mp3 = os.path.join(sdir, "source.mp3")
+    try: os.remove(original_path)
+    except OSError: pass
+
+    update_progress(sid, 90, "Calculando duración...", "processing")
+    duration = index_source(sdir, "source.mp3") or probe_duration_seconds(src_mp3)
+    analyze_audio(src_mp3, sdir, sid, duration, (90, 99))
+
+    meta = {"title": title, "duration": float(duration or 0.0), "source_hash": file_hash(src_mp3),
+            "created": datetime.utcnow().isoformat() + "Z"}
+    write_meta(sdir, meta)
+    set_progress_complete(sid, "Audio preparado correctamente")
+
+def process_upload(sid: str, original_path: str, title: str):
+    """Convierte a MP3 un archivo subido, en segundo plano"""
+    sdir = sess_dir(sid)
+    try:
+        src_mp3 = os.path.join(sdir, "source.mp3")
+        trace_set(input_bytes=os.path.getsize(original_path))
+        with stage_slot(encode_slots, sid, "Esperando turno para convertir...", 5):
+            update_progress(sid, 10, "Convirtiendo a MP3...", "processing")
+            ffmpeg_to_mp3(original_path, src_mp3, sid, probe_duration_seconds(original_path), (10, 90))
+        finish_upload(sid, sdir, original_path, title)
+    except Exception as e:
+        set_progress_error(sid, job_error_message(e))
+        shutil.rmtree(sdir, ignore_errors=True)
+
+# ---------- subidas por trozos ----------
+# POST /uploads crea la sesión, PATCH /uploads/<sid> añade bytes en Upload-Offset
+# (HEAD dice por dónde va) y POST /uploads/<sid>/finalize la cierra. Los bytes van
+# directos a <sesión>/input y el estado a upload.json, así que cualquier worker puede
+# atender cualquier trozo. Si el formato se puede leer de forma secuencial, ffmpeg
+# empieza a convertir en cuanto llega el primer MB, leyendo el fichero a medida que crece.
+UPLOAD_STATE = "upload.json"
+UPLOAD_STREAM_MIN = 1024 * 1024
+UPLOAD_STREAM_SLOTS = int(os.environ.get("UPLOAD_STREAM_SLOTS", "4"))  # conversiones simultáneas durante la subida
+UPLOAD_STALL_TIMEOUT = int(os.environ.get("UPLOAD_STALL_TIMEOUT", "120"))  # sin bytes nuevos: se abandona
+UPLOAD_POLL = 0.2
+UPLOAD_HEARTBEAT = 5  # s entre latidos del hilo que convierte durante la subida
+upload_stream_slots = threading.BoundedSemaphore(UPLOAD_STREAM_SLOTS)
+
+def upload_stream_acquire() -> bool:
+    """Hueco para convertir durante la subida. Es una codificación más, así que
+    también ocupa encode_slots (MAX_CONCURRENT_ENCODES); sin hueco libre no se
+    espera: la subida se convierte entera al finalizar, por el planificador."""
+    if not upload_stream_slots.acquire(blocking=False):
+        return False
+    if encode_slots.acquire(blocking=False):
+        return True
+    upload_stream_slots.release()
+    return False
+
+def upload_stream_release():
+    encode_slots.release()
+    upload_stream_slots.release()
+
+def read_upload_state(sdir: str):
+    try:
+        with open(os.path.join(sdir, UPLOAD_STATE), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_upload_state(sdir: str, state: dict):
+    tmp = os.path.join(sdir, UPLOAD_STATE + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(tmp, os.path.join(sdir, UPLOAD_STATE))
+
+@contextmanager
+def upload_lock(sdir: str):
+    """Serializa los cambios de una subida entre hilos y workers"""
+    if fcntl is None:
+        yield
+        return
+    with open(os.path.join(sdir, "upload.lock"), "a") as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+def upload_heartbeat(sdir: str) -> bool:
+    """Marca como vivo el hilo de conversión de este worker. False si la subida ya
+    no es suya (finalize la dio por perdida y la reprogramó)."""
+    with upload_lock(sdir):
+        state = read_upload_state(sdir)
+        if not state or state.get("ingest") != "running" or state.get("owner") != os.getpid():
+            return False
+        state["heartbeat"] = time.time()
+        write_upload_state(sdir, state)
+        return True
+
+def upload_ingest_alive(state: dict) -> bool:
+    """¿Sigue vivo el worker que convierte durante la subida? El latido cubre
+    también el caso de que otro proceso haya heredado su pid."""
+    pid = state.get("owner")
+    if not pid or time.time() - state.get("heartbeat", 0) > UPLOAD_STALL_TIMEOUT:
+        return False
+    return pid_alive(pid)
+
+def upload_streamable(head: bytes) -> bool:
+    """¿Puede ffmpeg leer este formato en orden, sin saltar al final del fichero?"""
+    if head[:3] == b"ID3" or (len(head) > 1 and head[0] == 0xFF and (head[1] & 0xE0) == 0xE0):
+        return True   # MP3 / AAC ADTS
+    if head[:4] in (b"OggS", b"fLaC", b"RIFF", b"\x1a\x45\xdf\xa3"):
+        return True   # Ogg, FLAC, WAV, Matroska/WebM
+    if head[4:8] == b"ftyp":
+        # MP4/MOV: solo si el índice (moov) va antes de los datos (mdat)
+        pos = 0
+        while pos + 8 <= len(head):
+            size, kind = struct.unpack(">I4s", head[pos:pos + 8])
+            if kind == b"moov":
+                return True
+            if kind == b"mdat" or size < 8:
+                return False
+            pos += size
+    return False
+
+def process_upload_stream(sid: str, title: str):
+    """Convierte la subida mientras llega: ffmpeg lee por stdin lo que un hilo va
+    sacando de input según crece. Si algo falla, la subida pasa al camino normal."""
+    sdir = sess_dir(sid)
+    original_path = os.path.join(sdir, "input")
+    src_mp3 = os.path.join(sdir, "source.mp3")
+    # Nombre propio: si finalize da este hilo por perdido, process_upload escribe
+    # source.mp3 sin pisarse con él
+    stream_mp3 = os.path.join(sdir, "source.stream.mp3")
+    tail = {"status": None}
+
+    def feed(stdin):
+        idle_since = last_beat = time.monotonic()
+        try:
+            with open(original_path, "rb") as f:
+                while True:
+                    if time.monotonic() - last_beat > UPLOAD_HEARTBEAT:
+                        last_beat = time.monotonic()
+                        if not upload_heartbeat(sdir):
+                            tail["status"] = "lost"
+                            break
+                    chunk = f.read(SEND_CHUNK)
+                    if chunk:
+                        stdin.write(chunk)
+                        idle_since = time.monotonic()
+                        continue
+                    if (read_upload_state(sdir) or {}).get("done"):
+                        chunk = f.read()  # lo que llegó entre la lectura y la comprobación
+                        if not chunk:
+                            tail["status"] = "done"
+                            break
+                        stdin.write(chunk)
+                        continue
+                    if cancel_requested(sid) or time.monotonic() - idle_since > UPLOAD_STALL_TIMEOUT:
+                        tail["status"] = "stalled"
+                        break
+                    time.sleep(UPLOAD_POLL)
+        except OSError:
+            tail["status"] = "error"
+        finally:
+            try: stdin.close()
+            except OSError: pass
 
-def parse_time_to_seconds(txt: str) -> float:
-    txt = (txt or "").strip()
-    if not txt: return float("nan")
-    parts = txt.split(":")
     try:
-        if len(parts)==1: return float(parts[0])
-        if len(parts)==2: return int(parts[0])*60 + float(parts[1])
-        if len(parts)==3: return int(parts[0])*3600 + int(parts[1])*60 + float(parts[2])
-    except Exception:
-        return float("nan")
-    return float("nan")
+        update_progress(sid, 5, "Convirtiendo mientras se sube...", "processing")
+        args = [ffbin, "-hide_banner", "-y", "-i", "pipe:0", "-vn", "-c:a", "libmp3lame", "-q:a", "0",
+                "-f", "mp3", stream_mp3]
+        rc, err = run_ffmpeg(args, sid=sid, timeout=FFMPEG_TIMEOUT + SESSION_TTL, feed=feed)
+        if rc != 0 or tail["status"] != "done" or not os.path.exists(stream_mp3):
+            raise RuntimeError(f"conversión incremental incompleta ({tail['status']}): {err[-200:]}")
+        with upload_lock(sdir):
+            state = read_upload_state(sdir) or {}
+            if state.get("ingest") != "running" or state.get("owner") != os.getpid():
+                raise RuntimeError("conversión incremental reasignada a otro trabajo")
+            os.replace(stream_mp3, src_mp3)
+            state["ingest"] = "done"
+            write_upload_state(sdir, state)
+    except JobCancelled:
+        upload_stream_release()
+        return
+    except Exception as e:
+        upload_stream_release()
+        print("subida:", e, flush=True)
+        trace_set(fallback=str(e)[:200])
+        try: os.remove(stream_mp3)
+        except OSError: pass
+        if not os.path.isdir(sdir):
+            return
+        with upload_lock(sdir):
+            state = read_upload_state(sdir) or {}
+            if state.get("ingest") != "running" or state.get("owner") != os.getpid():
+                return  # finalize ya la reprogramó
+            state["ingest"] = "failed"
+            write_upload_state(sdir, state)
+        if state.get("done"):
+            # finalize ya pasó y contaba con esta conversión: se hace ahora entera
+            try:
+                scheduler.submit(sid, process_upload, sid, original_path, title)
+            except QueueFull:
+                set_progress_error(sid, "El servidor está ocupado. Vuelve a subir el archivo en unos minutos.")
+        return
+    upload_stream_release()
+    try:
+        finish_upload(sid, sdir, original_path, title)
+    except Exception as e:
+        set_progress_error(sid, job_error_message(e))
+        shutil.rmtree(sdir, ignore_errors=True)
 
-def ffmpeg_to_mp3(src: str, dst: str):
-    args = [ffbin, "-hide_banner", "-nostdin", "-y", "-i", src, "-vn", "-c:a", "libmp3lame", "-q:a", "0", dst]
-    proc = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    if proc.returncode != 0 or not os.path.exists(dst) or os.path.getsize(dst)==0:
-        msg = proc.stderr.decode(errors="ignore")[-400:]
-        abort(500, f"FFmpeg falló al convertir a MP3: {msg}")
+# ---------- servicio de ficheros de sesión ----------
+# Si hay un nginx delante, AUDIO_ACCEL_REDIRECT es el prefijo de la location
+# internal que apunta a TMP_BASE; nginx sirve entonces el fichero y los rangos.
+AUDIO_ACCEL_REDIRECT = os.environ.get("AUDIO_ACCEL_REDIRECT", "")
+SEND_CHUNK = 256 * 1024
 
-def run_ffmpeg_trim(src: str, dst: str, start: float, end: float, precise: bool, fades: bool):
-    if end <= start:
-        abort(400, "El tiempo de fin debe ser mayor que el de inicio")
-    clip_len = end - start
-    if clip_len < 0.01:
-        abort(400, "El recorte debe tener al menos 0.01 s")
+def file_etag(st) -> str:
+    """ETag fuerte a partir de la identidad del fichero (inodo, tamaño, mtime)"""
+    return f'"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"'
 
-    args = [ffbin, "-hide_banner", "-nostdin", "-y"]
-    if precise:
-        # Recorte en filtros + fades con tiempo relativo seguro.
-        filters = [f"atrim=start={start:.6f}:end={end:.6f}", "asetpts=PTS-STARTPTS"]
-        if fades:
-            out_st = max(0.0, clip_len - 0.005)
-            filters.append("afade=t=in:d=0.005")
-            filters.append(f"afade=t=out:st={out_st:.6f}:d=0.005")
-        args += ["-i", src, "-af", ",".join(filters), "-c:a", "libmp3lame", "-q:a", "0", dst]
-    else:
-        # Rápido, sin recodificar.
-        args += ["-ss", f"{start:.6f}", "-to", f"{end:.6f}", "-i", src, "-c", "copy", dst]
+class FileRange:
+    """Iterable WSGI que entrega length bytes desde la posición actual de f"""
+    def __init__(self, f, length: int):
+        self.f = f
+        self.length = length
 
-    proc = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    if proc.returncode != 0 or not os.path.exists(dst) or os.path.getsize(dst)==0:
-        msg = proc.stderr.decode(errors="ignore")[-400:]
-        abort(500, f"FFmpeg falló al recortar: {msg}")
+    def __iter__(self):
+        while self.length > 0:
+            chunk = self.f.read(min(SEND_CHUNK, self.length))
+            if not chunk: break
+            self.length -= len(chunk)
+            yield chunk
 
-def yt_extract_then_download(url: str, outtmpl: str, sid: str = None):
-    base_common = {
-        "noplaylist": True,
-        "socket_timeout": 30,
-        "retries": 5,
-        "concurrent_fragment_downloads": 1,
-        "geo_bypass": True,
-        "ffmpeg_location": FFMPEG_DIR,
-        "quiet": True,
-        "no_warnings": True,
-        "max_filesize": MAX_UPLOAD_SIZE,
-        # Anti-bot improvements
-        "extractor_retries": 3,
-        "fragment_retries": 5,
-        "skip_unavailable_fragments": True,
-        "nocheckcertificate": True,
+    def close(self):
+        self.f.close()
+
+def send_session_file(path: str, mimetype: str, max_age: int = SESSION_TTL):
+    """Sirve un fichero de sesión con Range/If-Range, ETag y caché privada.
+    La URL lleva la firma, así que la caché del navegador queda ligada a ella."""
+    st = os.stat(path)
+    size = st.st_size
+    etag = file_etag(st)
+    headers = {
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+        "Cache-Control": f"private, max-age={max_age}, immutable",
+        "X-Content-Type-Options": "nosniff",
     }
-    
-    # Usar cookies si están disponibles en variable de entorno
-    cookies_txt = os.environ.get("YOUTUBE_COOKIES")
-    if cookies_txt:
-        cookies_file = os.path.join(tempfile.gettempdir(), "yt_cookies.txt")
-        with open(cookies_file, "w") as f:
-            f.write(cookies_txt)
-        base_common["cookiefile"] = cookies_file
-    
-    if sid:
-        update_progress(sid, 10, "Extrayendo información del vídeo...", "processing")
-    
-    info = None; chosen = None; last_err = None
-
-    for client, ua in CLIENTS:
-        opts_info = dict(base_common)
-        opts_info.update({
-            "user_agent": ua,
-            "http_headers": {
-                "User-Agent": ua,
-                "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
-                "Accept-Language": "en-us,en;q=0.5",
-                "Sec-Fetch-Mode": "navigate",
-            },
-            "extractor_args": {"youtube": {"player_client": [client], "skip": ["hls", "dash"]}},
-        })
-        try:
-          with yt_dlp.YoutubeDL(opts_info) as ydl:
-            info = ydl.extract_info(url, download=False)
-          chosen = (client, ua)
-          break
-        except yt_dlp.utils.DownloadError as e:
-          last_err = e
 
-    if info is None:
-        raise last_err if last_err else RuntimeError("No se pudo extraer información del vídeo")
+    if etag in (request.headers.get("If-None-Match") or ""):
+        return Response(status=304, headers=headers)
 
-    if sid:
-        update_progress(sid, 30, "Descargando audio...", "processing")
+    if AUDIO_ACCEL_REDIRECT:
+        rel = os.path.relpath(path, TMP_BASE).replace(os.sep, "/")
+        headers["X-Accel-Redirect"] = AUDIO_ACCEL_REDIRECT.rstrip("/") + "/" + rel
+        return Response(status=200, mimetype=mimetype, headers=headers)
 
-    duration = float(info.get("duration") or 0.0)
-    client, ua = chosen
-    opts_dl = dict(base_common)
-    opts_dl.update({
-        "format": "bestaudio/best",
-        "outtmpl": outtmpl,
-        "user_agent": ua,
-        "http_headers": {
-            "User-Agent": ua,
-            "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
-            "Accept-Language": "en-us,en;q=0.5",
-            "Sec-Fetch-Mode": "navigate",
-        },
-        "extractor_args": {"youtube": {"player_client": [client], "skip": ["hls", "dash"]}},
-    })
-    
-    # Hook de progreso para yt-dlp
-    def progress_hook(d):
-        if sid and d['status'] == 'downloading':
-            try:
-                percent = d.get('downloaded_bytes', 0) / d.get('total_bytes', 1) * 100
-                # Mapear 30-70% del progreso total
-                progress = 30 + (percent * 0.4)
-                update_progress(sid, int(progress), f"Descargando: {int(percent)}%", "processing")
-            except:
-                pass
-    
-    opts_dl['progress_hooks'] = [progress_hook]
-    
-    with yt_dlp.YoutubeDL(opts_dl) as ydl:
-        result = ydl.extract_info(url, download=True)
-        media_path = ydl.prepare_filename(result)
+    start, stop, status = 0, size, 200
+    rng = request.range
+    if_range = request.headers.get("If-Range")
+    # Con If-Range distinto del ETag actual se responde el fichero completo
+    if rng is not None and (not if_range or if_range == etag):
+        bounds = rng.range_for_length(size) if len(rng.ranges) == 1 else None
+        if bounds is None:
+            headers["Content-Range"] = f"bytes */{size}"
+            return Response(status=416, headers=headers)
+        start, stop = bounds
+        status = 206
+        headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
 
-    if sid:
-        update_progress(sid, 70, "Audio descargado", "processing")
+    length = stop - start
+    headers["Content-Length"] = str(length)
+    f = open(path, "rb")
+    f.seek(start)
+    file_wrapper = request.environ.get("wsgi.file_wrapper")
+    if file_wrapper is not None and (stop == size or getattr(file_wrapper, "__module__", "").startswith("gunicorn")):
+        # El FileWrapper de gunicorn usa os.sendfile desde la posición actual
+        # y respeta Content-Length, así que el rango no pasa por Python.
+        body = file_wrapper(f, SEND_CHUNK)
+    else:
+        body = FileRange(f, length)
+    return Response(body, status=status, mimetype=mimetype, headers=headers, direct_passthrough=True)
 
-    return {"title": info.get("title") or "audio", "duration": duration}, media_path
+class ZipStream:
+    """Destino no buscable para zipfile: guarda lo escrito hasta que se entrega al cliente"""
+    def __init__(self):
+        self.chunks = []
 
-_DURATION_RE = re.compile(r"Duration:\s*(\d+):(\d+):(\d+\.\d+)")
-def probe_duration_seconds(path: str) -> float:
-    try:
-        proc = subprocess.run([ffbin, "-hide_banner", "-nostdin", "-i", path],
-                              stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=30)
-        m = _DURATION_RE.search(proc.stderr.decode(errors="ignore"))
-        if not m: return 0.0
-        h = int(m.group(1)); m_ = int(m.group(2)); s = float(m.group(3))
-        return h*3600 + m_*60 + s
-    except Exception:
-        return 0.0
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        return len(data)
 
-def derive_title_from_filename(filename: str) -> str:
-    name = os.path.basename(filename or "").strip()
-    name = secure_filename(name)
-    base, _ = os.path.splitext(name)
-    base = base.strip()
-    return base or "audio"
+    def flush(self):
+        pass
 
-def safe_download_name(base: str) -> str:
-    base = (base or "audio")
-    base = re.sub(r'[\\/:*?"<>|]+', '_', base).strip()
-    base = re.sub(r'\s+', ' ', base)
-    return base or "audio"
+    def pop(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+def stream_zip(files, on_file=None):
+    """Genera un ZIP sin comprimir (el MP3 ya está comprimido) con los ficheros
+    [(ruta, nombre)], trozo a trozo y sin montarlo entero en memoria ni en disco"""
+    out = ZipStream()
+    with zipfile.ZipFile(out, "w", compression=zipfile.ZIP_STORED) as zf:
+        for path, name in files:
+            with open(path, "rb") as src, zf.open(zipfile.ZipInfo.from_file(path, name), "w") as dst:
+                for chunk in iter(lambda: src.read(SEND_CHUNK), b""):
+                    dst.write(chunk)
+                    yield out.pop()
+            if on_file:
+                on_file()
+    yield out.pop()
 
 # ---------- Helper para respuestas HTML con UTF-8 ----------
 def render_html(template_string, **context):
@@ -861,11 +4457,59 @@ def render_html(template_string, **context):
 # ---------- rutas ----------
 @app.get("/")
 def index():
-    cleanup_expired()
     print("DEPLOY_MARK:", DEPLOY_MARK, flush=True)
     print("yt-dlp:", yt_dlp.version.__version__, flush=True)
     return render_html(HOME_HTML)
 
+@app.get("/health")
+def health():
+    """Estado del proceso: uso del disco temporal, sesiones, cola de trabajos y clientes de YouTube"""
+    return {"status": "ok", "janitor": janitor.stats(), "jobs": scheduler.stats(), "clients": client_health.snapshot()}
+
+def require_token(expected: str):
+    """Exige "Authorization: Bearer <token>" para los endpoints internos. No se
+    acepta en la URL: acabaría en los logs de acceso."""
+    auth = request.headers.get("Authorization", "")
+    token = auth[7:] if auth.startswith("Bearer ") else ""
+    if not hmac.compare_digest(token.encode(), expected.encode()):
+        abort(403, "Token inválido")
+
+@app.get("/metrics")
+def metrics_endpoint():
+    """Métricas de todos los workers en formato de texto de Prometheus"""
+    if METRICS_TOKEN:
+        require_token(METRICS_TOKEN)
+    values = metrics.collect()
+    # Estado del disco compartido: se mide aquí, no se suma entre workers
+    try:
+        du = shutil.disk_usage(TMP_BASE)
+        values["ytmp3_tmp_disk_bytes"] = {(("kind", k),): getattr(du, k) for k in ("total", "used", "free")}
+        values["ytmp3_sessions"] = {(): sum(1 for n in os.listdir(TMP_BASE) if not n.startswith("."))}
+    except OSError:
+        pass
+    return Response(metrics.render(values), mimetype="text/plain; version=0.0.4",
+                    headers={"Cache-Control": "no-store"})
+
+@app.get("/debug/jobs")
+def debug_jobs():
+    """Trazas de los últimos trabajos y de los lentos; ?sid= da todas las de una sesión"""
+    if not DEBUG_TOKEN:
+        abort(404)
+    require_token(DEBUG_TOKEN)
+    try:
+        limit = max(1, min(int(request.args.get("limit") or 50), TRACE_KEEP))
+    except ValueError:
+        limit = 50
+    traces = load_traces()
+    sid = request.args.get("sid")
+    if sid:
+        return {"sid": sid, "jobs": [t for t in traces if t.get("sid") == sid][:limit]}
+    kind = request.args.get("kind")
+    if kind:
+        traces = [t for t in traces if t.get("kind") == kind]
+    slow = sorted((t for t in traces if t.get("seconds", 0) >= TRACE_SLOW), key=lambda t: -t["seconds"])
+    return {"slow_threshold": TRACE_SLOW, "recent": traces[:limit], "slow": slow[:limit]}
+
 @app.get("/youtube")
 def youtube_get():
     return render_html(YOUTUBE_HTML)
@@ -876,154 +4520,282 @@ def upload_get():
 
 @app.post("/prepare")
 def prepare():
-    cleanup_expired()
     url = (request.form.get("url") or "").strip()
     if not YTLINK.match(url):
         return {"error": "URL no válida. Debe ser de youtube.com o youtu.be"}, 400
     url = re.sub(r'(\?|&)si=[^&]+', '', url)
 
     sid = uuid.uuid4().hex
-    
-    # Iniciar procesamiento en background
-    def process_video():
-        sdir = os.path.join(TMP_BASE, sid)
-        try:
-            os.makedirs(sdir, exist_ok=True)
-            outtmpl = os.path.join(sdir, "%(title).200B.%(ext)s")
-
-            update_progress(sid, 5, "Iniciando descarga...", "processing")
-            
-            info, media_path = yt_extract_then_download(url, outtmpl, sid)
-            
-            if not (media_path and os.path.exists(media_path)):
-                set_progress_error(sid, "No se descargó el audio")
-                shutil.rmtree(sdir, ignore_errors=True)
-                return
-
-            update_progress(sid, 75, "Convirtiendo a MP3...", "processing")
-            
-            src_mp3 = os.path.join(sdir, "source.mp3")
-            ffmpeg_to_mp3(media_path, src_mp3)
-            
-            try:
-                if os.path.exists(media_path): os.remove(media_path)
-            except Exception:
-                pass
+    video_id = canonical_video_id(url)
+    janitor.touch(sid)
+    # El directorio existe desde ya: si /cancel o el janitor lo borran mientras la
+    # sesión espera a otro trabajo, cancel_requested lo ve desde cualquier worker
+    os.makedirs(sess_dir(sid), exist_ok=True)
 
-            duration = float(info.get("duration") or 0.0)
-            meta = {"title": info.get("title") or "audio", "duration": duration, "created": datetime.utcnow().isoformat() + "Z"}
-            with open(os.path.join(sdir, "meta.json"), "w", encoding="utf-8") as f:
-                json.dump(meta, f, ensure_ascii=False)
+    # Si el mismo vídeo ya se está preparando, esta sesión espera a ese trabajo
+    if not singleflight_join(video_id, sid):
+        try:
+            scheduler.submit(sid, process_video, sid, url, video_id)
+        except QueueFull:
+            msg = "El servidor está ocupado. Inténtalo de nuevo en unos segundos."
+            for f_sid in singleflight_finish(video_id, sid):
+                set_progress_error(f_sid, msg)
+                shutil.rmtree(sess_dir(f_sid), ignore_errors=True)
+            shutil.rmtree(sess_dir(sid), ignore_errors=True)
+            return {"error": msg}, 503, {"Retry-After": str(QUEUE_RETRY_AFTER)}
 
-            set_progress_complete(sid, "Audio preparado correctamente")
-            
-        except Exception as e:
-            set_progress_error(sid, str(e)[:300])
-            shutil.rmtree(sdir, ignore_errors=True)
-    
-    # Iniciar thread
-    thread = threading.Thread(target=process_video, daemon=True)
-    thread.start()
-    
     return {"session_id": sid}, 200
 
+def wants_json() -> bool:
+    """Petición de la página con JavaScript (o de un cliente de API), no de un formulario"""
+    return (request.headers.get("X-Requested-With") == "XMLHttpRequest"
+            or request.accept_mimetypes.best_match(["text/html", "application/json"]) == "application/json")
+
 @app.post("/upload")
 def upload_post():
-    cleanup_expired()
+    as_json = wants_json()
+    def fail(message: str, code: int, headers: dict = None):
+        if as_json:
+            return {"error": message}, code, headers or {}
+        abort(code, message)
+
     if "file" not in request.files:
-        abort(400, "No se envió archivo")
+        return fail("No se envió archivo", 400)
     f = request.files["file"]
     if not f or not f.filename:
-        abort(400, "Archivo inválido")
+        return fail("Archivo inválido", 400)
 
     sid = uuid.uuid4().hex
     sdir = os.path.join(TMP_BASE, sid)
     os.makedirs(sdir, exist_ok=True)
+    janitor.touch(sid)
 
     original_path = os.path.join(sdir, "input")
     try:
         f.save(original_path)
     except Exception as e:
         shutil.rmtree(sdir, ignore_errors=True)
-        abort(500, f"No se pudo guardar el archivo: {e}")
+        return fail(f"No se pudo guardar el archivo: {str(e)[:300]}", 500)
+    metrics.inc("ytmp3_uploaded_bytes_total", os.path.getsize(original_path))
 
     title = derive_title_from_filename(f.filename)
 
-    src_mp3 = os.path.join(sdir, "source.mp3")
+    # La conversión sigue en segundo plano; el cliente escucha /progress/<sid>
+    update_progress(sid, 5, "Archivo recibido", "processing")
     try:
-        ffmpeg_to_mp3(original_path, src_mp3)
-        os.remove(original_path)
-    except HTTPException:
-        shutil.rmtree(sdir, ignore_errors=True); raise
-    except Exception as e:
+        scheduler.submit(sid, process_upload, sid, original_path, title)
+    except QueueFull:
+        cleanup_progress(sid)
         shutil.rmtree(sdir, ignore_errors=True)
-        abort(500, f"FFmpeg fallo: {str(e)[:300]}")
+        return fail("El servidor está ocupado. Inténtalo de nuevo en unos segundos.",
+                    503, {"Retry-After": str(QUEUE_RETRY_AFTER)})
 
-    duration = probe_duration_seconds(src_mp3)
+    if not as_json:
+        return redirect(url_for("preparing", sid=sid, sig=sign_token(sid, "editor")), 303)
+    return {"session_id": sid}, 200
 
-    meta = {"title": title, "duration": float(duration or 0.0), "created": datetime.utcnow().isoformat() + "Z"}
-    with open(os.path.join(sdir, "meta.json"), "w", encoding="utf-8") as jf:
-        json.dump(meta, jf, ensure_ascii=False)
+@app.get("/preparing/<sid>")
+def preparing(sid):
+    """Progreso sin JavaScript: se recarga hasta que el editor está disponible"""
+    sig = request.args.get("sig", "")
+    if not verify_token(sid, "editor", sig):
+        abort(403, "Token inválido")
+    sdir = sess_dir(sid)
+    if os.path.exists(os.path.join(sdir, "meta.json")):
+        return redirect(url_for("editor", sid=sid, sig=sig))
+    p = get_progress(sid)
+    if p.get("status") == "error":
+        abort(500, p.get("error") or "Error desconocido")
+    if not os.path.isdir(sdir):
+        abort(410, "Sesión no encontrada o expirada")
+    janitor.touch(sid)
+    resp = render_html(WAIT_HTML, refresh=2, progress=int(p.get("progress") or 0),
+                       message=p.get("message") or "Procesando...")
+    resp.headers["Cache-Control"] = "no-store"
+    return resp
 
-    return render_html(
-        EDITOR_HTML,
-        title=meta["title"],
-        duration_str=hhmmss_from_seconds(meta["duration"]),
-        audio_url=url_for("audio_stream", sid=sid, sig=sign_token(sid, "audio")),
-        sid=sid,
-        sig=sign_token(sid, "trim"),
-        sig_cancel=sign_token(sid, "cancel"),
-        trim_url=url_for("trim"),
-        cancel_url=url_for("cancel"),
-        home_url=url_for("index"),
-    )
+def upload_session(sid: str):
+    """Comprueba la firma de una subida por trozos y devuelve (sdir, estado)"""
+    if not verify_token(sid, "upload", request.args.get("sig", "")):
+        abort(403, "Token inválido")
+    sdir = sess_dir(sid)
+    state = read_upload_state(sdir)
+    if state is None:
+        abort(404, "Subida no encontrada o expirada")
+    return sdir, state
+
+def upload_offset(sdir: str) -> int:
+    try:
+        return os.path.getsize(os.path.join(sdir, "input"))
+    except OSError:
+        return 0
+
+@app.post("/uploads")
+def uploads_create():
+    try:
+        length = int(request.headers.get("Upload-Length", ""))
+    except ValueError:
+        return {"error": "Falta Upload-Length"}, 400
+    if length <= 0:
+        return {"error": "Archivo inválido"}, 400
+    if length > MAX_UPLOAD_SIZE:
+        return {"error": "El archivo es demasiado grande."}, 413
+
+    # Upload-Metadata: "filename <base64>" como en tus
+    filename = ""
+    for item in (request.headers.get("Upload-Metadata") or "").split(","):
+        key, _, value = item.strip().partition(" ")
+        if key == "filename":
+            try: filename = base64.b64decode(value).decode("utf-8")
+            except ValueError: pass
+
+    sid = uuid.uuid4().hex
+    sdir = sess_dir(sid)
+    os.makedirs(sdir, exist_ok=True)
+    open(os.path.join(sdir, "input"), "wb").close()
+    write_upload_state(sdir, {"length": length, "title": derive_title_from_filename(filename or "audio"),
+                              "ingest": None, "done": False})
+    janitor.touch(sid)
+    update_progress(sid, 0, "Subiendo archivo...", "preparing")
+
+    sig = sign_token(sid, "upload")
+    upload_url = url_for("uploads_patch", sid=sid, sig=sig)
+    return ({"session_id": sid, "upload_url": upload_url,
+             "finalize_url": url_for("uploads_finalize", sid=sid, sig=sig)},
+            201, {"Location": upload_url, "Upload-Offset": "0"})
+
+@app.route("/uploads/<sid>", methods=["HEAD", "PATCH"])
+def uploads_patch(sid):
+    sdir, state = upload_session(sid)
+    headers = {"Upload-Length": str(state["length"]), "Cache-Control": "no-store"}
+    if request.method == "HEAD":
+        headers["Upload-Offset"] = str(upload_offset(sdir))
+        return "", 200, headers
+
+    try:
+        offset = int(request.headers.get("Upload-Offset", ""))
+    except ValueError:
+        return {"error": "Falta Upload-Offset"}, 400
+    start_stream = False
+    with upload_lock(sdir):
+        state = read_upload_state(sdir) or state
+        current = upload_offset(sdir)
+        if state.get("done") or offset != current:
+            headers["Upload-Offset"] = str(current)
+            return {"error": "Upload-Offset no coincide"}, 409, headers
+
+        written, overflow = current, False
+        with open(os.path.join(sdir, "input"), "ab") as f:
+            while True:
+                chunk = request.stream.read(SEND_CHUNK)
+                if not chunk:
+                    break
+                room = state["length"] - written
+                if len(chunk) > room:
+                    chunk, overflow = chunk[:room], True
+                f.write(chunk)
+                written += len(chunk)
+                metrics.inc("ytmp3_uploaded_bytes_total", len(chunk))
+                if overflow:
+                    break
+
+        if not state.get("ingest") and written >= min(UPLOAD_STREAM_MIN, state["length"]):
+            with open(os.path.join(sdir, "input"), "rb") as f:
+                head = f.read(64 * 1024)
+            if upload_streamable(head) and upload_stream_acquire():
+                state.update(ingest="running", owner=os.getpid(), heartbeat=time.time())
+                write_upload_state(sdir, state)
+                start_stream = True
+
+    if start_stream:
+        threading.Thread(target=run_traced, args=(sid, process_upload_stream, sid, state["title"]), daemon=True).start()
+    try: os.utime(sdir, None)
+    except OSError: pass
+    janitor.touch(sid)
+    pct = written * 100.0 / state["length"]
+    if state.get("ingest") == "running":
+        # La conversión va a la par que la subida
+        update_progress(sid, int(5 + pct * 0.85), f"Subiendo y convirtiendo: {pct:.0f}%", "processing")
+    else:
+        update_progress(sid, 0, f"Subiendo: {pct:.0f}%", "preparing")
+
+    headers["Upload-Offset"] = str(written)
+    if overflow:
+        return {"error": "Se enviaron más bytes de los anunciados"}, 413, headers
+    return "", 204, headers
+
+@app.post("/uploads/<sid>/finalize")
+def uploads_finalize(sid):
+    sdir, state = upload_session(sid)
+    original_path = os.path.join(sdir, "input")
+    with upload_lock(sdir):
+        state = read_upload_state(sdir) or state
+        # Si el worker que convertía durante la subida murió (reciclado de
+        # gunicorn, caída), su trabajo se rehace entero con el planificador
+        orphaned = state.get("ingest") == "running" and not upload_ingest_alive(state)
+        if orphaned:
+            print(f"subida {sid}: conversión incremental del pid {state.get('owner')} perdida", flush=True)
+            state["ingest"] = "lost"
+        elif state.get("done"):
+            return {"session_id": sid}, 200
+        size = upload_offset(sdir)
+        if size != state["length"]:
+            return ({"error": "La subida no está completa"}, 409,
+                    {"Upload-Offset": str(size), "Upload-Length": str(state["length"])})
+        state["done"] = True
+        write_upload_state(sdir, state)
+        # Si ya se está convirtiendo mientras llegaba, ese hilo termina el trabajo
+        if state.get("ingest") != "running":
+            update_progress(sid, 5, "Archivo recibido", "processing")
+            try:
+                scheduler.submit(sid, process_upload, sid, original_path, state["title"])
+            except QueueFull:
+                state["done"] = False
+                write_upload_state(sdir, state)
+                return ({"error": "El servidor está ocupado. Inténtalo de nuevo en unos segundos."},
+                        503, {"Retry-After": str(QUEUE_RETRY_AFTER)})
+    janitor.touch(sid)
+    return {"session_id": sid}, 200
 
 @app.get("/progress/<sid>")
 def progress_stream(sid):
     """Stream de progreso usando Server-Sent Events"""
+    # Al reconectar, EventSource manda Last-Event-ID y se continúa desde ahí
+    try:
+        last_id = int(request.headers.get("Last-Event-ID") or 0)
+    except ValueError:
+        last_id = 0
+    editor_url = url_for("editor", sid=sid, sig=sign_token(sid, "editor"))
+    if SSE_DISPATCH:
+        resp = sse_dispatcher.hijack(request.environ, sid, last_id, editor_url)
+        if resp is not None:
+            return resp
+
     def generate():
-        last_status = None
-        timeout = 300  # 5 minutos timeout
-        start_time = time.time()
-        
+        nonlocal last_id
+        last_change = time.monotonic()
+        yield "retry: 2000\n\n"
+
         while True:
-            if time.time() - start_time > timeout:
+            idle = time.monotonic() - last_change
+            if idle > SSE_IDLE_TIMEOUT:
                 yield f"event: error_event\ndata: {json.dumps({'error': 'Timeout'})}\n\n"
                 break
-            
-            progress_data = get_progress(sid)
-            
-            if not progress_data:
-                time.sleep(0.5)
+
+            progress_data = wait_progress(sid, last_id, min(SSE_HEARTBEAT, SSE_IDLE_TIMEOUT - idle))
+            if progress_data is None:
+                yield ": keepalive\n\n"
                 continue
-            
-            status = progress_data.get("status", "processing")
-            
-            # Enviar actualización
-            if status != last_status or progress_data.get("progress", 0) > 0:
-                yield f"event: progress\ndata: {json.dumps(progress_data)}\n\n"
-                last_status = status
-            
-            # Si completó, enviar evento final con URL del editor
-            if status == "complete":
-                sdir = sess_dir(sid)
-                meta_path = os.path.join(sdir, "meta.json")
-                if os.path.exists(meta_path):
-                    editor_url = url_for("editor", sid=sid, sig=sign_token(sid, "editor"))
-                    yield f"event: complete\ndata: {json.dumps({'editor_url': editor_url})}\n\n"
-                cleanup_progress(sid)
+            last_id = progress_data.get("version", last_id)
+            last_change = time.monotonic()
+            text, done = sse_progress_events(sid, progress_data, editor_url)
+            yield text
+            if done:
                 break
-            
-            # Si hubo error, enviar evento de error
-            if status == "error":
-                error_msg = progress_data.get("error", "Error desconocido")
-                yield f"event: error_event\ndata: {json.dumps({'error': error_msg})}\n\n"
-                cleanup_progress(sid)
-                break
-            
-            time.sleep(0.5)
-    
-    return Response(stream_with_context(generate()), mimetype="text/event-stream")
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    body = metrics.tracked(generate(), "ytmp3_sse_connections")
+    return Response(stream_with_context(body), mimetype="text/event-stream", headers=headers)
 
 @app.get("/editor/<sid>")
 def editor(sid):
@@ -1034,23 +4806,29 @@ def editor(sid):
     
     sdir = sess_dir(sid)
     meta_path = os.path.join(sdir, "meta.json")
-    src = os.path.join(sdir, "source.mp3")
     
-    if not (os.path.isdir(sdir) and os.path.exists(src) and os.path.exists(meta_path)):
+    if not (os.path.isdir(sdir) and os.path.exists(meta_path)):
         abort(410, "Sesión no encontrada o expirada")
     
     with open(meta_path, "r", encoding="utf-8") as f:
         meta = json.load(f)
+    if not os.path.exists(session_source(sdir, meta)):
+        abort(410, "Sesión no encontrada o expirada")
     
     return render_html(
         EDITOR_HTML,
         title=meta["title"],
         duration_str=hhmmss_from_seconds(meta["duration"]),
         audio_url=url_for("audio_stream", sid=sid, sig=sign_token(sid, "audio")),
+        peaks_url=url_for("peaks", sid=sid, sig=sign_token(sid, "peaks")),
+        boundaries_url=url_for("boundaries", sid=sid, sig=sign_token(sid, "boundaries")),
         sid=sid,
         sig=sign_token(sid, "trim"),
         sig_cancel=sign_token(sid, "cancel"),
         trim_url=url_for("trim"),
+        batch_url=url_for("trim_batch"),
+        preview_url=url_for("preview", sid=sid, sig=sign_token(sid, "preview")),
+        batch_max=BATCH_MAX_CLIPS,
         cancel_url=url_for("cancel"),
         home_url=url_for("index"),
     )
@@ -1061,43 +4839,102 @@ def audio_stream(sid):
     if not verify_token(sid, "audio", sig):
         abort(403, "Token inválido")
     sdir = sess_dir(sid)
-    src = os.path.join(sdir, "source.mp3")
+    src = session_source(sdir)
     if not os.path.exists(src):
         abort(410, "Sesión no encontrada o expirada")
     try: os.utime(sdir, None)
     except Exception: pass
-    resp = send_file(src, mimetype="audio/mpeg", as_attachment=False, download_name="source.mp3")
-    resp.headers["Cache-Control"] = "no-store"
+    janitor.touch(sid)
+    resp = send_session_file(src, SOURCE_MIMETYPES[os.path.basename(src)])
+    index = mp3_frame_index(src) if src.endswith(".mp3") else None
+    if index:
+        # Duración exacta para navegadores que la usan con MP3 VBR (Firefox)
+        resp.headers["X-Content-Duration"] = f"{index.duration:.3f}"
+    return resp
+
+@app.get("/peaks/<sid>")
+def peaks(sid):
+    """Pares min/max (int8) de la forma de onda entre start y end, con unos width tramos"""
+    sig = request.args.get("sig", "")
+    if not verify_token(sid, "peaks", sig):
+        abort(403, "Token inválido")
+    path = os.path.join(sess_dir(sid), PEAKS_FILE)
+    if not os.path.exists(path):
+        abort(404, "Forma de onda no disponible")
+    try:
+        start = float(request.args.get("start") or 0.0)
+        end = float(request.args["end"]) if request.args.get("end") else None
+        width = int(request.args.get("width") or 1000)
+    except ValueError:
+        abort(400, "Parámetros inválidos")
+    # inf/nan harían saltar OverflowError al pasar a índice de tramo
+    if not math.isfinite(start) or (end is not None and not (math.isfinite(end) and end > start)):
+        abort(400, "Parámetros inválidos")
+    width = min(max(width, 1), PEAKS_MAX_WIDTH)
+    try:
+        level, span, first, data = read_peaks(path, start, end, width)
+    except (OSError, ValueError, struct.error):
+        abort(404, "Forma de onda no disponible")
+    janitor.touch(sid)
+    resp = Response(data, mimetype="application/octet-stream")
+    resp.headers["X-Peaks-Level"] = str(level)
+    resp.headers["X-Peaks-Seconds-Per-Bucket"] = f"{span:.6f}"
+    resp.headers["X-Peaks-Start"] = f"{first:.6f}"
+    resp.headers["Cache-Control"] = f"private, max-age={SESSION_TTL}"
     resp.headers["X-Content-Type-Options"] = "nosniff"
     return resp
 
-@app.post("/trim")
-def trim():
-    cleanup_expired()
-    sid = (request.form.get("id") or "").strip()
-    sig = (request.form.get("sig") or "").strip()
-    if not verify_token(sid, "trim", sig):
+@app.get("/boundaries/<sid>")
+def boundaries(sid):
+    """Índice de silencios y ataques; con ?t=&kind=start|end, el punto ajustado"""
+    sig = request.args.get("sig", "")
+    if not verify_token(sid, "boundaries", sig):
+        abort(403, "Token inválido")
+    index = load_silence_index(sess_dir(sid))
+    if index is None:
+        abort(404, "Índice de silencios no disponible")
+    janitor.touch(sid)
+    t_txt = request.args.get("t")
+    if t_txt is None:
+        data = index
+    else:
+        t = parse_time_to_seconds(t_txt)
+        kind = request.args.get("kind", "start")
+        if not (t == t) or kind not in ("start", "end"):
+            abort(400, "Parámetros inválidos")
+        snapped = snap_time(index, t, kind)
+        data = {"t": round(snapped, 3), "snapped": snapped != t}
+    resp = Response(json.dumps(data), mimetype="application/json")
+    resp.headers["Cache-Control"] = f"private, max-age={SESSION_TTL}"
+    return resp
+
+def trim_session(sid: str, sig: str, scope: str = "trim"):
+    """(directorio, meta, audio fuente) de una sesión lista para recortar"""
+    if not verify_token(sid, scope, sig):
         abort(403, "Token inválido")
 
     sdir = sess_dir(sid)
     meta_path = os.path.join(sdir, "meta.json")
-    src = os.path.join(sdir, "source.mp3")
-    if not (os.path.isdir(sdir) and os.path.exists(src) and os.path.exists(meta_path)):
+    if not (os.path.isdir(sdir) and os.path.exists(meta_path)):
         shutil.rmtree(sdir, ignore_errors=True)
         abort(410, "Sesión no encontrada o expirada")
 
     with open(meta_path, "r", encoding="utf-8") as f:
         meta = json.load(f)
-    duration = float(meta.get("duration") or 0.0)
-
-    start_txt = request.form.get("start") or ""
-    end_txt = request.form.get("end") or ""
-    ringtone_mode = (request.form.get("ringtone_mode") or "false").lower() == "true"
-    precise = (request.form.get("precise") or "true").lower() == "true"
-    fades = (request.form.get("fades") or "true").lower() == "true"
+    src = session_source(sdir, meta)
+    if not os.path.exists(src):
+        shutil.rmtree(sdir, ignore_errors=True)
+        abort(410, "Sesión no encontrada o expirada")
+    return sdir, meta, src
 
+def trim_bounds(start_txt: str, end_txt: str, ringtone_mode: bool, duration: float, snap_index: dict = None):
+    """Inicio y fin en segundos, validados y dentro de la duración.
+    Con snap_index, los límites se ajustan al silencio sin volver a decodificar."""
     start = parse_time_to_seconds(start_txt)
     end = parse_time_to_seconds(end_txt)
+    if snap_index is not None:
+        if start == start: start = snap_time(snap_index, start, "start")
+        if end == end and not ringtone_mode: end = snap_time(snap_index, end, "end")
 
     if ringtone_mode:
         if not (start == start):
@@ -1112,22 +4949,170 @@ def trim():
     if duration and start >= duration: start = max(duration - 0.1, 0.0)
     if duration and end > duration: end = duration
     if end - start <= 0.01: abort(400, "El recorte debe tener al menos 0.01 s")
+    return round(start, 3), round(end, 3)  # al milisegundo, como la clave de la caché
+
+@app.post("/trim")
+def trim():
+    sid = (request.form.get("id") or "").strip()
+    sig = (request.form.get("sig") or "").strip()
+    sdir, meta, src = trim_session(sid, sig)
+    duration = float(meta.get("duration") or 0.0)
+
+    ringtone_mode = (request.form.get("ringtone_mode") or "false").lower() == "true"
+    precise = (request.form.get("precise") or "true").lower() == "true"
+    fades = (request.form.get("fades") or "true").lower() == "true"
+    snap = (request.form.get("snap") or "false").lower() == "true"
+    start, end = trim_bounds(request.form.get("start") or "", request.form.get("end") or "",
+                             ringtone_mode, duration, load_silence_index(sdir) if snap else None)
 
-    dst = os.path.join(sdir, "cut.mp3")
-    run_ffmpeg_trim(src, dst, start, end, precise or ringtone_mode, fades if (precise or ringtone_mode) else False)
+    precise = precise or ringtone_mode
+    fades = fades if precise else False
+
+    with job_trace("trim_request", sid, start=start, end=end, precise=precise, fades=fades) as trace:
+        # Un recorte ya hecho (aquí o en otra sesión con el mismo audio) se sirve tal cual
+        key = clip_key(session_source_hash(sdir, meta), start, end, precise, fades)
+        dst = clip_cache_get(sdir, key)
+        cache_status = "hit" if dst else "miss"
+        trace.attrs["clip_cache"] = cache_status
+        if dst is None:
+            os.makedirs(os.path.join(sdir, "clips"), exist_ok=True)
+            tmp = os.path.join(sdir, "clips", f".tmp-{uuid.uuid4().hex}.mp3")
+            try:
+                run_ffmpeg_trim(src, tmp, start, end, precise, fades, sid=sid)
+            except BaseException:
+                try: os.remove(tmp)
+                except OSError: pass
+                raise
+            dst = clip_cache_put(sdir, key, tmp)
+        trace.attrs["output_bytes"] = os.path.getsize(dst)
 
+    # La sesión sigue viva hasta su TTL: se puede volver a recortar
+    janitor.touch(sid)
     base = safe_download_name(meta.get("title") or "audio")
     filename = f"{base}-tono30s.mp3" if ringtone_mode else f"{base}-clip.mp3"
     resp = send_file(dst, as_attachment=True, download_name=filename)
     resp.headers["Cache-Control"] = "no-store"
     resp.headers["X-Content-Type-Options"] = "nosniff"
+    resp.headers["X-Clip-Cache"] = cache_status
+    return resp
 
-    @resp.call_on_close
-    def _cleanup():
-        try: shutil.rmtree(sdir, ignore_errors=True)
-        except Exception: pass
+PREVIEW_BITRATE = os.environ.get("PREVIEW_BITRATE", "64k")
+PREVIEW_CHUNK = 16 * 1024
 
-    return resp
+@app.get("/preview/<sid>")
+def preview(sid):
+    """Recorte de escucha: mono, bitrate bajo y los mismos fundidos que el definitivo.
+    Se envía mientras ffmpeg lo codifica y queda en la caché de recortes."""
+    sdir, meta, src = trim_session(sid, request.args.get("sig", ""), "preview")
+    duration = float(meta.get("duration") or 0.0)
+    fades = (request.args.get("fades") or "true").lower() == "true"
+    start, end = trim_bounds(request.args.get("start") or "", request.args.get("end") or "", False, duration)
+    janitor.touch(sid)
+
+    key = clip_key(session_source_hash(sdir, meta), start, end, True, fades, "preview")
+    cached = clip_cache_get(sdir, key)
+    if cached:
+        resp = send_session_file(cached, "audio/mpeg")
+        resp.headers["X-Clip-Cache"] = "hit"
+        return resp
+
+    inputs, head, chains = precise_trim_plan(src, [(start, end, fades)])
+    args = [ffbin, "-hide_banner", "-nostdin", "-v", "error"] + inputs + [
+        "-af", ",".join(head + chains[0]), "-ac", "1", "-c:a", "libmp3lame", "-b:a", PREVIEW_BITRATE,
+        "-write_xing", "0", "-flush_packets", "1", "-f", "mp3", "pipe:1"]
+    os.makedirs(os.path.join(sdir, "clips"), exist_ok=True)
+    tmp = os.path.join(sdir, "clips", f".tmp-{uuid.uuid4().hex}.mp3")
+
+    def generate():
+        # Cada trozo va al cliente en cuanto sale de ffmpeg y a la vez a disco;
+        # si el cliente se va, GeneratorExit mata ffmpeg y el fichero a medias se borra.
+        # ffmpeg arranca aquí y no en la vista: si la respuesta nunca se llega a
+        # recorrer (cliente que se va antes, fallo en after_request), no queda vivo.
+        proc = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        finished, killed = _watch_ffmpeg(proc, sid, FFMPEG_TIMEOUT)
+        complete = False
+        try:
+            with open(tmp, "wb") as f:
+                while True:
+                    chunk = proc.stdout.read1(PREVIEW_CHUNK)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    yield chunk
+            complete = proc.wait() == 0 and not killed["reason"]
+        finally:
+            finished.set()
+            if proc.poll() is None:
+                proc.kill(); proc.wait()
+            try:
+                if complete:
+                    clip_cache_put(sdir, key, tmp)
+                else:
+                    os.remove(tmp)
+            except OSError:
+                pass
+
+    headers = {"Cache-Control": "no-store", "X-Clip-Cache": "miss", "X-Accel-Buffering": "no"}
+    return Response(generate(), mimetype="audio/mpeg", headers=headers)
+
+BATCH_MAX_CLIPS = int(os.environ.get("BATCH_MAX_CLIPS", "20"))
+
+@app.post("/trim/batch")
+def trim_batch():
+    """Varios recortes de la misma sesión en una pasada de ffmpeg, devueltos como ZIP.
+    segments es una lista JSON de {start, end, fades, ringtone}; la sesión se conserva."""
+    sid = (request.form.get("id") or "").strip()
+    sig = (request.form.get("sig") or "").strip()
+    sdir, meta, src = trim_session(sid, sig)
+    duration = float(meta.get("duration") or 0.0)
+
+    try:
+        segments = json.loads(request.form.get("segments") or "[]")
+    except ValueError:
+        abort(400, "Lista de recortes inválida")
+    if not isinstance(segments, list) or not segments:
+        abort(400, "La lista de recortes está vacía")
+    if len(segments) > BATCH_MAX_CLIPS:
+        abort(400, f"Como máximo {BATCH_MAX_CLIPS} recortes por lote")
+    snap = (request.form.get("snap") or "false").lower() == "true"
+    snap_index = load_silence_index(sdir) if snap else None
+
+    clips, names = [], []
+    base = safe_download_name(meta.get("title") or "audio")
+    for n, seg in enumerate(segments, 1):
+        if not isinstance(seg, dict):
+            abort(400, "Lista de recortes inválida")
+        ringtone_mode = bool(seg.get("ringtone"))
+        start, end = trim_bounds(str(seg.get("start") or ""), str(seg.get("end") or ""),
+                                 ringtone_mode, duration, snap_index)
+        clips.append((start, end, seg.get("fades", True) is not False))
+        names.append(f"{base}-{n:02d}-tono30s.mp3" if ringtone_mode else f"{base}-{n:02d}.mp3")
+
+    # El lote vive en un subdirectorio de la sesión: cancelar o caducar la sesión lo
+    # borra con ella, y mientras se envía el ZIP la sesión se da por usada.
+    workdir = tempfile.mkdtemp(prefix="batch-", dir=sdir)
+    try:
+        outputs = run_ffmpeg_batch_trim(src, clips, workdir, sid=sid)
+    except BaseException:
+        shutil.rmtree(workdir, ignore_errors=True)
+        raise
+
+    def keep_alive():
+        try: os.utime(sdir, None)
+        except OSError: pass
+        janitor.touch(sid)
+
+    def generate():
+        try:
+            yield from stream_zip(zip(outputs, names), keep_alive)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    zip_name = f"{base}-recortes.zip"
+    headers = {"Content-Disposition": f"attachment; filename=\"recortes.zip\"; filename*=UTF-8''{quote(zip_name)}",
+               "Cache-Control": "no-store", "X-Content-Type-Options": "nosniff"}
+    keep_alive()
+    return Response(generate(), mimetype="application/zip", headers=headers)
 
 @app.post("/cancel")
 def cancel():
@@ -1135,6 +5120,7 @@ def cancel():
     sig = (request.form.get("sig") or "").strip()
     if not verify_token(sid, "cancel", sig):
         abort(403, "Token inválido")
+    request_cancel(sid)
     sdir = sess_dir(sid)
     shutil.rmtree(sdir, ignore_errors=True)
     return redirect(url_for("index"))
@@ -1147,6 +5133,20 @@ def legacy_download():
         abort(400, "URL no válida. Debe ser de youtube.com o youtu.be")
     url = re.sub(r'(\?|&)si=[^&]+', "", url)
 
+    if STREAM_DOWNLOAD:
+        try:
+            _, body = stream_download(url)
+        except StreamUnavailable as e:
+            print("descarga en streaming no disponible:", e, flush=True)
+        except HTTPException:
+            raise
+        except Exception as e:
+            abort(502, f"yt-dlp: {str(e)[:300]}")
+        else:
+            headers = {"Content-Disposition": 'attachment; filename="audio.mp3"', "Cache-Control": "no-store",
+                       "X-Content-Type-Options": "nosniff", "X-Accel-Buffering": "no"}
+            return Response(body, mimetype="audio/mpeg", headers=headers)
+
     tmpdir = tempfile.mkdtemp(prefix="ytmp3_legacy_")
     outtmpl = os.path.join(tmpdir, "%(title).200B.%(ext)s")
     try: